@@ -0,0 +1,182 @@
+#!/usr/bin/env python3
+""" Scheduler throughput benchmark for the TaskManager
+
+Schedules synthetic tasks that need no network access and measures:
+
+- dispatched_per_sec: tasks started per second
+- lateness_p50/p95/p99_ms: start time minus run_at in milliseconds
+- cpu_per_task_us: process CPU time per dispatched task in microseconds
+- bytes_per_task: memory allocated per scheduled task
+
+The noop task returns immediately, the sleep task sleeps for a short
+while so the tasks overlap like network probes do. Each is run in two
+modes: burst, where all tasks are due at the same moment, measures the
+maximum dispatch rate. spread, where the run_at of the tasks is spread
+over a window, makes the scheduler wake up for every deadline and
+shows the lateness under a steady load.
+
+    python3 benchmarks/scheduler.py [--sizes 1000 10000 100000]
+                                    [--save results.json]
+                                    [--baseline benchmarks/baseline.json]
+
+Results are only comparable on the same machine, rerun the baseline
+with --save before comparing a change.
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import sys
+import tracemalloc
+from time import process_time, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from poller import Task, TaskManager  # noqa: E402
+
+
+class NoopTask(Task):
+    """ Task that only records its lateness """
+
+    __slots__ = ()
+
+    lateness = []
+
+    async def run(self):
+        self.lateness.append(time() - self.run_at)
+
+
+class SleepTask(Task):
+    """ Task that records its lateness and sleeps like a network probe """
+
+    __slots__ = ()
+
+    lateness = []
+    duration = .05
+
+    async def run(self):
+        self.lateness.append(time() - self.run_at)
+        await asyncio.sleep(self.duration)
+
+
+def percentile(values, percent):
+    values = sorted(values)
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(len(values) * percent / 100))]
+
+
+def measure_memory(task_type, size):
+    """ Returns the bytes allocated per task added to a TaskManager """
+    loop = asyncio.new_event_loop()
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    manager = TaskManager(loop=loop)
+    now = time()
+    for i in range(size):
+        manager.add(task_type(_id=i, run_at=now + 60))
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del manager
+    loop.close()
+    return (after - before) / size
+
+
+async def dispatch(manager, task_type, size, window):
+    now = time() + .1
+    for i in range(size):
+        manager.add(task_type(_id=i, run_at=now + window * i / size))
+
+    processor = asyncio.ensure_future(manager.process_tasks())
+    start_cpu = process_time()
+    start = time()
+    while len(task_type.lateness) < size:
+        await asyncio.sleep(.01)
+    end = time()
+    cpu = process_time() - start_cpu
+    processor.cancel()
+
+    # Let the sleep tasks finish before closing the loop
+    while manager.limiter.running:
+        await asyncio.sleep(.01)
+
+    # The first task only becomes due after 0.1s
+    return end - max(start, now), cpu
+
+
+def run_benchmark(task_type, size, window, max_running):
+    task_type.lateness = []
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    manager = TaskManager(loop=loop, max_running=max_running,
+                          max_running_per_device=None)
+    elapsed, cpu = loop.run_until_complete(dispatch(manager, task_type,
+                                                    size, window))
+    loop.close()
+
+    lateness = task_type.lateness
+    return {'dispatched_per_sec': size / elapsed,
+            'lateness_p50_ms': percentile(lateness, 50) * 1000,
+            'lateness_p95_ms': percentile(lateness, 95) * 1000,
+            'lateness_p99_ms': percentile(lateness, 99) * 1000,
+            'cpu_per_task_us': cpu / size * 1000000,
+            'bytes_per_task': measure_memory(task_type, size)}
+
+
+COLUMNS = ('dispatched_per_sec', 'lateness_p50_ms', 'lateness_p95_ms',
+           'lateness_p99_ms', 'cpu_per_task_us', 'bytes_per_task')
+
+
+def print_results(results, baseline=None):
+    print('{:<24}'.format('benchmark') +
+          ''.join('{:>20}'.format(column) for column in COLUMNS))
+    for name, result in results.items():
+        line = '{:<24}'.format(name)
+        for column in COLUMNS:
+            cell = '{:.1f}'.format(result[column])
+            if baseline and name in baseline:
+                reference = baseline[name][column]
+                if reference:
+                    cell += ' ({:+.0f}%)'.format((result[column] / reference - 1) * 100)
+            line += '{:>20}'.format(cell)
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[1000, 10000, 100000])
+    parser.add_argument('--window', type=float, default=2,
+                        help='seconds over which the run_at of the tasks is spread')
+    parser.add_argument('--max-running', type=int, default=None,
+                        help='TaskManager max_running, unlimited by default')
+    parser.add_argument('--save', help='write the results to this json file')
+    parser.add_argument('--baseline', help='compare against this json file')
+    args = parser.parse_args()
+
+    results = {}
+    for task_type in (NoopTask, SleepTask):
+        for mode, window in (('burst', 0), ('spread', args.window)):
+            for size in args.sizes:
+                name = '{}-{}-{}'.format(task_type.__name__, mode, size)
+                results[name] = run_benchmark(task_type, size, window,
+                                              args.max_running)
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+
+    print_results(results, baseline)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+""" SNMP GET throughput benchmark of the pysnmp and native engines
+
+Runs a stand-in SNMPv2c agent on localhost that answers every GET with
+Counter64 values and measures for both engines of Snmp:
+
+- gets_per_sec: GET requests answered per second
+- cpu_per_get_us: process CPU time per GET in microseconds, the agent
+  runs in the same process so this includes its decoding and encoding
+
+Every GET asks for the in and out octets of an interface like
+InterfaceOctetsProbe does.
+
+    python3 benchmarks/snmp_engine.py [--requests 5000]
+                                      [--concurrency 100]
+
+Results are only comparable on the same machine.
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+from time import process_time, time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from poller.snmp_engine import (COUNTER64, RESPONSE, GET_REQUEST,  # noqa: E402
+                                decode_message, encode_message, encode_value)
+from poller.snmp_tasks import Snmp  # noqa: E402
+
+
+class StandInAgent(asyncio.DatagramProtocol):
+    """ Answers SNMPv2c GET requests with a Counter64 per OID """
+
+    def __init__(self):
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        community, pdu_tag, request_id, field1, field2, varbinds = decode_message(data)
+        if pdu_tag != GET_REQUEST:
+            return
+        response = [(oid, encode_value(COUNTER64, oid[-1] * 1000 + oid[-2]))
+                    for oid, tag, value in varbinds]
+        self.transport.sendto(encode_message(community, RESPONSE, request_id,
+                                             0, 0, response), address)
+
+
+async def run(snmp, requests, concurrency, port):
+    snmp.port = port
+    oids = ['1.3.6.1.2.1.31.1.1.1.6.{}', '1.3.6.1.2.1.31.1.1.1.10.{}']
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = []
+
+    async def get(if_index):
+        async with semaphore:
+            response = await snmp._get_multi('127.0.0.1',
+                                             [oid.format(if_index) for oid in oids])
+            if 'error' in response:
+                errors.append(response['error'])
+
+    start_cpu = process_time()
+    start = time()
+    await asyncio.gather(*[get(i % 1000) for i in range(requests)])
+    elapsed = time() - start
+    cpu = process_time() - start_cpu
+
+    return {'gets_per_sec': requests / elapsed,
+            'cpu_per_get_us': cpu / requests * 1000000,
+            'errors': len(errors)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--requests', type=int, default=5000)
+    parser.add_argument('--concurrency', type=int, default=100)
+    args = parser.parse_args()
+
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    transport, agent = loop.run_until_complete(
+        loop.create_datagram_endpoint(StandInAgent, local_addr=('127.0.0.1', 0)))
+    port = transport.get_extra_info('sockname')[1]
+
+    print('{:<12}{:>20}{:>20}{:>10}'.format('engine', 'gets_per_sec',
+                                          'cpu_per_get_us', 'errors'))
+    for name, native in (('pysnmp', False), ('native', True)):
+        snmp = Snmp(community='public', timeout=2, native=native)
+        result = loop.run_until_complete(run(snmp, args.requests,
+                                             args.concurrency, port))
+        snmp.shutdown()
+        print('{:<12}{:>20.1f}{:>20.1f}{:>10}'.format(name, result['gets_per_sec'],
+                                                    result['cpu_per_get_us'],
+                                                    result['errors']))
+
+    transport.close()
+    loop.close()
+
+
+if __name__ == '__main__':
+    main()
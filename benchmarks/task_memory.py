@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+""" Measures the memory used per scheduled task
+
+Creates Ping, Trace and InterfaceOctetsProbe tasks the way the RestApi
+does for tasks posted by the controller and reports the bytes
+allocated per task. Device strings are built per task, like the ones
+decoded from a JSON request body.
+
+    python3 benchmarks/task_memory.py [--tasks 100000] [--devices 1000]
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tracemalloc
+from time import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from poller.ip_tasks import Ping, Trace  # noqa: E402
+from poller.snmp_tasks import InterfaceOctetsProbe  # noqa: E402
+
+
+def build_tasks(task_type, amount, devices):
+    now = time()
+    tasks = []
+    for i in range(amount):
+        device = '10.{}.{}.{}'.format(0, (i % devices) // 256, (i % devices) % 256)
+        kwargs = {'_id': i, 'run_at': now, 'recurrence_time': 60}
+        if task_type is Ping:
+            tasks.append(Ping(device, **kwargs))
+        elif task_type is Trace:
+            tasks.append(Trace(device, **kwargs))
+        else:
+            tasks.append(InterfaceOctetsProbe(device, str(i % 48), None, **kwargs))
+    return tasks
+
+
+def measure(task_type, amount, devices):
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    tasks = build_tasks(task_type, amount, devices)
+    gc.collect()
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    del tasks
+    return (after - before) / amount
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--tasks', type=int, default=100000)
+    parser.add_argument('--devices', type=int, default=1000)
+    args = parser.parse_args()
+
+    for task_type in (Ping, Trace, InterfaceOctetsProbe):
+        print('{:<22} {:>8.0f} bytes/task at {} tasks'
+              .format(task_type.__name__,
+                      measure(task_type, args.tasks, args.devices),
+                      args.tasks))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import logging
+import math
+from time import monotonic
+from .utils import LruCache
+logger = logging.getLogger(__name__)
+
+
+class CircuitOpen(Exception):
+    """ Raised when a device is skipped because its circuit is open """
+    pass
+
+
+class DeviceHealth:
+    """ Round-trip time estimate and circuit state of a single device """
+
+    __slots__ = ('srtt', 'rttvar', 'failures', 'open_interval', 'retry_at',
+                 'probing')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.failures = 0
+        # Seconds between health checks while the circuit is open
+        self.open_interval = None
+        self.retry_at = None
+        # Whether the health check of the open circuit is in flight
+        self.probing = False
+
+
+class HealthTracker:
+    """ Per-device adaptive timeouts and circuit breaker
+
+    The timeout of a device follows its measured round-trip times the
+    way TCP computes its retransmission timeout (RFC 6298): smoothed
+    RTT plus four times the RTT variance, clamped between min_timeout
+    and the timeout asked for by the caller.
+
+    After failure_threshold failed requests in a row the circuit of the
+    device opens and requests are refused without touching the network,
+    except for a single health check every open_interval seconds. The
+    interval doubles with every failed health check up to
+    max_open_interval. A successful request closes the circuit again.
+
+    :param min_timeout: lower bound of the adaptive timeout in seconds
+    :param granularity: timeouts are rounded up to a multiple of this
+    :param failure_threshold: failures in a row that open the circuit
+    :param open_interval: seconds until the first health check
+    :param max_open_interval: upper bound of the health check interval
+    :param max_size: maximum amount of tracked devices
+    """
+
+    alpha = 1 / 8
+    beta = 1 / 4
+
+    def __init__(self, min_timeout=.2, granularity=.1, failure_threshold=3,
+                 open_interval=30, max_open_interval=600, max_size=100000):
+        self.min_timeout = min_timeout
+        self.granularity = granularity
+        self.failure_threshold = failure_threshold
+        self.open_interval = open_interval
+        self.max_open_interval = max_open_interval
+        self._devices = LruCache(max_size=max_size)
+
+        self.skipped = 0
+        self.opened = 0
+
+    def _health(self, device):
+        return self._devices.get_or_create(device, DeviceHealth)
+
+    def timeout(self, device, timeout):
+        """ Returns the timeout to use for a request to a device
+
+        :param timeout: timeout asked for by the caller, used as is
+            until the device answered once
+        """
+        health = self._devices.get(device)
+        if health is None or health.srtt is None:
+            return timeout
+
+        adaptive = max(self.min_timeout, health.srtt + 4 * health.rttvar)
+        adaptive = math.ceil(adaptive / self.granularity) * self.granularity
+        return min(timeout, round(adaptive, 6))
+
+    def allow(self, device):
+        """ Returns whether a request to the device should be sent
+
+        While the circuit is open only one request per interval is let
+        through as health check.
+        """
+        health = self._devices.get(device)
+        if health is None or health.retry_at is None:
+            return True
+
+        now = monotonic()
+        if now < health.retry_at:
+            self.skipped += 1
+            return False
+
+        # Let this request through as health check, the others keep
+        # being skipped until it fails or succeeds
+        health.retry_at = now + health.open_interval
+        health.probing = True
+        return True
+
+    def check(self, device):
+        """ Like allow but raises CircuitOpen """
+        if not self.allow(device):
+            raise CircuitOpen('Circuit open for {}, skipping until the next '
+                              'health check'.format(device))
+
+    def success(self, device, rtt=None):
+        """ Records an answered request
+
+        :param rtt: round-trip time in seconds, leave it out when the
+            request might have been retried so the sample is ambiguous
+        """
+        health = self._health(device)
+        if health.retry_at is not None:
+            logger.info('Device {} answers again, closing its circuit'.format(device))
+        health.failures = 0
+        health.open_interval = None
+        health.retry_at = None
+        health.probing = False
+
+        if rtt is None:
+            return
+        if health.srtt is None:
+            health.srtt = rtt
+            health.rttvar = rtt / 2
+        else:
+            health.rttvar = ((1 - self.beta) * health.rttvar +
+                             self.beta * abs(health.srtt - rtt))
+            health.srtt = (1 - self.alpha) * health.srtt + self.alpha * rtt
+
+    def failure(self, device):
+        """ Records a request that wasn't answered in time """
+        health = self._health(device)
+        health.failures += 1
+
+        if health.retry_at is not None:
+            # Requests that were in flight when the circuit opened don't
+            # back off the health checks, only a failed health check does
+            if health.probing:
+                health.probing = False
+                health.open_interval = min(health.open_interval * 2,
+                                           self.max_open_interval)
+                health.retry_at = monotonic() + health.open_interval
+        elif health.failures >= self.failure_threshold:
+            logger.info('Device {} failed {} times in a row, opening its circuit'
+                        .format(device, health.failures))
+            self.opened += 1
+            health.open_interval = self.open_interval
+            health.retry_at = monotonic() + health.open_interval
+
+        # The RTT estimate is stale, back off the timeout like TCP does
+        if health.srtt is not None:
+            health.rttvar = min(health.rttvar * 2, 60)
+
+    def is_open(self, device):
+        health = self._devices.get(device)
+        return health is not None and health.retry_at is not None
@@ -1,23 +1,65 @@
 #!/usr/bin/env python3
 
 import aiohttp
+from aiohttp.abc import AbstractResolver
+import asyncio
 from poller import Task
-from time import time
+from poller.health import HealthTracker, CircuitOpen
+from poller.resolver import resolver, ResolveError
+import socket
+from time import monotonic, time
+from urllib.parse import urlparse
+
+
+class CachedResolver(AbstractResolver):
+    """ Lets aiohttp resolve through the poller wide resolver cache """
+
+    async def resolve(self, host, port=0, family=socket.AF_INET):
+        try:
+            address = await resolver.resolve(host)
+        except ResolveError as e:
+            raise OSError(str(e))
+
+        return [{'hostname': host, 'host': address, 'port': port,
+                 'family': socket.AF_INET, 'proto': 0,
+                 'flags': socket.AI_NUMERICHOST}]
+
+    async def close(self):
+        pass
 
 
 class GetPage(Task):
-    """ Asynchronous class for common SSH queries """
+    """ Asynchronous class for HTTP GET requests
 
-    def __init__(self, url, *args, **kwargs):
-        # TODO: Implement timeout to avoid hanging tasks
+    The request timeout adapts to the response times of the host, with
+    timeout as upper bound. Hosts that stop answering are only
+    requested at the health check interval of the shared HealthTracker
+    until they answer again.
+    """
+
+    __slots__ = ('url', 'timeout')
+
+    # Shared by all GetPage tasks
+    health = HealthTracker(min_timeout=1)
+
+    def __init__(self, url, timeout=30, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.url = url
+        self.timeout = timeout
 
     def to_json(self):
         data = Task.to_json(self)
         data['url'] = self.url
+        data['timeout'] = self.timeout
         return data
 
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        task = super().from_json(data)
+        task.url = data['url']
+        task.timeout = data.get('timeout', 30)
+        return task
+
     async def run(self):
         """ Run a single command on a remote device
 
@@ -29,13 +71,30 @@ class GetPage(Task):
 
         result = {'start_timestamp': time()}
 
-        with aiohttp.ClientSession() as session:
+        host = urlparse(self.url).hostname
+        try:
+            self.health.check(host)
+        except CircuitOpen as e:
+            result['error'] = str(e)
+            result['end_timestamp'] = time()
+            self.results.append(result)
+            return result
+
+        timeout = self.health.timeout(host, self.timeout)
+        connector = aiohttp.TCPConnector(resolver=CachedResolver())
+        async with aiohttp.ClientSession(connector=connector) as session:
+            start = monotonic()
             try:
-                async with session.get(self.url) as response:
+                async with session.get(self.url,
+                                       timeout=aiohttp.ClientTimeout(total=timeout)) as response:
                     result['status_code'] = response.status
                     result['response'] = await response.text()
+                self.health.success(host, monotonic() - start)
+            except (asyncio.TimeoutError, aiohttp.ClientConnectionError) as e:
+                self.health.failure(host)
+                result['error'] = str(e) or 'Timeout after {}s'.format(timeout)
             except Exception as e:
-                result['error'] = e
+                result['error'] = str(e)
 
         result['end_timestamp'] = time()
         self.results.append(result)
@@ -0,0 +1,458 @@
+#!/usr/bin/env python3
+
+import asyncio
+import logging
+import os
+import socket
+import struct
+from time import monotonic
+from .utils import TimerWheel
+logger = logging.getLogger(__name__)
+
+ECHO_REPLY = 0
+DESTINATION_UNREACHABLE = 3
+ECHO_REQUEST = 8
+TIME_EXCEEDED = 11
+
+# Same amount of data as /bin/ping sends
+PAYLOAD = bytes(range(56))
+
+# Same destination ports as traceroute in UDP mode
+UDP_BASE_PORT = 33434
+UDP_PORTS = 1024
+UDP_PAYLOAD = bytes(32)
+
+# Linux socket options missing from the socket module
+SO_RCVBUFFORCE = 33
+SOL_RAW = 255
+ICMP_FILTER = 1
+IP_RECVERR = 11
+SO_EE_ORIGIN_ICMP = 2
+
+
+def checksum(data):
+    """ Internet checksum of RFC 1071 """
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack('!{}H'.format(len(data) // 2), data))
+    total = (total >> 16) + (total & 0xffff)
+    total += total >> 16
+    return ~total & 0xffff
+
+
+def echo_request(identifier, sequence, payload=PAYLOAD):
+    """ Returns an ICMP echo request packet """
+    header = struct.pack('!BBHHH', ECHO_REQUEST, 0, 0, identifier, sequence)
+    return (struct.pack('!BBHHH', ECHO_REQUEST, 0,
+                        checksum(header + payload), identifier, sequence) +
+            payload)
+
+
+def quoted_probe(data):
+    """ Returns the probe an ICMP error is about
+
+    :param data: the IP header and the first 8 bytes of the packet that
+        caused the error, as quoted in ICMP time exceeded and destination
+        unreachable messages
+    :return (protocol, destination address, ICMP identifier or UDP
+             source port, ICMP sequence number or UDP destination port),
+        None when it's no echo request or UDP datagram
+    """
+    if len(data) < 20:
+        return None
+    header_length = (data[0] & 0x0f) * 4
+    protocol = data[9]
+    probe = data[header_length:header_length + 8]
+    if len(probe) < 8:
+        return None
+
+    destination = socket.inet_ntoa(data[16:20])
+    if protocol == socket.IPPROTO_ICMP and probe[0] == ECHO_REQUEST:
+        identifier, sequence = struct.unpack('!HH', probe[4:8])
+        return protocol, destination, identifier, sequence
+    if protocol == socket.IPPROTO_UDP:
+        source_port, destination_port = struct.unpack('!HH', probe[:4])
+        return protocol, destination, source_port, destination_port
+    return None
+
+
+class IcmpEngine:
+    """ Sends the ICMP echo requests of all Ping tasks over one socket
+
+    Uses an unprivileged ICMP datagram socket when the kernel allows it
+    (net.ipv4.ping_group_range), otherwise a raw socket which needs
+    root or CAP_NET_RAW. Replies are matched to their request by
+    identifier, sequence number and source address. The socket is only
+    opened on the first ping.
+
+    Traces send their probes over the same socket, or over a single
+    UDP socket in UDP mode. The ICMP errors of routers are read from the
+    raw socket or, for the datagram sockets, from their error queue
+    (IP_RECVERR) which needs no privileges.
+
+    :param resolution: seconds per tick of the timeout wheel
+    :param receive_buffer: size of the socket receive buffer in bytes
+    """
+
+    def __init__(self, resolution=.01, receive_buffer=4 * 1024 * 1024):
+        self.loop = None
+        self.resolution = resolution
+        self.receive_buffer = receive_buffer
+        self.sock = None
+        self.raw = None
+        self.unavailable = False
+        self.identifier = None
+        self._sequence = 0
+        self.udp_sock = None
+        self.udp_port = None
+        self._port = 0
+        # (protocol, address, sequence or port) ->
+        # (future, sent at, timeout slot, whether it's a trace probe)
+        self._pending = {}
+        self._timeouts = None
+
+        self.sent = 0
+        self.received = 0
+
+    def _start(self):
+        """ Binds the engine to the running event loop """
+        loop = asyncio.get_event_loop()
+        if self.loop is loop and self._timeouts is not None:
+            return
+        if self.loop is not None:
+            # Opened on another event loop
+            self.close()
+        self.loop = loop
+        self._timeouts = TimerWheel(self._expire, resolution=self.resolution,
+                                    loop=self.loop)
+
+    def _buffer(self, sock):
+        # Replies of a burst of requests arrive at once
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, SO_RCVBUFFORCE, self.receive_buffer)
+        except OSError:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self.receive_buffer)
+
+    def open(self):
+        """ Opens the socket
+
+        :raises PermissionError: when neither socket type is allowed
+        """
+        self._start()
+        if self.sock is not None:
+            return
+        if self.unavailable:
+            raise PermissionError('No ICMP socket allowed')
+
+        try:
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM,
+                                 socket.IPPROTO_ICMP)
+            raw = False
+        except PermissionError:
+            try:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_RAW,
+                                     socket.IPPROTO_ICMP)
+            except PermissionError:
+                # Don't try again for every ping
+                self.unavailable = True
+                raise
+            raw = True
+        sock.setblocking(False)
+        self._buffer(sock)
+
+        if raw:
+            # Only wake up for the replies, not for every ICMP packet
+            # the host receives, like the own echo requests on loopback
+            sock.setsockopt(SOL_RAW, ICMP_FILTER,
+                            struct.pack('I', ~((1 << ECHO_REPLY) |
+                                               (1 << DESTINATION_UNREACHABLE) |
+                                               (1 << TIME_EXCEEDED)) & 0xffffffff))
+            self.identifier = os.getpid() & 0xffff
+        else:
+            # The kernel uses the local port of the socket as identifier
+            sock.bind(('0.0.0.0', 0))
+            self.identifier = sock.getsockname()[1]
+            # ICMP errors about our probes are only queued with this
+            sock.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+
+        self.sock = sock
+        self.raw = raw
+        self.loop.add_reader(sock.fileno(), self._read)
+        logger.info('Opened {} ICMP socket'.format('raw' if raw else 'datagram'))
+
+    def open_udp(self):
+        """ Opens the socket for traces in UDP mode """
+        self._start()
+        if self.udp_sock is not None:
+            return
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setblocking(False)
+        self._buffer(sock)
+        sock.setsockopt(socket.IPPROTO_IP, IP_RECVERR, 1)
+        sock.bind(('0.0.0.0', 0))
+
+        self.udp_sock = sock
+        self.udp_port = sock.getsockname()[1]
+        self.loop.add_reader(sock.fileno(), self._read_udp)
+
+    def close(self):
+        for sock in (self.sock, self.udp_sock):
+            if sock is not None:
+                self.loop.remove_reader(sock.fileno())
+                sock.close()
+        self.sock = None
+        self.udp_sock = None
+        if self._timeouts is not None:
+            self._timeouts.close()
+            self._timeouts = None
+        for future, sent_at, slot, trace in self._pending.values():
+            if not future.done():
+                future.cancel()
+        self._pending.clear()
+
+    def _next_sequence(self, address):
+        for i in range(0x10000):
+            self._sequence = (self._sequence + 1) & 0xffff
+            if (socket.IPPROTO_ICMP, address, self._sequence) not in self._pending:
+                return self._sequence
+        raise OSError('No free ICMP sequence numbers for {}'.format(address))
+
+    def _next_port(self, address):
+        for i in range(UDP_PORTS):
+            self._port = (self._port + 1) % UDP_PORTS
+            if (socket.IPPROTO_UDP, address, UDP_BASE_PORT + self._port) not in self._pending:
+                return UDP_BASE_PORT + self._port
+        raise OSError('No free UDP ports for {}'.format(address))
+
+    def _send(self, address, timeout, trace=False):
+        """ Sends an echo request, returns the future of its round-trip
+        time in seconds or None when it's lost """
+        sequence = self._next_sequence(address)
+        return self._transmit(self.sock, echo_request(self.identifier, sequence),
+                              address, 0, (socket.IPPROTO_ICMP, address, sequence),
+                              timeout, trace)
+
+    def _send_udp(self, address, timeout):
+        """ Sends a UDP trace probe """
+        port = self._next_port(address)
+        return self._transmit(self.udp_sock, UDP_PAYLOAD, address, port,
+                              (socket.IPPROTO_UDP, address, port), timeout, True)
+
+    def _transmit(self, sock, data, address, port, key, timeout, trace):
+        future = self.loop.create_future()
+        try:
+            sock.sendto(data, (address, port))
+        except OSError as e:
+            logger.debug('Unable to send a probe to {}: {}'.format(address, e))
+            future.set_result(None)
+            return future
+
+        self._pending[key] = (future, monotonic(), self._timeouts.add(key, timeout),
+                              trace)
+        self.sent += 1
+        return future
+
+    def _expire(self, key):
+        entry = self._pending.pop(key, None)
+        if entry is not None and not entry[0].done():
+            entry[0].set_result(None)
+
+    def _answer(self, key, responder, final, error=False):
+        """ Completes the probe of a reply or ICMP error
+
+        Pings only complete on echo replies, traces complete with
+        (responder address, round-trip time, whether the destination or
+        an unreachable error was reached).
+        """
+        entry = self._pending.get(key)
+        if entry is None or (error and not entry[3]):
+            return
+        del self._pending[key]
+        future, sent_at, slot, trace = entry
+        self._timeouts.cancel(key, slot)
+        if future.done():
+            return
+        self.received += 1
+        rtt = monotonic() - sent_at
+        future.set_result((responder, rtt, final) if trace else rtt)
+
+    def _read(self):
+        if not self.raw:
+            self._read_errors(self.sock, socket.IPPROTO_ICMP)
+
+        while True:
+            try:
+                data, (address, port) = self.sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug('ICMP socket error {}'.format(e))
+                return
+
+            if self.raw:
+                # Raw sockets include the IP header
+                data = data[(data[0] & 0x0f) * 4:]
+            if len(data) < 8:
+                continue
+
+            icmp_type, code, _, identifier, sequence = struct.unpack('!BBHHH', data[:8])
+            if icmp_type == ECHO_REPLY:
+                if identifier == self.identifier:
+                    self._answer((socket.IPPROTO_ICMP, address, sequence), address, True)
+            elif icmp_type in (TIME_EXCEEDED, DESTINATION_UNREACHABLE):
+                # Only raw sockets receive the errors of other sockets,
+                # UDP probes are handled by _read_udp
+                probe = quoted_probe(data[8:])
+                if (probe is not None and probe[0] == socket.IPPROTO_ICMP and
+                        probe[2] == self.identifier):
+                    self._answer((socket.IPPROTO_ICMP, probe[1], probe[3]), address,
+                                 icmp_type == DESTINATION_UNREACHABLE, error=True)
+
+    def _read_udp(self):
+        self._read_errors(self.udp_sock, socket.IPPROTO_UDP)
+        while True:
+            try:
+                # Some destinations answer the probes
+                data, (address, port) = self.udp_sock.recvfrom(4096)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError:
+                # The error of the last ICMP error on the socket
+                continue
+            self._answer((socket.IPPROTO_UDP, address, port), address, True)
+
+    def _read_errors(self, sock, protocol):
+        """ Reads the ICMP errors about the probes of a datagram socket
+        from its error queue """
+        while True:
+            try:
+                data, ancdata, flags, (address, port) = sock.recvmsg(
+                    512, 512, socket.MSG_ERRQUEUE)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                logger.debug('ICMP error queue error {}'.format(e))
+                return
+
+            for level, kind, error in ancdata:
+                # struct sock_extended_err followed by the offender
+                if level != socket.IPPROTO_IP or kind != IP_RECVERR or len(error) < 24:
+                    continue
+                origin, icmp_type = error[4], error[5]
+                if origin != SO_EE_ORIGIN_ICMP:
+                    continue
+                responder = socket.inet_ntoa(error[20:24])
+                if protocol == socket.IPPROTO_ICMP:
+                    # The echo request that caused the error
+                    if len(data) < 8:
+                        continue
+                    port = struct.unpack('!H', data[6:8])[0]
+                self._answer((protocol, address, port), responder,
+                             icmp_type == DESTINATION_UNREACHABLE, error=True)
+
+    async def ping(self, address, count=1, interval=1, preload=1, timeout=1):
+        """ Pings an address like /bin/ping does
+
+        The first preload requests are sent at once, the others every
+        interval seconds. Each request waits timeout seconds for its
+        reply.
+
+        :param address: IPv4 address to ping
+        :return: list of round-trip times in seconds, None for the
+            requests that weren't answered
+        :raises PermissionError: when no ICMP socket can be opened
+        """
+        self.open()
+
+        futures = []
+        for i in range(count):
+            if i >= max(1, preload):
+                await asyncio.sleep(interval)
+            futures.append(self._send(address, timeout))
+
+        return list(await asyncio.gather(*futures))
+
+    async def sweep(self, addresses, count=1, interval=1, timeout=1, rate=1000):
+        """ Pings many addresses like fping does
+
+        Sends count rounds of a single echo request to every address.
+        The requests of a round are interleaved over the addresses and
+        paced to rate requests per second over all addresses, a round
+        starts at least interval seconds after the previous one.
+
+        :param addresses: list of IPv4 addresses to ping
+        :return: dict of address to list of round-trip times in seconds,
+            None for the requests that weren't answered
+        :raises PermissionError: when no ICMP socket can be opened
+        """
+        self.open()
+
+        futures = {address: [] for address in addresses}
+        start = self.loop.time()
+        sent = 0
+        for round_number in range(count):
+            round_start = start + round_number * interval
+            for address in futures:
+                at = max(round_start, start + sent / rate)
+                # Sleep in batches instead of before every request
+                ahead = at - self.loop.time()
+                if ahead > self.resolution:
+                    await asyncio.sleep(ahead)
+                futures[address].append(self._send(address, timeout))
+                sent += 1
+
+        return {address: list(await asyncio.gather(*address_futures))
+                for address, address_futures in futures.items()}
+
+    async def trace(self, address, max_hops=30, timeout=1, udp=False):
+        """ Traces the path to an address like traceroute does
+
+        The probes for all TTLs are sent at once, so a trace takes about
+        a round-trip time plus timeout instead of a timeout per silent
+        hop.
+
+        :param address: IPv4 address to trace
+        :param max_hops: highest TTL to probe
+        :param timeout: seconds to wait for each hop
+        :param udp: send UDP datagrams instead of echo requests
+        :return: list per TTL up to the destination of (hop address,
+            round-trip time in seconds, whether it's the last hop),
+            None for hops that didn't answer
+        :raises PermissionError: when no ICMP socket can be opened
+        """
+        if udp:
+            self.open_udp()
+            sock = self.udp_sock
+        else:
+            self.open()
+            sock = self.sock
+
+        futures = []
+        default_ttl = sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL)
+        try:
+            for ttl in range(1, max_hops + 1):
+                sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, ttl)
+                if udp:
+                    futures.append(self._send_udp(address, timeout))
+                else:
+                    futures.append(self._send(address, timeout, trace=True))
+        finally:
+            # Nothing else is sent in between
+            sock.setsockopt(socket.IPPROTO_IP, socket.IP_TTL, default_ttl)
+
+        # The probes beyond the last hop are left to expire
+        waiting = set(futures)
+        while waiting:
+            done, waiting = await asyncio.wait(waiting,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            hops = [future.result() if future.done() else None for future in futures]
+            last = next((ttl for ttl, hop in enumerate(hops)
+                         if hop is not None and hop[2]), None)
+            if last is not None and all(future.done() for future in futures[:last]):
+                return hops[:last + 1]
+        return hops
+
+
+# Engine shared by all Ping tasks
+icmp = IcmpEngine()
@@ -1,22 +1,119 @@
 #!/usr/bin/env python3
 
+from array import array
 from asyncio import create_subprocess_exec, subprocess
+from collections import OrderedDict
 from poller import Task
+from poller.health import HealthTracker, CircuitOpen
+from poller.icmp import icmp
+from poller.resolver import resolver, ResolveError
+from poller.stats import NAN, RttHistogram, rtt_statistics
 from time import time
 import ipaddress
+import math
+import sys
+
+
+class PathTable:
+    """ Interns the hop sequences of traces
+
+    Every distinct path is stored once and gets an id, a tuple of hop
+    addresses with '*' for the hops that didn't answer. Ids are only
+    valid within the running poller and are never reused. Beyond
+    max_size the least recently used paths are dropped, a trace whose
+    path was dropped reports it again under a new id.
+
+    :param max_size: maximum amount of stored paths
+    """
+
+    def __init__(self, max_size=100000):
+        self.max_size = max_size
+        self._ids = {}
+        self._paths = OrderedDict()
+        self._next_id = 0
+
+    def __len__(self):
+        return len(self._paths)
+
+    def intern(self, path):
+        """ Returns the id of a path, adding it when it's new """
+        path_id = self._ids.get(path)
+        if path_id is not None:
+            self._paths.move_to_end(path_id)
+            return path_id
+
+        path = tuple(sys.intern(address) for address in path)
+        path_id = self._next_id
+        self._next_id += 1
+        self._ids[path] = path_id
+        self._paths[path_id] = path
+        while len(self._paths) > self.max_size:
+            del self._ids[self._paths.popitem(last=False)[1]]
+        return path_id
+
+    def get(self, path_id):
+        """ Returns the path of an id, None when it was dropped """
+        path = self._paths.get(path_id)
+        if path is not None:
+            self._paths.move_to_end(path_id)
+        return path
+
+    @staticmethod
+    def merge(path, other):
+        """ Returns path with the hops that didn't answer filled in from
+        other, None when the paths differ in a hop that answered """
+        if len(path) != len(other):
+            return None
+
+        merged = []
+        for hop, other_hop in zip(path, other):
+            if hop == '*':
+                merged.append(other_hop)
+            elif hop == other_hop or other_hop == '*':
+                merged.append(hop)
+            else:
+                return None
+        return tuple(merged)
 
 
 class Trace(Task):
-    """ Asynchronous class for traceroute probes """
+    """ Asynchronous class for traceroute probes
+
+    The probes for all TTLs are sent at once by the shared IcmpEngine,
+    traceroute is only used when the poller isn't allowed to open an
+    ICMP socket in ICMP mode.
+
+    With changes_only a result only holds the id of the path in the
+    shared PathTable and the round-trip time per hop. The hops are only
+    added when the path differs from the one of the previous run, which
+    is flagged with path_changed.
+    """
+
+    __slots__ = ('device', 'wait_time', 'max_hops', 'icmp', 'changes_only',
+                 '_path_id')
+
+    # Shared with the Ping tasks
+    engine = icmp
+    # Shared by all Trace tasks
+    paths = PathTable()
+
+    result_fields = dict(Task.result_fields, path_id='I')
 
     def __init__(self, device, wait_time=1, max_hops=20, icmp=False,
-                 *args, **kwargs):
-        """ Init Task """
+                 changes_only=False, *args, **kwargs):
+        """ Init Task
+
+        :param changes_only: only return the hops when the path changed
+        """
         super().__init__(*args, **kwargs)
-        self.device = device
-        self.wait_time = str(wait_time)
-        self.max_hops = str(max_hops)
+        self.device = sys.intern(device)
+        self.wait_time = int(wait_time)
+        self.max_hops = int(max_hops)
         self.icmp = icmp
+        self.changes_only = changes_only
+
+        # Path of the previous run
+        self._path_id = None
 
     def to_json(self):
         data = Task.to_json(self)
@@ -24,31 +121,115 @@ class Trace(Task):
         data['wait_time'] = self.wait_time
         data['max_hops'] = self.max_hops
         data['icmp'] = self.icmp
+        data['changes_only'] = self.changes_only
         return data
 
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        task = super().from_json(data)
+        task.device = sys.intern(data['device'])
+        task.wait_time = data.get('wait_time', 1)
+        task.max_hops = data.get('max_hops', 20)
+        task.icmp = data.get('icmp', False)
+        task.changes_only = data.get('changes_only', False)
+        task._path_id = None
+        return task
+
     async def run(self):
-        """ Runs a traceroute using the OS traceroute function """
+        """ Traces the path to the device
+
+        :return {'hops': [{'ip_address': <hop address or '*'>,
+                           'rtt': <round-trip time in ms or '*'>}],
+                 'end_timestamp': <timestamp after the trace>}
+
+        With changes_only:
+
+        :return {'path_id': <id of the path>,
+                 'path_changed': <whether it differs from the last run>,
+                 'rtts': <round-trip time in ms per hop, None for
+                          hops that didn't answer>,
+                 'hops': <list of hop addresses, only on changes>,
+                 'end_timestamp': <timestamp after the trace>}
+        """
 
         result = {'hops': [],
                   'start_timestamp': time()}
 
+        try:
+            address = await resolver.resolve(self.device)
+        except ResolveError as e:
+            result['error'] = str(e)
+            result['end_timestamp'] = time()
+            self.results.append(result)
+            return result
+
+        try:
+            hops = await self.engine.trace(address, max_hops=self.max_hops,
+                                           timeout=self.wait_time,
+                                           udp=not self.icmp)
+        except PermissionError:
+            await self._run_process(address, result)
+        else:
+            for hop in hops:
+                if hop is None:
+                    result['hops'].append({'ip_address': '*',
+                                           'rtt': '*'})
+                else:
+                    # Formatted like traceroute prints it
+                    result['hops'].append({'ip_address': hop[0],
+                                           'rtt': '{:.3f}'.format(hop[1] * 1000)})
+
+        if self.changes_only and 'error' not in result:
+            self.compact(result)
+
+        result['end_timestamp'] = time()
+        self.results.append(result)
+        return result
+
+    def compact(self, result):
+        """ Replaces the hops of a result by the id of their path
+
+        A hop that didn't answer isn't a change of the path. When a hop
+        answers that didn't before, the more complete path is reported
+        under a new id.
+        """
+        hops = result.pop('hops')
+        path = tuple(hop['ip_address'] for hop in hops)
+
+        previous = None if self._path_id is None else self.paths.get(self._path_id)
+        merged = None if previous is None else self.paths.merge(previous, path)
+        if merged is not None and merged == previous:
+            result['path_changed'] = False
+        else:
+            path = merged or path
+            self._path_id = self.paths.intern(path)
+            result['path_changed'] = True
+            result['hops'] = list(path)
+
+        result['path_id'] = self._path_id
+        result['rtts'] = array('d', (NAN if hop['rtt'] in ('*', None) else float(hop['rtt'])
+                                     for hop in hops))
+
+    async def _run_process(self, address, result):
+        """ Runs a traceroute using the OS traceroute function """
+
         if self.icmp:
             trace = await create_subprocess_exec("traceroute",
                                                  "-n",
                                                  "-I",
-                                                 "-w" + self.wait_time,
-                                                 "-m" + self.max_hops,
+                                                 "-w" + str(self.wait_time),
+                                                 "-m" + str(self.max_hops),
                                                  "-q 1",
-                                                 self.device,
+                                                 address,
                                                  stdout=subprocess.PIPE,
                                                  stderr=subprocess.PIPE)
         else:
             trace = await create_subprocess_exec("traceroute",
                                                  "-n",
-                                                 "-w" + self.wait_time,
-                                                 "-m" + self.max_hops,
+                                                 "-w" + str(self.wait_time),
+                                                 "-m" + str(self.max_hops),
                                                  "-q 1",
-                                                 self.device,
+                                                 address,
                                                  stdout=subprocess.PIPE,
                                                  stderr=subprocess.PIPE)
 
@@ -73,9 +254,6 @@ class Trace(Task):
                 result['hops'].append({'ip_address': '*',
                                        'rtt': '*'})
 
-        result['end_timestamp'] = time()
-        self.results.append(result)
-
     def extract_rtt_from_line(self, line):
         """ Fetch the first occurance of the round-trip time of
         a traceroute output """
@@ -99,16 +277,57 @@ class Trace(Task):
 
 
 class Ping(Task):
-    """ Asynchronous class for Ping probes """
+    """ Asynchronous class for Ping probes
 
-    def __init__(self, device, count=9, preload=3, timeout=1,
-                 *args, **kwargs):
-        """ Init task """
+    The echo requests are sent by the IcmpEngine shared by all Ping
+    tasks, /bin/ping is only used when the poller isn't allowed to
+    open an ICMP socket.
+
+    The reply timeout adapts to the round-trip times of the device,
+    with timeout as upper bound. Devices that stop answering are only
+    pinged at the health check interval of the shared HealthTracker
+    until they answer again.
+
+    Every result keeps the round-trip time of each echo request and
+    their percentiles, jitter and loss bursts. With rollup set every
+    rollup runs a result also gets the percentiles over those runs,
+    counted in an RttHistogram instead of keeping their samples.
+    """
+
+    __slots__ = ('device', 'count', 'preload', 'timeout', 'interval',
+                 'rollup', '_histogram', '_runs')
+
+    # Shared by all Ping tasks
+    health = HealthTracker(min_timeout=.5)
+    icmp = icmp
+
+    result_fields = dict(Task.result_fields,
+                         min='d', avg='d', max='d', mdev='d',
+                         p50='d', p95='d', p99='d', jitter='d',
+                         packets_sent='I', packets_recv='I',
+                         loss_bursts='I', max_loss_burst='I')
+
+    def __init__(self, device, count=9, preload=3, timeout=1, interval=1,
+                 rollup=0, *args, **kwargs):
+        """ Init task
+
+        :param device: device to ping
+        :param count: amount of echo requests
+        :param preload: amount of echo requests sent at once
+        :param timeout: seconds to wait for each reply
+        :param interval: seconds between the other echo requests
+        :param rollup: amount of runs to roll up, 0 to disable
+        """
         super().__init__(*args, **kwargs)
-        self.device = device
-        self.count = str(count)
-        self.preload = str(preload)
-        self.timeout = str(timeout)
+        self.device = sys.intern(device)
+        self.count = int(count)
+        self.preload = int(preload)
+        self.timeout = float(timeout)
+        self.interval = float(interval)
+        self.rollup = int(rollup)
+
+        self._histogram = None
+        self._runs = 0
 
     def to_json(self):
         data = Task.to_json(self)
@@ -116,22 +335,123 @@ class Ping(Task):
         data['count'] = self.count
         data['preload'] = self.preload
         data['timeout'] = self.timeout
+        data['interval'] = self.interval
+        data['rollup'] = self.rollup
         return data
 
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        task = super().from_json(data)
+        task.device = sys.intern(data['device'])
+        task.count = data.get('count', 9)
+        task.preload = data.get('preload', 3)
+        task.timeout = data.get('timeout', 1.0)
+        task.interval = data.get('interval', 1.0)
+        task.rollup = data.get('rollup', 0)
+        task._histogram = None
+        task._runs = 0
+        return task
+
     async def run(self):
-        """ Runs a ping using the OS ping function
+        """ Pings the device
 
-        Returns:
-            True: Returns true if the probe was succesful
+        :return {'min': <minimum rtt in ms>,
+                 'avg': <average rtt in ms>,
+                 'max': <maximum rtt in ms>,
+                 'mdev': <standard deviation of the rtt in ms>,
+                 'packets_sent': <amount of echo requests>,
+                 'packets_recv': <amount of replies>,
+                 'rtts': <array of the rtt in ms per echo request,
+                          NaN when lost>,
+                 'p50', 'p95', 'p99': <percentiles of the rtt in ms>,
+                 'jitter': <mean rtt difference of consecutive replies>,
+                 'loss_bursts': <amount of runs of lost requests>,
+                 'max_loss_burst': <longest run of lost requests>,
+                 'rollup': <RttHistogram summary, every rollup runs>,
+                 'end_timestamp': <timestamp after the ping>}
         """
 
         result = {'start_timestamp': time()}
 
+        try:
+            address = await resolver.resolve(self.device)
+            self.health.check(address)
+        except (ResolveError, CircuitOpen) as e:
+            result['error'] = str(e)
+            result['end_timestamp'] = time()
+            self.results.append(result)
+            return result
+
+        timeout = self.health.timeout(address, self.timeout)
+        try:
+            rtts = await self.icmp.ping(address, count=self.count,
+                                        interval=self.interval,
+                                        preload=self.preload,
+                                        timeout=timeout)
+        except PermissionError:
+            # ping only takes whole seconds
+            await self._run_process(address, math.ceil(timeout), result)
+        else:
+            self.summarize(rtts, result)
+
+        if result.get('packets_recv'):
+            self.health.success(address, result['avg'] / 1000)
+        else:
+            self.health.failure(address)
+
+        if self.rollup and 'rtts' in result:
+            self.roll_up(result)
+
+        result['end_timestamp'] = time()
+        self.results.append(result)
+        return result
+
+    def roll_up(self, result):
+        """ Counts the samples of a result, adds the summary of the
+        last rollup runs to it every rollup runs """
+        if self._histogram is None:
+            self._histogram = RttHistogram()
+        self._histogram.add(result['rtts'], result['max_loss_burst'])
+        self._runs += 1
+        if self._runs >= self.rollup:
+            result['rollup'] = dict(self._histogram.summary(), runs=self._runs)
+            self._histogram.reset()
+            self._runs = 0
+
+    @staticmethod
+    def add_samples(rtts, result):
+        """ Adds the round-trip times in ms, None for lost requests, and
+        their statistics to a result """
+        result['rtts'] = array('d', (NAN if rtt is None else rtt for rtt in rtts))
+        result.update(rtt_statistics(result['rtts']))
+
+    @staticmethod
+    def summarize(rtts, result):
+        """ Adds the /bin/ping statistics of the round-trip times in
+        seconds, None for lost requests, to a result """
+        Ping.add_samples([None if rtt is None else rtt * 1000 for rtt in rtts], result)
+        received = [rtt * 1000 for rtt in rtts if rtt is not None]
+        result['packets_sent'] = len(rtts)
+        result['packets_recv'] = len(received)
+        if not received:
+            result['error'] = 'Host unreachable'
+            return
+
+        avg = sum(received) / len(received)
+        result['min'] = min(received)
+        result['avg'] = avg
+        result['max'] = max(received)
+        # Population standard deviation like ping's mdev
+        result['mdev'] = math.sqrt(max(0, sum(rtt * rtt for rtt in received) /
+                                       len(received) - avg * avg))
+
+    async def _run_process(self, address, timeout, result):
+        """ Runs a ping using the OS ping function """
         ping = await create_subprocess_exec("/bin/ping",
-                                            self.device,
-                                            "-c " + self.count,
-                                            "-l " + self.preload,
-                                            "-W " + self.timeout,
+                                            address,
+                                            "-c " + str(self.count),
+                                            "-l " + str(self.preload),
+                                            "-W " + str(timeout),
                                             stdout=subprocess.PIPE,
                                             stderr=subprocess.PIPE)
         stdout = await ping.stdout.read()
@@ -141,23 +461,185 @@ class Ping(Task):
             result['error'] = stderr.decode('utf-8').strip()
         else:
             lines = stdout.splitlines()
+            self.add_samples(self.extract_rtts(lines), result)
             second_last_line = lines[len(lines)-2].decode('utf-8').split()
             last_line = lines[len(lines)-1].decode('utf-8')
             if not last_line:
                 # if the last line is empty
                 # none of the packets arrived
                 result['error'] = 'Host unreachable'
-                result['packets_sent'] = second_last_line[0]
-                result['packets_recv'] = second_last_line[3]
+                result['packets_sent'] = int(second_last_line[0])
+                result['packets_recv'] = int(second_last_line[3])
             else:
                 last_line = last_line.split()[3].split('/')
-                result['min'] = last_line[0]
-                result['avg'] = last_line[1]
-                result['max'] = last_line[2]
-                result['mdev'] = last_line[3]
-                result['packets_sent'] = second_last_line[0]
-                result['packets_recv'] = second_last_line[3]
+                result['min'] = float(last_line[0])
+                result['avg'] = float(last_line[1])
+                result['max'] = float(last_line[2])
+                result['mdev'] = float(last_line[3])
+                result['packets_sent'] = int(second_last_line[0])
+                result['packets_recv'] = int(second_last_line[3])
+
+    def extract_rtts(self, lines):
+        """ Returns the round-trip time in ms per echo request from the
+        reply lines of a ping output, None for lost requests """
+        rtts = [None] * self.count
+        for line in lines:
+            fields = dict(field.split('=', 1) for field in line.decode('utf-8').split()
+                          if '=' in field)
+            try:
+                sequence = int(fields['icmp_seq'])
+                rtt = float(fields['time'])
+            except (KeyError, ValueError):
+                continue
+            if 1 <= sequence <= self.count:
+                rtts[sequence - 1] = rtt
+        return rtts
+
+
+class PingSweep(Task):
+    """ Asynchronous class for pinging many hosts at once, like fping
+
+    Takes a list of hosts, addresses and IPv4 networks in CIDR
+    notation. All echo requests are sent by the shared IcmpEngine,
+    interleaved over the hosts and paced to rate requests per second,
+    so a whole subnet is a single task instead of a Ping task per host.
+    There is no /bin/ping fallback, the sweep fails when the poller
+    isn't allowed to open an ICMP socket.
+    """
+
+    __slots__ = ('targets', 'count', 'timeout', 'interval', 'rate')
+
+    icmp = icmp
+
+    # Upper bound of the hosts of a single sweep, a /16
+    max_hosts = 65536
+
+    result_fields = dict(Task.result_fields,
+                         hosts_total='I', hosts_alive='I',
+                         packets_sent='I', packets_recv='I')
 
+    def __init__(self, targets, count=1, timeout=1, interval=1, rate=1000,
+                 *args, **kwargs):
+        """ Init task
+
+        :param targets: list of hosts, addresses and networks, or a
+            single one of them
+        :param count: amount of echo requests per host
+        :param timeout: seconds to wait for each reply
+        :param interval: minimum seconds between the echo requests to a
+            single host
+        :param rate: maximum echo requests per second over all hosts
+        """
+        super().__init__(*args, **kwargs)
+        if isinstance(targets, str):
+            targets = [targets]
+        self.targets = tuple(sys.intern(target) for target in targets)
+        self.count = int(count)
+        self.timeout = float(timeout)
+        self.interval = float(interval)
+        self.rate = float(rate)
+        if self.rate <= 0:
+            raise ValueError('rate should be positive')
+
+    def to_json(self):
+        data = Task.to_json(self)
+        data['targets'] = list(self.targets)
+        data['count'] = self.count
+        data['timeout'] = self.timeout
+        data['interval'] = self.interval
+        data['rate'] = self.rate
+        return data
+
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        # Validates the rate, sweeps are few
+        return cls(data['targets'],
+                   count=data.get('count', 1),
+                   timeout=data.get('timeout', 1),
+                   interval=data.get('interval', 1),
+                   rate=data.get('rate', 1000),
+                   **cls.json_options(data))
+
+    async def addresses(self):
+        """ Returns the addresses of the targets, networks are expanded
+        to their hosts and duplicates are removed
+
+        :raises ValueError: for IPv6 or too many addresses
+        :raises ResolveError: when a host can't be resolved
+        """
+        addresses = {}
+        for target in self.targets:
+            try:
+                network = ipaddress.ip_network(target, strict=False)
+            except ValueError:
+                addresses[await resolver.resolve(target)] = None
+                continue
+
+            if network.version != 4:
+                raise ValueError('Only IPv4 is supported, not {}'.format(target))
+            # Without the network and broadcast address
+            if len(addresses) + network.num_addresses - 2 > self.max_hosts:
+                raise ValueError('More than {} hosts to sweep'.format(self.max_hosts))
+            for address in network.hosts():
+                addresses[str(address)] = None
+
+        if len(addresses) > self.max_hosts:
+            raise ValueError('More than {} hosts to sweep'.format(self.max_hosts))
+        return list(addresses)
+
+    async def run(self):
+        """ Pings all hosts
+
+        Hosts that didn't answer are left out of the result, they are
+        the targets missing from hosts.
+
+        :return {'hosts': {<address>: [<packets_recv>, <min rtt in ms>,
+                                       <avg rtt in ms>, <max rtt in ms>]},
+                 'hosts_total': <amount of pinged hosts>,
+                 'hosts_alive': <amount of hosts that answered>,
+                 'packets_sent': <amount of echo requests>,
+                 'packets_recv': <amount of replies>,
+                 'end_timestamp': <timestamp after the sweep>}
+        """
+
+        result = {'start_timestamp': time()}
+
+        try:
+            addresses = await self.addresses()
+            rtts = await self.icmp.sweep(addresses, count=self.count,
+                                         interval=self.interval,
+                                         timeout=self.timeout, rate=self.rate)
+        except (ValueError, ResolveError, PermissionError) as e:
+            result['error'] = str(e)
+            result['end_timestamp'] = time()
+            self.results.append(result)
+            return result
+
+        self.summarize(rtts, result)
         result['end_timestamp'] = time()
         self.results.append(result)
         return result
+
+    @staticmethod
+    def summarize(rtts, result):
+        """ Adds the per-host statistics of a dict of address to
+        round-trip times in seconds, None for lost requests, to a
+        result """
+        hosts = {}
+        sent = received = 0
+        for address, address_rtts in rtts.items():
+            sent += len(address_rtts)
+            answered = [rtt * 1000 for rtt in address_rtts if rtt is not None]
+            if not answered:
+                continue
+            received += len(answered)
+            hosts[address] = [len(answered),
+                              round(min(answered), 3),
+                              round(sum(answered) / len(answered), 3),
+                              round(max(answered), 3)]
+
+        result['hosts'] = hosts
+        result['hosts_total'] = len(rtts)
+        result['hosts_alive'] = len(hosts)
+        result['packets_sent'] = sent
+        result['packets_recv'] = received
@@ -0,0 +1,191 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left
+from collections import OrderedDict
+import logging
+logger = logging.getLogger(__name__)
+
+# Default histogram buckets in seconds
+DEFAULT_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5, 10, 30, 60)
+
+
+def _format_labels(pairs):
+    """ Formats (name, value) label pairs as {name="value",...} """
+    if not pairs:
+        return ''
+
+    formatted = []
+    for name, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        formatted.append('{}="{}"'.format(name, value))
+    return '{' + ','.join(formatted) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Counter:
+    """ Monotonically increasing counter
+
+    :param name: metric name
+    :param description: help text of the metric
+    :param labelnames: tuple of label names
+    """
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labelnames=()):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+
+    def inc(self, *labelvalues, amount=1):
+        self.values[labelvalues] = self.values.get(labelvalues, 0) + amount
+
+    def samples(self):
+        for labelvalues, value in sorted(self.values.items()):
+            yield self.name, list(zip(self.labelnames, labelvalues)), value
+
+
+class Gauge:
+    """ Value that is read from a callable when the metrics are rendered
+
+    :param name: metric name
+    :param description: help text of the metric
+    :param function: callable returning the current value
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, function):
+        self.name = name
+        self.description = description
+        self.function = function
+
+    def samples(self):
+        yield self.name, [], self.function()
+
+
+class CallbackCounter(Gauge):
+    """ Counter that is read from a callable when the metrics are rendered
+
+    For counters that are kept by another object.
+    """
+
+    kind = 'counter'
+
+
+class Histogram:
+    """ Counts observations in cumulative buckets
+
+    :param name: metric name
+    :param description: help text of the metric
+    :param labelnames: tuple of label names
+    :param buckets: sorted tuple of bucket upper bounds
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labelnames=(),
+                 buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        # labelvalues -> [bucket counts, sum]
+        self.values = {}
+
+    def observe(self, value, *labelvalues):
+        entry = self.values.get(labelvalues)
+        if entry is None:
+            entry = self.values[labelvalues] = [[0] * len(self.buckets), 0.0]
+
+        entry[0][bisect_left(self.buckets, value)] += 1
+        entry[1] += value
+
+    def samples(self):
+        for labelvalues, (counts, total) in sorted(self.values.items()):
+            labels = list(zip(self.labelnames, labelvalues))
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield (self.name + '_bucket',
+                       labels + [('le', _format_value(bound))],
+                       cumulative)
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, cumulative
+
+
+class Metrics:
+    """ Registry of metrics rendered in the Prometheus text format
+
+    :param labels: dict of labels added to every sample
+    """
+
+    content_type = 'text/plain'
+
+    def __init__(self, labels=None):
+        self.metrics = []
+        self.labels = labels or {}
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, labelnames=()):
+        return self.register(Counter(name, description, labelnames))
+
+    def gauge(self, name, description, function):
+        return self.register(Gauge(name, description, function))
+
+    def callback_counter(self, name, description, function):
+        return self.register(CallbackCounter(name, description, function))
+
+    def histogram(self, name, description, labelnames=(),
+                  buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, description, labelnames, buckets))
+
+    def render(self):
+        """ Returns all metrics in the text exposition format """
+        const_labels = sorted(self.labels.items())
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.kind))
+            for name, labels, value in metric.samples():
+                lines.append('{}{} {}'.format(name,
+                                              _format_labels(const_labels + labels),
+                                              _format_value(value)))
+        return '\n'.join(lines) + '\n'
+
+
+def merge_metrics(texts):
+    """ Merges rendered metrics of several registries
+
+    Samples of the same metric are grouped under a single HELP and
+    TYPE line, the registries should use distinct constant labels.
+    """
+    families = OrderedDict()
+    for text in texts:
+        family = None
+        for line in text.splitlines():
+            if line.startswith('# HELP '):
+                name = line.split()[2]
+                family = families.setdefault(name, [line, None, []])
+            elif line.startswith('# TYPE '):
+                family[1] = line
+            elif line and family is not None:
+                family[2].append(line)
+
+    lines = []
+    for help_line, type_line, samples in families.values():
+        lines.append(help_line)
+        if type_line:
+            lines.append(type_line)
+        lines.extend(samples)
+    return '\n'.join(lines) + '\n'
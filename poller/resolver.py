@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+
+import asyncio
+import ipaddress
+import logging
+import socket
+from .utils import LruCache
+logger = logging.getLogger(__name__)
+
+
+class ResolveError(Exception):
+    """ Raised when a device name can't be resolved """
+    pass
+
+
+class Resolver:
+    """ Asynchronous DNS resolver with a cache shared by all tasks
+
+    Lookups run through the event loop's getaddrinfo so they don't
+    block the loop. Resolved addresses are cached for ttl seconds and
+    failed lookups for negative_ttl seconds. Concurrent lookups for
+    the same name share a single getaddrinfo call.
+
+    :param ttl: seconds to cache a resolved address
+    :param negative_ttl: seconds to cache a failed lookup
+    :param max_size: maximum amount of cached names
+    :param family: address family to resolve to
+    """
+
+    def __init__(self, ttl=300, negative_ttl=30, max_size=10000,
+                 family=socket.AF_INET):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.family = family
+        self._cache = LruCache(max_size=max_size, ttl=ttl)
+        self._pending = {}
+        self.negative_hits = 0
+
+    @property
+    def hits(self):
+        return self._cache.hits
+
+    @property
+    def misses(self):
+        return self._cache.misses
+
+    @staticmethod
+    def _is_address(host):
+        try:
+            ipaddress.ip_address(host)
+            return True
+        except ValueError:
+            return False
+
+    async def resolve(self, host):
+        """ Returns the address of a host name
+
+        :raises ResolveError: when the name can't be resolved
+        """
+        if self._is_address(host):
+            return host
+
+        cached = self._cache.get(host)
+        if isinstance(cached, ResolveError):
+            self.negative_hits += 1
+            raise cached
+        elif cached is not None:
+            return cached
+
+        future = self._pending.get(host)
+        if future is None:
+            future = asyncio.ensure_future(self._lookup(host))
+            self._pending[host] = future
+            future.add_done_callback(lambda f: self._pending.pop(host, None))
+
+        # Shielded so a cancelled task doesn't cancel the shared lookup
+        return await asyncio.shield(future)
+
+    async def _lookup(self, host):
+        loop = asyncio.get_event_loop()
+        try:
+            addresses = await loop.getaddrinfo(host, None, family=self.family,
+                                               type=socket.SOCK_DGRAM)
+        except (socket.gaierror, UnicodeError) as e:
+            error = ResolveError('Unable to resolve {}: {}'.format(host, e))
+            self._cache.set(host, error, ttl=self.negative_ttl)
+            raise error
+
+        address = addresses[0][4][0]
+        logger.debug('Resolved {} to {}'.format(host, address))
+        self._cache.set(host, address)
+        return address
+
+    def invalidate(self, host):
+        """ Drops the cached address of a host
+
+        :return: the address the host resolved to, the host itself when
+            it's an address, None when it wasn't cached
+        """
+        if self._is_address(host):
+            return host
+        address = self._cache.pop(host)
+        return None if isinstance(address, ResolveError) else address
+
+
+# Resolver shared by all tasks of the poller
+resolver = Resolver()
@@ -6,31 +6,21 @@ import logging
 logger = logging.getLogger(__name__)
 
 # Import tasks
-from .snmp_tasks import InterfaceOctetsProbe, SystemInfoProbe
+from .snmp_tasks import InterfaceOctetsProbe, InterfaceTableProbe, SystemInfoProbe
 #from .ssh_tasks import SshRunSingleCommand
 from .http_tasks import GetPage
-from .ip_tasks import Ping, Trace
-
-
-def queue_peek(queue):
-    """ Peeks inside a (asyncio) Queue and returns a list
-    of items. This is non-blocking and will not remove
-    any items from the queue
-    """
-    # TODO: It only works on queue's with maxsize=0
-
-    queue_list = []
-    while not queue.empty():
-        queue_list.append(queue.get_nowait())
-
-    for item in queue_list:
-        queue.put_nowait(item)
-
-    return queue_list
+from .ip_tasks import Ping, PingSweep, Trace
 
 
 class RestApi:
 
+    # Task types that can be created through the API,
+    # SshRunSingleCommand is disabled
+    task_types = {task_type.__name__: task_type
+                  for task_type in (InterfaceOctetsProbe, InterfaceTableProbe,
+                                    SystemInfoProbe, GetPage, Trace, Ping,
+                                    PingSweep)}
+
     def __init__(self, task_manager, ip='0.0.0.0', port='8080',
                  snmp_engine=None, ssh_user=None, ssh_pass=None, loop=None):
         """ Initialise Rest API
@@ -57,59 +47,31 @@ class RestApi:
         self.add_routes()
 
     def json_to_task(self, task):
-        """ Converts a received json object to a Task """
-
-        logger.debug('Parsing received task {}'.format(task))
-        if task['type'] == 'InterfaceOctetsProbe':
-            return InterfaceOctetsProbe(task['device'],
-                                        task['if_index'],
-                                        self.snmp_engine,
-                                        _id=task['_id'],
-                                        run_at=task['run_at'],
-                                        recurrence_count=task.get('recurrence_count', None),
-                                        recurrence_time=task.get('recurrence_time', None))
-        elif task['type'] == 'SystemInfoProbe':
-            return SystemInfoProbe(task['device'],
-                                   self.snmp_engine,
-                                   _id=task['_id'],
-                                   run_at=task['run_at'],
-                                   recurrence_count=task.get('recurrence_count', None),
-                                   recurrence_time=task.get('recurrence_time', None))
-        #elif task['type'] == 'SshRunSingleCommand':
-        #    return SshRunSingleCommand(task['device'],
-         #                              task['cmd'],
-          #                             username=task.get('ssh_user', self.ssh_user),
-           #                            password=task.get('ssh_pass', self.ssh_pass),
-            #                           _id=task['_id'],
-             #                          run_at=task['run_at'],
-              #                         recurrence_count=task.get('recurrence_count', None),
-               #                        recurrence_time=task.get('recurrence_time', None))
-        elif task['type'] == 'GetPage':
-            return GetPage(task['url'],
-                           _id=task['_id'],
-                           run_at=task['run_at'],
-                           recurrence_count=task.get('recurrence_count', None),
-                           recurrence_time=task.get('recurrence_time', None))
-        elif task['type'] == 'Trace':
-            return Trace(task['device'],
-                         wait_time=task.get('wait_time', 1),
-                         max_hops=task.get('max_hops', 20),
-                         icmp=task.get('icmp', False),
-                         _id=task['_id'],
-                         run_at=task['run_at'],
-                         recurrence_count=task.get('recurrence_count', None),
-                         recurrence_time=task.get('recurrence_time', None))
-        elif task['type'] == 'Ping':
-            return Ping(task['device'],
-                        count=task.get('count', 9),
-                        preload=task.get('preload', 3),
-                        timeout=task.get('timeout', 1),
-                        _id=task['_id'],
-                        run_at=task['run_at'],
-                        recurrence_count=task.get('recurrence_count', None),
-                        recurrence_time=task.get('recurrence_time', None))
-        else:
+        """ Converts a received json object to a Task, None for unknown
+        task types
+
+        The task is built through __init__, which checks and converts
+        its options. The SNMP tasks get the snmp_engine, the other task
+        types ignore it.
+
+        :raises TypeError, ValueError: on missing or invalid options
+        """
+        task_type = self.task_types.get(task['type'])
+        if task_type is None:
+            return None
+        return task_type(**dict(task, snmp=self.snmp_engine))
+
+    def restore_task(self, task):
+        """ Converts a stored json object to a Task, None for unknown
+        task types
+
+        Stored tasks already went through json_to_task, so they skip
+        its checks, see Task.from_json.
+        """
+        task_type = self.task_types.get(task['type'])
+        if task_type is None:
             return None
+        return task_type.from_json(task, snmp=self.snmp_engine)
 
     def start(self):
         web.run_app(self.app, host=self.ip, port=self.port)
@@ -126,16 +88,19 @@ class RestApi:
         self.app.router.add_route('DELETE', '/tasks', self.delete_task)
         logger.debug('Adding route GET /tasks/{task_id}')
         self.app.router.add_route('GET', '/tasks/{task_id}', self.get_task)
+        logger.debug('Adding route GET /run_queue')
+        self.app.router.add_route('GET', '/run_queue', self.get_run_queue)
+        logger.debug('Adding route GET /metrics')
+        self.app.router.add_route('GET', '/metrics', self.get_metrics)
 
     async def get_task(self, request):
         """ Returns a single given task """
 
         task_id = request.match_info['task_id']
 
-        tasks = queue_peek(self.task_manager.task_queue)
-        for task in tasks:
-            if str(task._id) == str(task_id):
-                return web.json_response(task.to_json())
+        task = self.task_manager.get(task_id)
+        if task:
+            return web.json_response(task.to_json())
 
         return web.json_response({'error': 'Task {} not found'
                                            .format(task_id)})
@@ -150,23 +115,18 @@ class RestApi:
 
         logger.debug('Parsing received task {}'.format(data))
 
-        if data['type'] == 'InterfaceOctetsProbe':
-            task = InterfaceOctetsProbe(**data)
-        elif data['type'] == 'SystemInfoProbe':
-            task = SystemInfoProbe(**data)
-        elif data['type'] == 'SshRunSingleCommand':
-            task = SshRunSingleCommand(**data)
-        elif data['type'] == 'GetPage':
-            task = GetPage(**data)
-        elif data['type'] == 'Trace':
-            task = Trace(**data)
-        elif data['type'] == 'Ping':
-            task = Ping(**data)
-        else:
+        try:
+            task = self.json_to_task(data)
+        except (TypeError, ValueError) as e:
+            return web.json_response({'error': str(e)}, status=400)
+        if task is None:
             return web.json_response({'error': 'task type not found'}, status=501)
 
         logger.info('Adding {} to task_manager'.format(task))
-        self.task_manager.add(task)
+        try:
+            self.task_manager.add(task)
+        except ValueError as e:
+            return web.json_response({'error': str(e)}, status=409)
 
         # TODO: Fix the result fetching for a task
         if 'run_instant' in data and data['run_instant']:
@@ -183,7 +143,7 @@ class RestApi:
     async def get_tasks(self, request):
         """ Returns all current scheduled tasks """
 
-        tasks = queue_peek(self.task_manager.task_queue)
+        tasks = self.task_manager.tasks()
         json_tasks = []
         for task in tasks:
             json_tasks.append(task.to_json())
@@ -206,9 +166,19 @@ class RestApi:
 
         results = []
 
-        tasks = queue_peek(self.task_manager.task_queue)
+        tasks = self.task_manager.tasks()
         for task in tasks:
-            results.append({task._id: task.results})
+            results.append({task._id: task.results.to_json()})
 
         # response = queue_peek(self.task_manager.result_queue)
         return web.json_response(results)
+
+    async def get_run_queue(self, request):
+        """ Returns the running and waiting tasks for each concurrency limit """
+        return web.json_response(self.task_manager.limiter.run_queue_depth())
+
+    async def get_metrics(self, request):
+        """ Returns the task manager metrics in the Prometheus text format """
+        metrics = self.task_manager.metrics
+        return web.Response(text=metrics.render(),
+                            content_type=metrics.content_type)
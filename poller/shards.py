@@ -0,0 +1,194 @@
+#!/usr/bin/env python3
+
+from aiohttp import web
+import aiohttp
+import asyncio
+import json
+import logging
+from urllib.parse import urlparse
+import zlib
+from .metrics import merge_metrics
+from .rest_api import RestApi
+from .snmp_tasks import Snmp, SnmpDispatcher
+from .task_manager import TaskManager
+from .task_store import TaskStore
+logger = logging.getLogger(__name__)
+
+
+def shard_for(task, shards):
+    """ Returns the shard that owns a task based on its device
+
+    Tasks without a device (GetPage) are sharded on their url host so
+    all tasks towards the same target end up in the same worker, tasks
+    without either on their _id.
+
+    :param task: task dict as received on POST /tasks
+    :param shards: amount of shards
+    """
+    key = task.get('device')
+    if not key and task.get('url'):
+        key = urlparse(task['url']).hostname
+    if not key:
+        key = task.get('_id')
+    return zlib.crc32(str(key).encode('utf-8')) % shards
+
+
+def run_worker(shard, host, port, snmp_community, ssh_user, ssh_pass,
+               store_path=None, task_manager_options=None, snmp_options=None):
+    """ Runs a single poller shard in its own event loop
+
+    This is the target of the worker processes started by run_poller.py,
+    each worker runs its own TaskManager and RestApi.
+
+    :param shard: number of this shard
+    :param host: ip address the shard RestApi listens on
+    :param port: port the shard RestApi listens on
+    :param store_path: path of the TaskStore of this shard, None to
+        not persist the tasks
+    :param task_manager_options: dict of extra TaskManager arguments
+    :param snmp_options: dict of extra Snmp arguments
+    """
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+
+    store = TaskStore(store_path) if store_path else None
+    task_manager = TaskManager(loop=loop, store=store,
+                               **(task_manager_options or {}))
+    task_manager.metrics.labels['shard'] = str(shard)
+    snmp_engine = SnmpDispatcher(Snmp(community=snmp_community,
+                                      **(snmp_options or {})))
+
+    asyncio.ensure_future(task_manager.process_tasks())
+    asyncio.ensure_future(task_manager.monitor_loop())
+
+    logger.info('Starting shard {} on {}:{}'.format(shard, host, port))
+    rest_api = RestApi(task_manager,
+                       ip=host, port=str(port),
+                       snmp_engine=snmp_engine,
+                       ssh_user=ssh_user, ssh_pass=ssh_pass,
+                       loop=loop)
+    if store:
+        task_manager.restore(rest_api.restore_task)
+    rest_api.start()
+
+
+class ShardRouter:
+    """ Front RESTful API routing requests to the poller shards
+
+    Tasks are partitioned over the shards by device, see shard_for, so
+    the per device limits and SNMP coalescing of a worker see all tasks
+    of a device. The owner of a task id isn't known to the router, so
+    all other requests are sent to every shard and merged.
+
+    :param shards: list of (ip, port) tuples of the shard RestApis
+    :param ip: ip address to listen on
+    :param port: port to listen on
+    """
+
+    def __init__(self, shards, ip='0.0.0.0', port='8080', loop=None):
+        self.shards = shards
+        self.ip = ip
+        self.port = port
+        self.loop = loop or asyncio.get_event_loop()
+        self.session = None
+
+        self.app = web.Application(loop=self.loop)
+        self.add_routes()
+
+    def start(self):
+        web.run_app(self.app, host=self.ip, port=self.port)
+
+    def add_routes(self):
+        """ Registers all the routes """
+        self.app.router.add_route('GET', '/results', self.get_results)
+        self.app.router.add_route('GET', '/tasks', self.get_tasks)
+        self.app.router.add_route('POST', '/tasks', self.post_tasks)
+        self.app.router.add_route('DELETE', '/tasks', self.delete_task)
+        self.app.router.add_route('GET', '/tasks/{task_id}', self.get_task)
+        self.app.router.add_route('GET', '/run_queue', self.get_run_queue)
+        self.app.router.add_route('GET', '/metrics', self.get_metrics)
+
+    async def _request(self, shard, method, path, data=None):
+        """ Sends a request to a shard
+
+        :return: tuple of (status, body, content type)
+        """
+        if self.session is None:
+            self.session = aiohttp.ClientSession()
+
+        url = 'http://{}:{}{}'.format(self.shards[shard][0],
+                                      self.shards[shard][1], path)
+        kwargs = {}
+        if data is not None:
+            kwargs['data'] = json.dumps(data)
+            kwargs['headers'] = {'content-type': 'application/json'}
+
+        async with self.session.request(method, url, **kwargs) as response:
+            body = await response.read()
+            return response.status, body, response.content_type
+
+    async def _request_all(self, method, path, data=None):
+        """ Sends a request to all shards at once """
+        return await asyncio.gather(*[self._request(shard, method, path, data)
+                                      for shard in range(len(self.shards))])
+
+    async def _forward(self, shard, method, path, data=None):
+        status, body, content_type = await self._request(shard, method, path, data)
+        return web.Response(body=body, status=status, content_type=content_type)
+
+    async def post_tasks(self, request):
+        """ Schedules the task on the shard owning its device """
+        data = await request.json()
+        shard = shard_for(data, len(self.shards))
+        return await self._forward(shard, 'POST', '/tasks', data)
+
+    async def delete_task(self, request):
+        """ Deletes the task from the shard that has it """
+        data = await request.json()
+        if 'task_id' not in data:
+            return web.json_response({'error': 'Expecting {"task_id": "id"}'},
+                                     status=400)
+
+        await self._request_all('DELETE', '/tasks', data)
+        return web.Response(status=204)
+
+    async def get_task(self, request):
+        """ Returns a single task from the shard that has it """
+        task_id = request.match_info['task_id']
+        path = '/tasks/{}'.format(task_id)
+
+        for status, body, content_type in await self._request_all('GET', path):
+            task = json.loads(body.decode('utf-8'))
+            if 'error' not in task:
+                return web.json_response(task)
+
+        return web.json_response({'error': 'Task {} not found'
+                                           .format(task_id)})
+
+    async def get_tasks(self, request):
+        """ Returns the scheduled tasks of all shards """
+        tasks = []
+        for status, body, content_type in await self._request_all('GET', '/tasks'):
+            tasks.extend(json.loads(body.decode('utf-8')))
+        return web.json_response(tasks)
+
+    async def get_results(self, request):
+        """ Returns the results of all shards """
+        results = []
+        for status, body, content_type in await self._request_all('GET', '/results'):
+            results.extend(json.loads(body.decode('utf-8')))
+        return web.json_response(results)
+
+    async def get_run_queue(self, request):
+        """ Returns the run queue depth of each shard """
+        responses = await self._request_all('GET', '/run_queue')
+        return web.json_response({str(shard): json.loads(body.decode('utf-8'))
+                                  for shard, (status, body, content_type)
+                                  in enumerate(responses)})
+
+    async def get_metrics(self, request):
+        """ Returns the metrics of all shards labeled by shard """
+        responses = await self._request_all('GET', '/metrics')
+        text = merge_metrics(body.decode('utf-8')
+                             for status, body, content_type in responses)
+        return web.Response(text=text, content_type='text/plain')
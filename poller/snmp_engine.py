@@ -0,0 +1,426 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import logging
+from .utils import TimerWheel
+logger = logging.getLogger(__name__)
+
+# BER tags
+INTEGER = 0x02
+OCTET_STRING = 0x04
+NULL = 0x05
+OBJECT_IDENTIFIER = 0x06
+SEQUENCE = 0x30
+IP_ADDRESS = 0x40
+COUNTER32 = 0x41
+GAUGE32 = 0x42
+TIME_TICKS = 0x43
+OPAQUE = 0x44
+COUNTER64 = 0x46
+NO_SUCH_OBJECT = 0x80
+NO_SUCH_INSTANCE = 0x81
+END_OF_MIB_VIEW = 0x82
+
+# PDU tags
+GET_REQUEST = 0xa0
+GET_NEXT_REQUEST = 0xa1
+RESPONSE = 0xa2
+GET_BULK_REQUEST = 0xa5
+
+SNMP_V2C = 1
+
+UNSIGNED_TAGS = (COUNTER32, GAUGE32, TIME_TICKS, COUNTER64)
+
+ERROR_STATUS = ('noError', 'tooBig', 'noSuchName', 'badValue', 'readOnly',
+                'genErr', 'noAccess', 'wrongType', 'wrongLength',
+                'wrongEncoding', 'wrongValue', 'noCreation',
+                'inconsistentValue', 'resourceUnavailable', 'commitFailed',
+                'undoFailed', 'authorizationError', 'notWritable',
+                'inconsistentName')
+
+
+class BerError(ValueError):
+    """ Raised when a message can't be encoded or decoded
+
+    :param request_id: request id of the message when it was decoded
+        before the error
+    """
+
+    def __init__(self, message, request_id=None):
+        super().__init__(message)
+        self.request_id = request_id
+
+
+# Same text as the pysnmp timeout
+TIMEOUT_ERROR = 'No SNMP response received before timeout'
+
+
+class SnmpTimeout(Exception):
+    """ Raised when a device doesn't answer in time """
+
+    def __str__(self):
+        return TIMEOUT_ERROR
+
+
+class Oid(tuple):
+    """ OID value of a varbind, a tuple of ints rendered as a dotted
+    string when the results are serialized """
+
+    __slots__ = ()
+
+    def __str__(self):
+        return '.'.join(str(arc) for arc in self)
+
+    def to_json(self):
+        return str(self)
+
+
+class Exceptional:
+    """ Value of a varbind without a value, like endOfMibView """
+
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __repr__(self):
+        return self.name
+
+
+noSuchObject = Exceptional('noSuchObject')
+noSuchInstance = Exceptional('noSuchInstance')
+endOfMibView = Exceptional('endOfMibView')
+
+EXCEPTIONAL_TAGS = {NO_SUCH_OBJECT: noSuchObject,
+                    NO_SUCH_INSTANCE: noSuchInstance,
+                    END_OF_MIB_VIEW: endOfMibView}
+
+
+def encode_length(length):
+    if length < 0x80:
+        return bytes((length,))
+    encoded = length.to_bytes((length.bit_length() + 7) // 8, 'big')
+    return bytes((0x80 | len(encoded),)) + encoded
+
+
+def encode_tlv(tag, value):
+    return bytes((tag,)) + encode_length(len(value)) + value
+
+
+def encode_integer(value, tag=INTEGER):
+    return encode_tlv(tag, value.to_bytes(value.bit_length() // 8 + 1, 'big',
+                                          signed=True))
+
+
+def encode_oid(oid):
+    """ Encodes an OID tuple """
+    if len(oid) < 2:
+        raise BerError('OID {} is too short'.format(oid))
+
+    encoded = bytearray()
+    for arc in (oid[0] * 40 + oid[1],) + tuple(oid[2:]):
+        chunk = [arc & 0x7f]
+        arc >>= 7
+        while arc:
+            chunk.append(0x80 | (arc & 0x7f))
+            arc >>= 7
+        encoded.extend(reversed(chunk))
+    return encode_tlv(OBJECT_IDENTIFIER, bytes(encoded))
+
+
+def encode_value(tag, value):
+    """ Encodes a varbind value, used by the stand-in agent of the
+    benchmark and the tests """
+    if value is None:
+        return encode_tlv(NULL, b'')
+    elif isinstance(value, Exceptional):
+        tag = next(tag for tag, exceptional in EXCEPTIONAL_TAGS.items()
+                   if exceptional is value)
+        return encode_tlv(tag, b'')
+    elif tag == OBJECT_IDENTIFIER:
+        return encode_oid(value)
+    elif tag == IP_ADDRESS:
+        return encode_tlv(tag, bytes(int(part) for part in value.split('.')))
+    elif tag in (OCTET_STRING, OPAQUE):
+        return encode_tlv(tag, value)
+    elif tag in UNSIGNED_TAGS:
+        return encode_tlv(tag, value.to_bytes(value.bit_length() // 8 + 1, 'big'))
+    else:
+        return encode_integer(value, tag)
+
+
+def encode_message(community, pdu_tag, request_id, field1, field2, varbinds):
+    """ Encodes an SNMPv2c message
+
+    :param field1: error status, or non repeaters of a GET BULK
+    :param field2: error index, or max repetitions of a GET BULK
+    :param varbinds: list of (OID tuple, encoded value)
+    """
+    encoded_varbinds = b''.join(encode_tlv(SEQUENCE, encode_oid(oid) + value)
+                                for oid, value in varbinds)
+    pdu = encode_tlv(pdu_tag,
+                     encode_integer(request_id) +
+                     encode_integer(field1) +
+                     encode_integer(field2) +
+                     encode_tlv(SEQUENCE, encoded_varbinds))
+    return encode_tlv(SEQUENCE,
+                      encode_integer(SNMP_V2C) +
+                      encode_tlv(OCTET_STRING, community) +
+                      pdu)
+
+
+NULL_VALUE = encode_tlv(NULL, b'')
+
+
+def decode_tlv(data, position):
+    """ Returns the (tag, value start, value end) of the TLV at position """
+    try:
+        tag = data[position]
+        length = data[position + 1]
+        position += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(data[position:position + size], 'big')
+            position += size
+    except IndexError:
+        raise BerError('Truncated message')
+
+    end = position + length
+    if end > len(data):
+        raise BerError('Truncated message')
+    return tag, position, end
+
+
+def decode_oid(data):
+    """ Decodes the contents of an OID to a tuple """
+    arcs = []
+    arc = 0
+    for byte in data:
+        arc = (arc << 7) | (byte & 0x7f)
+        if not byte & 0x80:
+            arcs.append(arc)
+            arc = 0
+    if not arcs:
+        raise BerError('Empty OID')
+
+    first = arcs[0]
+    if first < 80:
+        return (first // 40, first % 40) + tuple(arcs[1:])
+    return (2, first - 80) + tuple(arcs[1:])
+
+
+def decode_value(tag, data):
+    """ Decodes the contents of a varbind value to a Python value
+
+    Integers, counters, gauges and time ticks decode to int, strings
+    and opaque values to bytes, OIDs to Oid and IP addresses to a
+    dotted string.
+    """
+    if tag == INTEGER:
+        return int.from_bytes(data, 'big', signed=True)
+    elif tag in UNSIGNED_TAGS:
+        return int.from_bytes(data, 'big')
+    elif tag in (OCTET_STRING, OPAQUE):
+        return bytes(data)
+    elif tag == OBJECT_IDENTIFIER:
+        return Oid(decode_oid(data))
+    elif tag == IP_ADDRESS:
+        return '.'.join(str(byte) for byte in data)
+    elif tag == NULL:
+        return None
+    elif tag in EXCEPTIONAL_TAGS:
+        return EXCEPTIONAL_TAGS[tag]
+    raise BerError('Unsupported value type 0x{:02x}'.format(tag))
+
+
+def decode_message(data):
+    """ Decodes an SNMPv2c message
+
+    :return (community, pdu tag, request id, field1, field2, varbinds)
+            where varbinds holds (OID tuple, value tag, value)
+    """
+    data = memoryview(data)
+    tag, start, end = decode_tlv(data, 0)
+    if tag != SEQUENCE:
+        raise BerError('Message is not a sequence')
+
+    tag, start, position = decode_tlv(data, start)
+    if tag != INTEGER or int.from_bytes(data[start:position], 'big') != SNMP_V2C:
+        raise BerError('Not an SNMPv2c message')
+
+    tag, start, position = decode_tlv(data, position)
+    community = bytes(data[start:position])
+
+    pdu_tag, position, end = decode_tlv(data, position)
+    fields = []
+    for i in range(3):
+        tag, start, position = decode_tlv(data, position)
+        fields.append(int.from_bytes(data[start:position], 'big', signed=True))
+
+    varbinds = []
+    try:
+        tag, position, end = decode_tlv(data, position)
+        while position < end:
+            tag, start, position = decode_tlv(data, position)
+            tag, oid_start, oid_end = decode_tlv(data, start)
+            oid = decode_oid(data[oid_start:oid_end])
+            tag, value_start, value_end = decode_tlv(data, oid_end)
+            varbinds.append((oid, tag, decode_value(tag, data[value_start:value_end])))
+    except BerError as e:
+        # The request id is known, so the request can fail right away
+        raise BerError(str(e), request_id=fields[0])
+
+    return (community, pdu_tag) + tuple(fields) + (varbinds,)
+
+
+class _Request:
+
+    __slots__ = ('message', 'address', 'future', 'retries', 'timeout', 'slot')
+
+    def __init__(self, message, address, future, retries, timeout):
+        self.message = message
+        self.address = address
+        self.future = future
+        self.retries = retries
+        self.timeout = timeout
+        self.slot = None
+
+
+class SnmpClient(asyncio.DatagramProtocol):
+    """ Minimal SNMPv2c GET and GET BULK client on a single UDP socket
+
+    All requests share one socket, responses are matched to their
+    request by request id and source address. Only the value types of
+    SNMPv2-SMI are decoded, messages it can't decode raise BerError so
+    the caller can fall back to pysnmp.
+
+    :param resolution: seconds per tick of the timeout wheel
+    """
+
+    def __init__(self, resolution=.05, loop=None):
+        self.loop = loop or asyncio.get_event_loop()
+        self.transport = None
+        self._opening = None
+        self._request_ids = itertools.count(1)
+        self._requests = {}
+        self._timeouts = TimerWheel(self._expire, resolution=resolution,
+                                    loop=self.loop)
+
+        self.sent = 0
+        self.received = 0
+        self.timeouts = 0
+
+    async def _open(self):
+        if self.transport is None:
+            if self._opening is None:
+                self._opening = asyncio.ensure_future(
+                    self.loop.create_datagram_endpoint(lambda: self,
+                                                       local_addr=('0.0.0.0', 0)))
+            await self._opening
+        return self.transport
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.transport = None
+        self._opening = None
+
+    def close(self):
+        self._timeouts.close()
+        if self.transport is not None:
+            self.transport.close()
+        for request in self._requests.values():
+            if not request.future.done():
+                request.future.cancel()
+        self._requests.clear()
+
+    def _next_request_id(self):
+        request_id = next(self._request_ids)
+        if request_id >= 2 ** 31:
+            self._request_ids = itertools.count(1)
+            request_id = next(self._request_ids)
+        return request_id
+
+    async def _request(self, address, community, pdu_tag, field1, field2,
+                       oids, timeout, retries):
+        transport = await self._open()
+
+        request_id = self._next_request_id()
+        message = encode_message(community.encode('utf-8'), pdu_tag,
+                                 request_id, field1, field2,
+                                 [(oid, NULL_VALUE) for oid in oids])
+        request = _Request(message, address, self.loop.create_future(),
+                           retries, timeout)
+        self._requests[request_id] = request
+        self._send(request_id, request, transport)
+        try:
+            return await request.future
+        finally:
+            self._requests.pop(request_id, None)
+            if request.slot is not None:
+                self._timeouts.cancel(request_id, request.slot)
+
+    def _send(self, request_id, request, transport=None):
+        (transport or self.transport).sendto(request.message, request.address)
+        request.slot = self._timeouts.add(request_id, request.timeout)
+        self.sent += 1
+
+    def _expire(self, request_id):
+        request = self._requests.get(request_id)
+        if request is None or request.future.done():
+            return
+
+        request.slot = None
+        if request.retries > 0 and self.transport is not None:
+            request.retries -= 1
+            self._send(request_id, request)
+        else:
+            self.timeouts += 1
+            request.future.set_exception(SnmpTimeout())
+
+    def datagram_received(self, data, address):
+        try:
+            community, pdu_tag, request_id, error_status, error_index, varbinds = \
+                decode_message(data)
+        except BerError as e:
+            logger.debug('Undecodable response from {}: {}'.format(address, e))
+            request = self._requests.get(e.request_id)
+            if (request is not None and not request.future.done() and
+                    address[0] == request.address[0]):
+                request.future.set_exception(e)
+            # Otherwise the request it belongs to will time out
+            return
+
+        request = self._requests.get(request_id)
+        if (request is None or request.future.done() or
+                pdu_tag != RESPONSE or address[0] != request.address[0]):
+            return
+
+        self.received += 1
+        request.future.set_result((error_status, error_index,
+                                   [(oid, value) for oid, tag, value in varbinds]))
+
+    def error_received(self, exc):
+        logger.debug('SNMP socket error {}'.format(exc))
+
+    async def get(self, address, community, oids, timeout=1, retries=0):
+        """ Sends a GET request
+
+        :param address: (ip, port) tuple of the device
+        :param oids: list of OID tuples
+
+        :return (error status, error index, [(OID tuple, value)])
+        :raises SnmpTimeout: when no response was received in time
+        :raises BerError: when the response can't be decoded
+        """
+        return await self._request(address, community, GET_REQUEST, 0, 0,
+                                   oids, timeout, retries)
+
+    async def get_bulk(self, address, community, oids, non_repeaters=0,
+                       max_repetitions=25, timeout=1, retries=0):
+        """ Sends a GET BULK request, see get """
+        return await self._request(address, community, GET_BULK_REQUEST,
+                                   non_repeaters, max_repetitions,
+                                   oids, timeout, retries)
@@ -1,20 +1,123 @@
 #!/usr/bin/env python3
 
-from time import time
+from time import monotonic, time
 from poller import Task
+from poller.utils import LruCache
+from poller.resolver import resolver, ResolveError
+from poller.health import HealthTracker, CircuitOpen
+from poller.snmp_engine import (SnmpClient, SnmpTimeout, BerError, Exceptional,
+                                Oid, ERROR_STATUS, TIMEOUT_ERROR, endOfMibView, noSuchInstance,
+                                noSuchObject)
 from pysnmp.hlapi.asyncio import (SnmpEngine, CommunityData,
                                   UdpTransportTarget, ContextData,
                                   ObjectType, ObjectIdentity,
                                   getCmd, bulkCmd)
+from pysnmp.proto.errind import RequestTimedOut
+from pysnmp.proto.rfc1902 import IpAddress, ObjectName
+from pyasn1.type import univ
+from pysnmp.proto.rfc1905 import NoSuchObject, NoSuchInstance, EndOfMibView
+from array import array
+from bisect import bisect_left
+from collections import OrderedDict
 import asyncio
+import logging
+import sys
+import zlib
+logger = logging.getLogger(__name__)
+
+# sysUpTime is a 32 bit TimeTicks in hundredths of a second, it wraps
+# to 0 after about 497 days
+UPTIME_WRAP = 2 ** 32 / 100
+
+
+class SnmpError(Exception):
+    """ Raised when an SNMP walk fails """
+    pass
+
+
+def parse_oid(oid):
+    """ Returns a dotted OID string as a tuple of ints """
+    return tuple(int(part) for part in oid.strip('.').split('.'))
+
+
+def format_oid(oid):
+    """ Returns an OID tuple as a dotted string """
+    return '.'.join(str(part) for part in oid)
+
+
+def uptime_interval(uptime, previous, elapsed):
+    """ Returns the seconds between two sysUpTime samples, None when the
+    device rebooted in between
+
+    A decrease is a wrap of sysUpTime instead of a reboot when the
+    interval across the wrap matches the wall clock time between the
+    samples.
+
+    :param uptime: sysUpTime in seconds
+    :param previous: sysUpTime in seconds of the previous sample
+    :param elapsed: wall clock seconds between the samples
+    """
+    if uptime >= previous:
+        return uptime - previous
+    interval = uptime - previous + UPTIME_WRAP
+    if abs(interval - elapsed) <= max(60, elapsed * .1):
+        return interval
+    return None
+
+
+def native_value(value):
+    """ Returns a pysnmp value as the Python value SnmpClient decodes
+    it to, see snmp_engine.decode_value """
+    # The exceptional values are OctetStrings in pysnmp
+    if isinstance(value, EndOfMibView):
+        return endOfMibView
+    elif isinstance(value, NoSuchInstance):
+        return noSuchInstance
+    elif isinstance(value, NoSuchObject):
+        return noSuchObject
+    elif isinstance(value, univ.Integer):
+        return int(value)
+    elif isinstance(value, IpAddress):
+        return '.'.join(str(byte) for byte in value.asOctets())
+    elif isinstance(value, univ.OctetString):
+        return value.asOctets()
+    elif isinstance(value, univ.ObjectIdentifier):
+        return Oid(value)
+    return None
 
 
 class Snmp:
     """ Asynchronous class for common SNMP queries """
 
     def __init__(self, community='public',
-                 timeout=1, retries=0, port=161, lookup_mib=False):
-        """ Initialise snmp engine """
+                 timeout=1, retries=0, port=161, lookup_mib=False,
+                 target_cache_size=4096, target_ttl=300,
+                 oid_cache_size=16384, resolver=resolver,
+                 max_repetitions=25, max_repetitions_limit=200,
+                 max_response_varbinds=400, native=False, health=None):
+        """ Initialise snmp engine
+
+        The auth data, transport targets and parsed OIDs are cached
+        instead of being built for every request. Device names are
+        resolved through the shared resolver before building the
+        transport target, so the target never blocks on a lookup.
+
+        :param target_cache_size: maximum amount of cached transport targets
+        :param target_ttl: seconds after which a transport target is rebuilt
+        :param oid_cache_size: maximum amount of cached parsed OIDs
+        :param resolver: Resolver for the device names
+        :param max_repetitions: initial max_repetitions of a walk
+        :param max_repetitions_limit: upper bound of the adapted
+            max_repetitions
+        :param max_response_varbinds: upper bound of the varbinds
+            asked for in a single GET BULK response
+        :param native: send GET and GET BULK requests with the built in
+            SnmpClient on a single socket instead of pysnmp. pysnmp is
+            still used for responses the client can't decode.
+        :param health: HealthTracker for the adaptive timeouts and the
+            circuit breaker per device. When a request doesn't pass a
+            timeout, timeout is the upper bound of the adaptive one.
+        """
 
         self.community = community
         self.snmp_engine = SnmpEngine()
@@ -23,9 +126,69 @@ class Snmp:
         self.port = port
         self.lookup_mib = lookup_mib
 
+        self.resolver = resolver
+        self._context = ContextData()
+        self._auth = LruCache(max_size=64)
+        self._targets = LruCache(max_size=target_cache_size, ttl=target_ttl)
+        self._object_types = LruCache(max_size=oid_cache_size)
+
+        self.max_repetitions = max_repetitions
+        self.max_repetitions_limit = max_repetitions_limit
+        self.max_response_varbinds = max_response_varbinds
+        # Device address -> max_repetitions learned by previous walks
+        self._repetitions = LruCache(max_size=target_cache_size)
+
+        self.client = SnmpClient() if native else None
+        self._oids = LruCache(max_size=oid_cache_size)
+        self.fallbacks = 0
+
+        self.health = health or HealthTracker()
+
     def shutdown(self):
         """ Shut down the SNMP engine """
-        self.snmp_engine.transportDispatcher.closeDispatcher()
+        if self.client is not None:
+            self.client.close()
+        # pysnmp only creates the dispatcher on the first request
+        if self.snmp_engine.transportDispatcher is not None:
+            self.snmp_engine.transportDispatcher.closeDispatcher()
+
+    def _auth_data(self, community):
+        return self._auth.get_or_create(community,
+                                        lambda: CommunityData(community))
+
+    def _target(self, device, timeout, retries):
+        """ Returns the cached transport target, the key holds all
+        settings of the target so changing any of them builds a new one """
+        return self._targets.get_or_create(
+            (device, self.port, timeout, retries),
+            lambda: UdpTransportTarget((device, self.port),
+                                       timeout=timeout,
+                                       retries=retries))
+
+    def _object_type(self, oid):
+        """ Returns a cached ObjectType, pysnmp resolves it in place on
+        first use so later requests skip parsing the OID """
+        return self._object_types.get_or_create(
+            oid, lambda: ObjectType(ObjectIdentity(oid)))
+
+    def _oid(self, oid):
+        """ Returns the cached OID tuple of a dotted OID """
+        return self._oids.get_or_create(oid, lambda: parse_oid(oid))
+
+    def invalidate(self, device=None, community=None):
+        """ Drops the cached transport targets of a device and the
+        auth data of a community
+
+        The targets and learned max_repetitions are kept per address,
+        a device name is matched through the address it resolved to.
+        """
+        if device is not None:
+            address = self.resolver.invalidate(device)
+            if address is not None:
+                self._targets.invalidate(lambda key: key[0] == address)
+                self._repetitions.pop(address)
+        if community is not None:
+            self._auth.pop(community)
 
     async def _get(self, device, oid,
                    community=None,
@@ -41,159 +204,657 @@ class Snmp:
         :param retries: amount of GET retries, 0 means a single poll
         :param lookupMib: can speed up things a little by turning off
         """
+        response = await self._get_multi(device, [oid],
+                                         community=community,
+                                         timeout=timeout,
+                                         retries=retries,
+                                         lookup_mib=lookup_mib)
+        if 'error' in response:
+            return response
+        else:
+            return {'value': response['values'][oid]}
+
+    async def _get_multi(self, device, oids,
+                         community=None,
+                         timeout=None,
+                         retries=None,
+                         lookup_mib=None):
+        """ Run async snmp GET request for several OIDs in a single PDU
+
+        All OIDs are sampled by the device at the same moment.
+
+        :param device: host to poll
+        :param oids: list of SNMP OIDs to poll
+        :param community: SNMP v2 community string
+        :param timeout: SNMP GET timeout in sec (only use multiple of 0.5's)
+        :param retries: amount of GET retries, 0 means a single poll
+        :param lookupMib: can speed up things a little by turning off
+
+        :return {'values': {<oid>: <value or None if the device
+                                    doesn't have the object>}}
+                or {'error': <error>}. The values are native Python
+                values by SNMP type, see native_value.
+        """
         if not community:
             community = self.community
-        if not timeout:
-            timeout = self.timeout
         if not retries:
             retries = self.retries
         if not lookup_mib:
             lookup_mib = self.lookup_mib
 
+        try:
+            address = await self.resolver.resolve(device)
+            self.health.check(address)
+        except (ResolveError, CircuitOpen) as e:
+            return {'error': str(e)}
+
+        if not timeout:
+            timeout = self.health.timeout(address, self.timeout)
+
+        start = monotonic()
+        response = await self._send_get(address, oids, community, timeout,
+                                        retries, lookup_mib)
+        self._record(address, start, timeout, response.get('error'))
+        return response
+
+    def _record(self, address, start, timeout, error):
+        """ Records the outcome of a request in the device health """
+        if error == TIMEOUT_ERROR:
+            self.health.failure(address)
+        else:
+            # Only an answer before the first timeout is a clean sample
+            rtt = monotonic() - start
+            self.health.success(address, rtt if rtt < timeout else None)
+
+    async def _send_get(self, address, oids, community, timeout, retries,
+                        lookup_mib):
+        """ Sends the GET of _get_multi """
+        if self.client is not None:
+            try:
+                return await self._get_multi_native(address, oids, community,
+                                                    timeout, retries)
+            except (BerError, OSError) as e:
+                self.fallbacks += 1
+                logger.debug('Falling back to pysnmp for {}: {}'.format(address, e))
+
         (err_indication,
          err_status,
          err_index,
          var_binds) = await getCmd(self.snmp_engine,
-                                   CommunityData(community),
-                                   UdpTransportTarget((device, self.port),
-                                                      timeout=timeout,
-                                                      retries=retries),
-                                   ContextData(),
-                                   ObjectType(ObjectIdentity(oid)),
+                                   self._auth_data(community),
+                                   self._target(address, timeout, retries),
+                                   self._context,
+                                   *[self._object_type(oid) for oid in oids],
                                    lookupMib=lookup_mib)
 
         if err_indication:
             return {'error': str(err_indication)}
+        elif err_status:
+            return {'error': err_status.prettyPrint()}
+        else:
+            # The response holds the varbinds in the order of the request
+            values = {}
+            for oid, (response_oid, value) in zip(oids, var_binds):
+                value = native_value(value)
+                values[oid] = None if isinstance(value, Exceptional) else value
+            return {'values': values}
+
+    async def _get_multi_native(self, address, oids, community, timeout, retries):
+        """ Sends the GET of _get_multi with the SnmpClient """
+        try:
+            error_status, error_index, var_binds = await self.client.get(
+                (address, self.port), community,
+                [self._oid(oid) for oid in oids],
+                timeout=timeout, retries=retries)
+        except SnmpTimeout as e:
+            return {'error': str(e)}
+
+        if error_status:
+            return {'error': self._error_status(error_status)}
+
+        values = {}
+        for oid, (response_oid, value) in zip(oids, var_binds):
+            values[oid] = None if isinstance(value, Exceptional) else value
+        return {'values': values}
+
+    @staticmethod
+    def _error_status(error_status):
+        if 0 <= error_status < len(ERROR_STATUS):
+            return ERROR_STATUS[error_status]
+        return str(error_status)
+
+    async def _send_bulk(self, address, community, timeout, retries,
+                         max_repetitions, oids):
+        """ Sends a single GET BULK PDU without non repeaters
+
+        :param oids: list of OID tuples to get the successors of
+
+        :return (error, retry_smaller, rows) where rows holds a list of
+                (OID tuple, value) per repetition in the order of oids
+                and retry_smaller tells if the request might succeed
+                with a smaller max_repetitions
+        """
+        start = monotonic()
+        response = await self._send_bulk_pdu(address, community, timeout, retries,
+                                             max_repetitions, oids)
+        self._record(address, start, timeout, response[0])
+        return response
+
+    async def _send_bulk_pdu(self, address, community, timeout, retries,
+                             max_repetitions, oids):
+        if self.client is not None:
+            try:
+                return await self._send_bulk_native(address, community, timeout,
+                                                    retries, max_repetitions, oids)
+            except (BerError, OSError) as e:
+                self.fallbacks += 1
+                logger.debug('Falling back to pysnmp for {}: {}'.format(address, e))
+
+        (err_indication,
+         err_status,
+         err_index,
+         var_binds) = await bulkCmd(self.snmp_engine,
+                                    self._auth_data(community),
+                                    self._target(address, timeout, retries),
+                                    self._context,
+                                    0, max_repetitions,
+                                    *[ObjectType(ObjectIdentity(ObjectName(oid)))
+                                      for oid in oids],
+                                    lookupMib=False)
+
+        if err_indication:
+            return (str(err_indication),
+                    isinstance(err_indication, RequestTimedOut), None)
+        elif err_status:
+            error = err_status.prettyPrint()
+            return error, error == 'tooBig', None
         else:
-            for oid, value in var_binds:
-                return {'value': value.prettyPrint()}
+            return None, False, [[(tuple(oid), native_value(value)) for oid, value in row]
+                                 for row in var_binds]
+
+    async def _send_bulk_native(self, address, community, timeout, retries,
+                                max_repetitions, oids):
+        """ Sends the GET BULK of _send_bulk with the SnmpClient """
+        try:
+            error_status, error_index, var_binds = await self.client.get_bulk(
+                (address, self.port), community, oids,
+                max_repetitions=max_repetitions,
+                timeout=timeout, retries=retries)
+        except SnmpTimeout as e:
+            return str(e), True, None
+
+        if error_status:
+            error = self._error_status(error_status)
+            return error, error == 'tooBig', None
+
+        # The response holds the varbinds row by row
+        return None, False, [var_binds[i:i + len(oids)]
+                             for i in range(0, len(var_binds), len(oids))]
+
+    async def walk(self, device, oids,
+                   community=None,
+                   timeout=None,
+                   retries=None):
+        """ Walks one or more table columns and yields the rows
+
+        The columns are walked in parallel, every GET BULK asks for the
+        next rows of all columns that haven't reached their end yet. A
+        column ends at the first OID outside its subtree, which is
+        compared as numbers so 1.3.6.1.2.1.1 doesn't continue into
+        1.3.6.1.2.1.10.
+
+        The max_repetitions is learned per device: it grows while the
+        device answers and is halved when it answers tooBig, or on the
+        first timeout of a walk, after which it stays put until the next
+        walk. It's capped so a response holds at most
+        max_response_varbinds varbinds. The walk stops as soon as the
+        circuit of the device opens.
+
+        Usage::
+
+            async for index, values in snmp.walk(device, [column, ...]):
+                ...
+
+        :param device: host to poll
+        :param oids: list of column OIDs to walk
+        :param community: SNMP v2 community string
+        :param timeout: SNMP timeout in sec (only use multiple of 0.5's)
+        :param retries: amount of retries, 0 means a single poll
+
+        :return async generator of (index, {<column oid>: <value>})
+                in index order, index is the tuple of OID parts after
+                the column OID. Columns without a value for the index
+                are left out.
+        :raises SnmpError: when the device doesn't answer or the walk fails
+        """
+        if not community:
+            community = self.community
+        if not retries:
+            retries = self.retries
+
+        try:
+            address = await self.resolver.resolve(device)
+        except ResolveError as e:
+            raise SnmpError(str(e))
+
+        if not timeout:
+            timeout = self.health.timeout(address, self.timeout)
+
+        roots = [parse_oid(oid) for oid in oids]
+        # Last OID received per column, None once a column has ended
+        positions = list(roots)
+        rows = {}
+        repetitions = self._repetitions.get(address) or self.max_repetitions
+        backed_off = False
+        timed_out = False
+
+        while True:
+            active = [column for column, position in enumerate(positions)
+                      if position is not None]
+            if not active:
+                break
+
+            try:
+                self.health.check(address)
+            except CircuitOpen as e:
+                raise SnmpError(str(e))
+
+            repetitions = max(1, min(repetitions,
+                                     self.max_repetitions_limit,
+                                     self.max_response_varbinds // len(active)))
+
+            error, retry_smaller, table = await self._send_bulk(
+                address, community, timeout, retries, repetitions,
+                [positions[column] for column in active])
+
+            if error:
+                # A dead device times out whatever the size, so only the
+                # first timeout of a walk is retried smaller
+                if error != 'tooBig' and retry_smaller:
+                    retry_smaller = not timed_out
+                    timed_out = True
+                if retry_smaller and repetitions > 1:
+                    repetitions //= 2
+                    backed_off = True
+                    self._repetitions.set(address, repetitions)
+                    logger.debug('Walk of {} failed with {}, retrying with '
+                                 'max_repetitions {}'.format(device, error,
+                                                             repetitions))
+                    continue
+                raise SnmpError(error)
+
+            for row in table:
+                for column, (oid, value) in zip(active, row):
+                    position = positions[column]
+                    if position is None:
+                        continue
+                    root = roots[column]
+                    if (value is endOfMibView or
+                            oid[:len(root)] != root or oid <= position):
+                        # Left the subtree, or the device isn't
+                        # returning increasing OIDs
+                        positions[column] = None
+                        continue
+                    positions[column] = oid
+                    rows.setdefault(oid[len(root):], {})[oids[column]] = value
+
+            if not table:
+                for column in active:
+                    positions[column] = None
+
+            # Rows before the position of every active column are complete
+            pending = [positions[column][len(roots[column]):]
+                       for column in active if positions[column] is not None]
+            boundary = min(pending) if pending else None
+            for index in sorted(rows):
+                if boundary is not None and index >= boundary:
+                    break
+                yield index, rows.pop(index)
+
+            # Only the next walk probes for larger responses again
+            # after backing off
+            if not backed_off:
+                repetitions = min(repetitions + repetitions // 2 + 1,
+                                  self.max_repetitions_limit)
+                self._repetitions.set(address, repetitions)
+
+        for index in sorted(rows):
+            yield index, rows[index]
 
     async def _get_bulk(self, device, start_oid,
                         community=None,
                         timeout=None,
                         retries=None,
                         non_repeaters=0,
-                        max_repetitions=25,
+                        max_repetitions=None,
                         lookup_mib=None):
-        """ Run async snmp GET BULK request
+        """ Walks a subtree with GET BULK requests
 
         :param device: host to poll
-        :param oid: SNMP OID to poll
+        :param start_oid: SNMP OID of the subtree to walk
         :param community: SNMP v2 community string
         :param timeout: SNMP GET timeout in sec (only use multiple of 0.5's)
         :param retries: amount of GET retries, 0 means a single poll
-        :param non_repeaters: amount of objects to retrieved with a get-next
-        :param max_repetitions: amount of get-next to retrieve the remaining
-        :param lookupMib: can speed up things a little by turning off
-        """
-        if not community:
-            community = self.community
-        if not timeout:
-            timeout = self.timeout
-        if not retries:
-            retries = self.retries
-        if not lookup_mib:
-            lookup_mib = self.lookup_mib
+        :param non_repeaters: unused, kept for compatibility
+        :param max_repetitions: unused, the walk adapts it per device
+        :param lookupMib: unused, the walk doesn't resolve MIB names
 
-        current_oid = start_oid
+        :return {<oid>: <value>} or {'error': <error>}
+        """
         result = {}
+        try:
+            async for index, values in self.walk(device, [start_oid],
+                                                 community=community,
+                                                 timeout=timeout,
+                                                 retries=retries):
+                result[start_oid + '.' + format_oid(index)] = values[start_oid]
+        except SnmpError as e:
+            return {'error': str(e)}
+        return result
 
-        while True:
-            print(current_oid)
-            (err_indication,
-             err_status,
-             err_index,
-             var_binds) = await bulkCmd(self.snmp_engine,
-                                        CommunityData(community),
-                                        UdpTransportTarget((device, self.port),
-                                                           timeout=timeout,
-                                                           retries=retries),
-                                        ContextData(),
-                                        non_repeaters,
-                                        max_repetitions,
-                                        ObjectType(ObjectIdentity(current_oid)),
-                                        lookupMib=lookup_mib)
-
-            if err_indication:
-                return {'error': str(err_indication)}
+
+class SnmpDispatcher:
+    """ Coalesces SNMP GET requests of several tasks per device
+
+    Sits between the tasks and Snmp with the same _get, _get_multi,
+    _get_bulk and walk interface. GET requests for the same device and
+    community that arrive within window seconds are merged into as
+    few PDUs as the device's max varbinds per PDU allow. The values
+    are handed back to each requester. When a device answers tooBig
+    the PDU is split in half and sent again.
+
+    :param snmp: Snmp instance sending the PDUs
+    :param window: seconds to wait for other requests to merge with
+    :param max_varbinds: maximum amount of varbinds per PDU
+    :param max_varbinds_per_device: dict of device to max_varbinds
+    """
+
+    def __init__(self, snmp, window=.01, max_varbinds=30,
+                 max_varbinds_per_device=None):
+        self.snmp = snmp
+        self.window = window
+        self.max_varbinds = max_varbinds
+        self.max_varbinds_per_device = max_varbinds_per_device or {}
+
+        # (device, community, timeout, retries) -> [(oids, future)]
+        self._pending = {}
+
+        self.requests = 0
+        self.pdus = 0
+
+    def shutdown(self):
+        self.snmp.shutdown()
+
+    async def _get(self, device, oid, **kwargs):
+        """ Run a coalesced snmp GET request, see Snmp._get """
+        response = await self._get_multi(device, [oid], **kwargs)
+        if 'error' in response:
+            return response
+        else:
+            return {'value': response['values'][oid]}
+
+    async def _get_multi(self, device, oids, community=None,
+                         timeout=None, retries=None, lookup_mib=None):
+        """ Run a coalesced snmp GET request, see Snmp._get_multi """
+        key = (device, community, timeout, retries)
+        future = asyncio.get_event_loop().create_future()
+
+        self.requests += 1
+        if key not in self._pending:
+            self._pending[key] = []
+            asyncio.ensure_future(self._flush_later(key))
+        self._pending[key].append((oids, future))
+
+        return await future
+
+    async def _get_bulk(self, *args, **kwargs):
+        """ GET BULK requests are not coalesced, see Snmp._get_bulk """
+        return await self.snmp._get_bulk(*args, **kwargs)
+
+    def walk(self, *args, **kwargs):
+        """ Walks are not coalesced, see Snmp.walk """
+        return self.snmp.walk(*args, **kwargs)
+
+    async def _flush_later(self, key):
+        await asyncio.sleep(self.window)
+        requests = self._pending.pop(key)
+        device, community, timeout, retries = key
+
+        # Several tasks can ask for the same OID
+        oids = list(OrderedDict.fromkeys(oid for request_oids, future in requests
+                                         for oid in request_oids))
+        max_varbinds = self.max_varbinds_per_device.get(device, self.max_varbinds)
+        chunks = [oids[i:i + max_varbinds]
+                  for i in range(0, len(oids), max_varbinds)]
+
+        try:
+            responses = await asyncio.gather(*[self._send(key, chunk)
+                                               for chunk in chunks])
+        except Exception as e:
+            for request_oids, future in requests:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        values = {}
+        errors = {}
+        for chunk, response in zip(chunks, responses):
+            for oid in chunk:
+                if 'error' in response:
+                    errors[oid] = response['error']
+                else:
+                    values[oid] = response['values'][oid]
+
+        for request_oids, future in requests:
+            if future.done():
+                continue
+            for oid in request_oids:
+                if oid in errors:
+                    future.set_result({'error': errors[oid]})
+                    break
             else:
-                for row in var_binds:
-                    for oid, value in row:
-                        if oid.prettyPrint().startswith(start_oid):
-                            pretty_value = value.prettyPrint()
-                            if pretty_value.startswith('0x'):
-                                # Hack to convert long strings into
-                                # ascii. pysnmp converts all strings
-                                # longer than 7-bits to hex
-                                pretty_value = str(value)
-                            result[oid.prettyPrint()] = pretty_value
-                        else:
-                            # We've reached the last oid
-                            return result
-                current_oid = var_binds[-1][0][1]
+                future.set_result({'values': {oid: values[oid]
+                                              for oid in request_oids}})
+
+    async def _send(self, key, oids):
+        """ Sends a single GET PDU, splitting it when it's too big """
+        device, community, timeout, retries = key
+
+        self.pdus += 1
+        response = await self.snmp._get_multi(device, oids,
+                                              community=community,
+                                              timeout=timeout,
+                                              retries=retries)
+        if response.get('error') == 'tooBig' and len(oids) > 1:
+            half = len(oids) // 2
+            first, second = await asyncio.gather(self._send(key, oids[:half]),
+                                                 self._send(key, oids[half:]))
+            if 'error' in first:
+                return first
+            if 'error' in second:
+                return second
+            first['values'].update(second['values'])
+            return first
+        return response
 
 
 class SystemInfoProbe(Task):
-    """ Retrieves common system info """
+    """ Retrieves common system info
+
+    With changes_only the probe polls only sysUpTime and walks the
+    system subtree when the device rebooted, when refresh_age seconds
+    passed since the last walk, or on the first run. A result then
+    only holds the uptime and the fields that changed since the
+    previous walk.
+    """
+
+    __slots__ = ('device', 'snmp', 'changes_only', 'refresh_age',
+                 '_info', '_uptime', '_sampled_at', '_walked_at')
+
+    # OID definition
+    sys_info_oid = '1.3.6.1.2.1.1'
+    uptime_oid = '1.3.6.1.2.1.1.3.0'
+    fields = OrderedDict([('description', '1.3.6.1.2.1.1.1.0'),
+                          ('object_id', '1.3.6.1.2.1.1.2.0'),
+                          ('contact', '1.3.6.1.2.1.1.4.0'),
+                          ('name', '1.3.6.1.2.1.1.5.0'),
+                          ('location', '1.3.6.1.2.1.1.6.0'),
+                          ('services', '1.3.6.1.2.1.1.7.0')])
+
+    result_fields = dict(Task.result_fields, uptime='d')
 
-    def __init__(self, device, snmp, *args, **kwargs):
+    def __init__(self, device, snmp, changes_only=False, refresh_age=86400,
+                 *args, **kwargs):
         """ Making sure to pass on the scheduling variables to the
         main task.
 
         :param snmp: asyncio snmp class
         :param device: device to poll
+        :param changes_only: poll only the uptime and return changed fields
+        :param refresh_age: seconds after which the subtree is walked
+            again when changes_only is set
         """
 
         super().__init__(*args, **kwargs)
-        self.device = device
+        self.device = sys.intern(device)
         self.snmp = snmp
+        self.changes_only = changes_only
+        self.refresh_age = refresh_age
+
+        # System info of the last walk
+        self._info = None
+        self._uptime = None
+        self._sampled_at = None
+        self._walked_at = None
 
     def to_json(self):
         data = Task.to_json(self)
         data['device'] = self.device
-        data['if_index'] = self.if_index
+        data['changes_only'] = self.changes_only
+        data['refresh_age'] = self.refresh_age
         return data
 
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        task = super().from_json(data)
+        task.device = sys.intern(data['device'])
+        task.snmp = snmp
+        task.changes_only = data.get('changes_only', False)
+        task.refresh_age = data.get('refresh_age', 86400)
+        task._info = None
+        task._uptime = None
+        task._sampled_at = None
+        task._walked_at = None
+        return task
+
+    async def _walk(self, result):
+        """ Walks the system subtree, returns the info or None on errors """
+        sys_info = await self.snmp._get_bulk(self.device, self.sys_info_oid)
+        if 'error' in sys_info:
+            result['error'] = sys_info['error']
+            return None
+
+        info = {field: sys_info.get(oid) for field, oid in self.fields.items()}
+        uptime = sys_info.get(self.uptime_oid)
+        # sysUpTime is in hundredths of a second
+        info['uptime'] = uptime / 100 if uptime is not None else None
+        return info
+
+    def _rebooted(self, uptime, sampled_at):
+        """ Returns whether sysUpTime went backwards since the previous
+        sample, other than by wrapping """
+        return (self._uptime is not None and uptime is not None and
+                uptime_interval(uptime, self._uptime,
+                                sampled_at - self._sampled_at) is None)
+
+    def _sample(self, uptime, sampled_at):
+        self._uptime = uptime
+        self._sampled_at = sampled_at
+
     async def run(self):
         """ Gets common system information
 
-        :param device: network device to query
-        :param if_index: the interface if_index
+        :return {'description': <sysDescr>,
+                 'object_id': <sysObjectID>,
+                 'uptime': <sysUpTime in seconds>,
+                 'contact': <sysContact>,
+                 'name': <sysName>,
+                 'location': <sysLocation>,
+                 'services': <sysServices>,
+                 'end_timestamp': <timestamp after poll>}
 
-        :return {'device' : <device name/ip>,
-                 'if_index' <interface if_index>,
-                 'ifHCInOctets' <in octets>,
-                 'ifHCOutOctets': <interface out octets>,
-                 'timestamp': <timestamp after poll>}
+        'rebooted' is set when the uptime went backwards since the
+        previous sample. With changes_only the fields that didn't change
+        are left out.
         """
-
-        # OID definition
-        sys_info_oid = '1.3.6.1.2.1.1'
-
         result = {'start_timestamp': time()}
 
-        sys_info = await self.snmp._get_bulk(self.device, sys_info_oid)
+        if not self.changes_only:
+            info = await self._walk(result)
+            if info is not None:
+                if self._rebooted(info['uptime'], result['start_timestamp']):
+                    result['rebooted'] = True
+                self._sample(info['uptime'], result['start_timestamp'])
+                result.update(info)
+            result['end_timestamp'] = time()
+            self.results.append(result)
+            return
 
-        if 'error' in sys_info:
-            result['error'] = sys_info['error']
-        else:
-            result['description'] = sys_info['1.3.6.1.2.1.1.1.0']
-            result['object_id'] = sys_info['1.3.6.1.2.1.1.2.0']
-            result['uptime'] = float(sys_info['1.3.6.1.2.1.1.3.0']) / 100
-            result['contact'] = sys_info['1.3.6.1.2.1.1.4.0']
-            result['name'] = sys_info['1.3.6.1.2.1.1.5.0']
-            result['location'] = sys_info['1.3.6.1.2.1.1.6.0']
-            result['services'] = sys_info['1.3.6.1.2.1.1.7.0']
+        walk = (self._info is None or
+                result['start_timestamp'] - self._walked_at >= self.refresh_age)
+        if not walk:
+            response = await self.snmp._get(self.device, self.uptime_oid)
+            if 'error' in response:
+                result['error'] = response['error']
+            elif response['value'] is not None:
+                uptime = response['value'] / 100
+                if self._rebooted(uptime, result['start_timestamp']):
+                    # The uptime is only updated by a successful walk so
+                    # a failed one is retried on the next run
+                    result['rebooted'] = True
+                    walk = True
+                else:
+                    self._sample(uptime, result['start_timestamp'])
+                result['uptime'] = uptime
 
-        result['end_timestamp'] = time()
+        if walk:
+            info = await self._walk(result)
+            if info is not None:
+                # A refresh walk can be the first sample after a reboot
+                if self._rebooted(info['uptime'], result['start_timestamp']):
+                    result['rebooted'] = True
+                previous = self._info or {}
+                for field in self.fields:
+                    if field not in previous or info[field] != previous[field]:
+                        result[field] = info[field]
+                self._sample(info['uptime'], result['start_timestamp'])
+                result['uptime'] = info['uptime']
+                self._info = info
+                self._walked_at = result['start_timestamp']
 
+        result['end_timestamp'] = time()
         self.results.append(result)
 
 
 class InterfaceOctetsProbe(Task):
-    """ Runs an ICMP probe to the provided destination """
+    """ Polls the traffic counters of a single interface """
+
+    __slots__ = ('device', 'if_index', 'snmp', 'counters')
+
+    # OID definition
+    oids = {'ifHCInOctets': '1.3.6.1.2.1.31.1.1.1.6.',
+            'ifHCOutOctets': '1.3.6.1.2.1.31.1.1.1.10.',
+            'ifInDiscards': '1.3.6.1.2.1.2.2.1.13.',
+            'ifInErrors': '1.3.6.1.2.1.2.2.1.14.',
+            'ifOutDiscards': '1.3.6.1.2.1.2.2.1.19.',
+            'ifOutErrors': '1.3.6.1.2.1.2.2.1.20.'}
 
-    def __init__(self, device, if_index, snmp, *args, **kwargs):
+    result_fields = dict(Task.result_fields,
+                         ifHCInOctets='Q', ifHCOutOctets='Q',
+                         ifInDiscards='I', ifInErrors='I',
+                         ifOutDiscards='I', ifOutErrors='I')
+
+    def __init__(self, device, if_index, snmp, counters=None, *args, **kwargs):
         """ Making sure to pass on the scheduling variables to the
         main task.
 
@@ -201,22 +862,43 @@ class InterfaceOctetsProbe(Task):
             snmp: asyncio snmp class
             device: device to poll
             if_index: The interface ifindex to poll ion/out octets from
+            counters: extra counters to poll next to the in/out octets,
+                any of ifInDiscards, ifInErrors, ifOutDiscards, ifOutErrors
         """
 
         super().__init__(*args, **kwargs)
-        self.device = device
-        self.if_index = if_index
+        self.device = sys.intern(device)
+        self.if_index = int(if_index)
         self.snmp = snmp
+        self.counters = ('ifHCInOctets', 'ifHCOutOctets') + tuple(counters or ())
+
+        for counter in self.counters:
+            if counter not in self.oids:
+                raise ValueError('Unknown interface counter {}'.format(counter))
 
     def to_json(self):
         data = Task.to_json(self)
         data['device'] = self.device
         data['if_index'] = self.if_index
+        data['counters'] = list(self.counters[2:])
         return data
 
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        # The counters were checked when the task was created
+        task = super().from_json(data)
+        task.device = sys.intern(data['device'])
+        task.if_index = data['if_index']
+        task.snmp = snmp
+        task.counters = ('ifHCInOctets', 'ifHCOutOctets') + tuple(data.get('counters') or ())
+        return task
+
     async def run(self):
         """ Gets the in and out octets of a given interface
 
+        All counters are fetched in a single GET so they are sampled
+        at the same moment.
+
         :param device: network device to query
         :param if_index: the interface if_index
 
@@ -224,36 +906,224 @@ class InterfaceOctetsProbe(Task):
                  'if_index' <interface if_index>,
                  'ifHCInOctets' <in octets>,
                  'ifHCOutOctets': <out octets>,
+                 <extra counter>: <value>,
                  'end_timestamp': <timestamp after poll>}
         """
-        # OID definition
-        ifHCInOctets = '1.3.6.1.2.1.31.1.1.1.6.'
-        ifHCOutOctets = '1.3.6.1.2.1.31.1.1.1.10.'
+        oids = [self.oids[counter] + str(self.if_index)
+                for counter in self.counters]
 
         result = {'start_timestamp': time()}
 
-        # Incoming traffic
-        in_octets = await self.snmp._get(self.device,
-                                         ifHCInOctets + self.if_index)
-        if 'value' in in_octets:
-            result['ifHCInOctets'] = int(in_octets['value'])
-        elif 'error' in in_octets:
-            result['error'] = in_octets['error']
-            result['ifHCInOctets'] = None
-        else:
-            result['ifHCInOctets'] = None
-
-        # Outgoing traffic
-        out_octets = await self.snmp._get(self.device,
-                                          ifHCOutOctets + self.if_index)
-        if 'value' in out_octets:
-            result['ifHCOutOctets'] = int(out_octets['value'])
-        elif 'error' in out_octets:
-            result['error'] = in_octets['error']
-            result['ifHCOutOctets'] = None
-        else:
-            result['ifHCOutOctets'] = None
+        response = await self.snmp._get_multi(self.device, oids)
+        for counter, oid in zip(self.counters, oids):
+            if 'values' in response and response['values'][oid] is not None:
+                result[counter] = response['values'][oid]
+            else:
+                result[counter] = None
+
+        if 'error' in response:
+            result['error'] = response['error']
+
+        result['end_timestamp'] = time()
+        self.results.append(result)
+
+
+class InterfaceTableProbe(Task):
+    """ Polls the traffic rates of all interfaces of a device
+
+    The octet counters of every interface, or of the given if_indexes,
+    are fetched in bulk and turned into bits per second rates against
+    the previous sample. The previous sample is kept in arrays instead
+    of a dict per interface so chassis with thousands of ports stay
+    small.
+
+    The interval between samples is taken from sysUpTime. When it went
+    backwards, other than by wrapping after 497 days, the device
+    rebooted and the counters restarted, so no rates are returned for
+    that run. An interface only gets a rate when its ifName didn't
+    change since the previous sample, which catches interfaces that got
+    a different ifIndex. A 64 bit counter doesn't wrap in practice, so
+    a counter that went down was reset and gets no rate for that
+    interval.
+    """
+
+    __slots__ = ('device', 'snmp', 'if_indexes',
+                 '_indexes', '_names', '_in_octets', '_out_octets', '_uptime',
+                 '_sampled_at')
+
+    # OID definition
+    uptime_oid = '1.3.6.1.2.1.1.3.0'
+    columns = OrderedDict([('ifName', '1.3.6.1.2.1.31.1.1.1.1'),
+                           ('ifHCInOctets', '1.3.6.1.2.1.31.1.1.1.6'),
+                           ('ifHCOutOctets', '1.3.6.1.2.1.31.1.1.1.10')])
+
+    # Maximum amount of OIDs in a single GET of the filtered if_indexes
+    max_varbinds = 30
+
+    result_fields = dict(Task.result_fields, uptime='d', interface_count='I')
+
+    def __init__(self, device, snmp, if_indexes=None, *args, **kwargs):
+        """ Making sure to pass on the scheduling variables to the
+        main task.
+
+        :param device: device to poll
+        :param snmp: asyncio snmp class
+        :param if_indexes: list of if_indexes to poll, None to walk
+            all interfaces
+        """
+
+        super().__init__(*args, **kwargs)
+        self.device = sys.intern(device)
+        self.snmp = snmp
+        self.if_indexes = (tuple(sorted(int(if_index) for if_index in if_indexes))
+                           if if_indexes else None)
+
+        # Previous sample, sorted on if_index
+        self._indexes = array('L')
+        self._names = array('L')
+        self._in_octets = array('Q')
+        self._out_octets = array('Q')
+        self._uptime = None
+        self._sampled_at = None
+
+    def to_json(self):
+        data = Task.to_json(self)
+        data['device'] = self.device
+        data['if_indexes'] = list(self.if_indexes) if self.if_indexes else None
+        return data
+
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        task = super().from_json(data)
+        task.device = sys.intern(data['device'])
+        task.snmp = snmp
+        if_indexes = data.get('if_indexes')
+        task.if_indexes = (tuple(sorted(int(if_index) for if_index in if_indexes))
+                           if if_indexes else None)
+        task._indexes = array('L')
+        task._names = array('L')
+        task._in_octets = array('Q')
+        task._out_octets = array('Q')
+        task._uptime = None
+        task._sampled_at = None
+        return task
+
+    async def _walk(self):
+        """ Returns the uptime and the interface rows of all interfaces """
+        response = await self.snmp._get(self.device, self.uptime_oid)
+        if 'error' in response:
+            raise SnmpError(response['error'])
+
+        rows = []
+        async for index, values in self.snmp.walk(self.device,
+                                                  list(self.columns.values())):
+            rows.append((index[0], values))
+        return response['value'], rows
+
+    async def _get_filtered(self):
+        """ Returns the uptime and the interface rows of the filtered
+        if_indexes with GET requests """
+        oids = [self.uptime_oid]
+        for if_index in self.if_indexes:
+            oids.extend('{}.{}'.format(column, if_index)
+                        for column in self.columns.values())
+
+        chunks = [oids[i:i + self.max_varbinds]
+                  for i in range(0, len(oids), self.max_varbinds)]
+        values = {}
+        for response in await asyncio.gather(*[self.snmp._get_multi(self.device, chunk)
+                                               for chunk in chunks]):
+            if 'error' in response:
+                raise SnmpError(response['error'])
+            values.update(response['values'])
+
+        rows = []
+        for if_index in self.if_indexes:
+            row = {}
+            for column in self.columns.values():
+                value = values['{}.{}'.format(column, if_index)]
+                if value is not None:
+                    row[column] = value
+            rows.append((if_index, row))
+        return values[self.uptime_oid], rows
+
+    async def run(self):
+        """ Gets the in and out rates of the interfaces
+
+        :return {'uptime': <sysUpTime in seconds>,
+                 'interface_count': <amount of polled interfaces>,
+                 'rebooted': <True when sysUpTime went backwards>,
+                 'interfaces': [{'if_index': <if_index>,
+                                 'name': <ifName>,
+                                 'in_bps': <in bits per second>,
+                                 'out_bps': <out bits per second>}],
+                 'end_timestamp': <timestamp after poll>}
+
+        The rates are left out on the first sample of an interface.
+        """
+        result = {'start_timestamp': time()}
+
+        try:
+            if self.if_indexes:
+                uptime, rows = await self._get_filtered()
+            else:
+                uptime, rows = await self._walk()
+        except SnmpError as e:
+            result['error'] = str(e)
+            result['end_timestamp'] = time()
+            self.results.append(result)
+            return
+
+        name_oid, in_oid, out_oid = self.columns.values()
+        uptime = uptime / 100 if uptime is not None else None
+        interval = None
+        if uptime is not None and self._uptime is not None:
+            interval = uptime_interval(uptime, self._uptime,
+                                       result['start_timestamp'] - self._sampled_at)
+            if interval is None:
+                result['rebooted'] = True
+
+        indexes = array('L')
+        names = array('L')
+        in_octets = array('Q')
+        out_octets = array('Q')
+        interfaces = []
+        for if_index, values in rows:
+            if in_oid not in values or out_oid not in values:
+                continue
+
+            name = values.get(name_oid, b'')
+            name_hash = zlib.crc32(name)
+            octets = (values[in_oid], values[out_oid])
+            interface = {'if_index': if_index, 'name': name}
+
+            previous = bisect_left(self._indexes, if_index)
+            if (interval and previous < len(self._indexes) and
+                    self._indexes[previous] == if_index and
+                    self._names[previous] == name_hash):
+                if octets[0] >= self._in_octets[previous]:
+                    interface['in_bps'] = ((octets[0] - self._in_octets[previous]) *
+                                           8 / interval)
+                if octets[1] >= self._out_octets[previous]:
+                    interface['out_bps'] = ((octets[1] - self._out_octets[previous]) *
+                                            8 / interval)
+
+            indexes.append(if_index)
+            names.append(name_hash)
+            in_octets.append(octets[0])
+            out_octets.append(octets[1])
+            interfaces.append(interface)
+
+        self._indexes = indexes
+        self._names = names
+        self._in_octets = in_octets
+        self._out_octets = out_octets
+        self._uptime = uptime
+        self._sampled_at = result['start_timestamp']
 
+        result['uptime'] = uptime
+        result['interface_count'] = len(interfaces)
+        result['interfaces'] = interfaces
         result['end_timestamp'] = time()
         self.results.append(result)
 
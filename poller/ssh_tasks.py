@@ -8,6 +8,8 @@ from time import time
 class SshRunSingleCommand(Task):
     """ Asynchronous class for common SSH queries """
 
+    __slots__ = ('device', 'cmd', 'username', 'password', 'known_hosts')
+
     def __init__(self, device, cmd, username, password, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.device = device
@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+
+from array import array
+import math
+
+NAN = float('nan')
+
+
+def percentile(ordered, fraction):
+    """ Nearest-rank percentile of a sorted sequence """
+    if not ordered:
+        return None
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def rtt_statistics(rtts):
+    """ Returns the statistics of the round-trip times of a ping
+
+    A single pass over the samples collects the sums, the jitter and
+    the loss bursts, the percentiles come from one sort of the replies.
+
+    :param rtts: round-trip time in ms per echo request in the order
+        they were sent, NaN or None for lost requests
+    :return {'p50', 'p95', 'p99': <percentiles of the rtt in ms>,
+             'jitter': <mean difference in ms between the rtt of
+                        consecutive replies>,
+             'loss_bursts': <amount of runs of lost requests>,
+             'max_loss_burst': <longest run of lost requests>},
+        without the rtt statistics when nothing was received
+    """
+    received = []
+    jitter = 0.0
+    previous = None
+    bursts = burst = max_burst = 0
+
+    for rtt in rtts:
+        if rtt is None or rtt != rtt:
+            if not burst:
+                bursts += 1
+            burst += 1
+            max_burst = max(max_burst, burst)
+            continue
+
+        burst = 0
+        if previous is not None:
+            jitter += abs(rtt - previous)
+        previous = rtt
+        received.append(rtt)
+
+    statistics = {'loss_bursts': bursts, 'max_loss_burst': max_burst}
+    if not received:
+        return statistics
+
+    received.sort()
+    statistics['p50'] = percentile(received, .5)
+    statistics['p95'] = percentile(received, .95)
+    statistics['p99'] = percentile(received, .99)
+    statistics['jitter'] = jitter / (len(received) - 1) if len(received) > 1 else 0.0
+    return statistics
+
+
+class RttHistogram:
+    """ Round-trip times of many pings in logarithmic buckets
+
+    Keeps a fixed amount of counters instead of the samples, so the
+    percentiles over any amount of runs cost the same memory. Every
+    bucket is growth times wider than the previous one, which bounds
+    the relative error of a percentile by growth - 1.
+
+    :param minimum: upper bound in ms of the first bucket
+    :param maximum: round-trip times above this are counted in the last
+        bucket
+    :param growth: ratio between the bounds of consecutive buckets
+    """
+
+    __slots__ = ('minimum', 'growth', '_log_growth', '_size', '_counts',
+                 'sent', 'received', 'max_loss_burst')
+
+    def __init__(self, minimum=.01, maximum=60000, growth=1.05):
+        self.minimum = minimum
+        self.growth = growth
+        self._log_growth = math.log(growth)
+        self._size = math.ceil(math.log(maximum / minimum) / self._log_growth) + 2
+        self.reset()
+
+    def reset(self):
+        self._counts = array('I', [0]) * self._size
+        self.sent = 0
+        self.received = 0
+        self.max_loss_burst = 0
+
+    def _bucket(self, rtt):
+        if rtt <= self.minimum:
+            return 0
+        bucket = math.ceil(math.log(rtt / self.minimum) / self._log_growth)
+        return min(bucket, self._size - 1)
+
+    def _bound(self, bucket):
+        """ Upper bound in ms of a bucket """
+        return self.minimum * self.growth ** bucket
+
+    def add(self, rtts, max_loss_burst=0):
+        """ Counts the round-trip times in ms of a ping, NaN or None for
+        lost requests """
+        for rtt in rtts:
+            self.sent += 1
+            if rtt is None or rtt != rtt:
+                continue
+            self.received += 1
+            self._counts[self._bucket(rtt)] += 1
+        self.max_loss_burst = max(self.max_loss_burst, max_loss_burst)
+
+    def percentile(self, fraction):
+        """ Returns the upper bound of the bucket holding the percentile """
+        if not self.received:
+            return None
+        rank = max(1, math.ceil(fraction * self.received))
+        seen = 0
+        for bucket, count in enumerate(self._counts):
+            seen += count
+            if seen >= rank:
+                return self._bound(bucket)
+
+    def summary(self):
+        return {'packets_sent': self.sent,
+                'packets_recv': self.received,
+                'p50': self.percentile(.5),
+                'p95': self.percentile(.95),
+                'p99': self.percentile(.99),
+                'max_loss_burst': self.max_loss_burst}
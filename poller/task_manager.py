@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 
 import asyncio
+from array import array
 from time import time
+from collections import Counter, OrderedDict, deque
+import gc
+import heapq
+import itertools
 import logging
 import aiohttp
 import json
-from random import randint
+import math
+import sys
+import zlib
+import uuid
+from .metrics import Metrics
+from .resolver import resolver
+from .utils import json_value
 logger = logging.getLogger(__name__)
 
 __version = '0.0.1'
@@ -20,6 +31,15 @@ class Task:
         recurrence_count: how often should the task re-occur
     """
 
+    # Tasks are kept in memory by the hundred thousands, subclasses
+    # should define __slots__ as well.
+    __slots__ = ('results', 'description', '_id', 'run_at',
+                 'recurrence_time', 'recurrence_count')
+
+    # Numeric result fields and their array typecode, see TaskResults
+    result_fields = {'start_timestamp': 'd',
+                     'end_timestamp': 'd'}
+
     def __init__(self, *args, **kwargs):
         """ Define the task name, set the run at time and define
          recurrence if any
@@ -28,13 +48,16 @@ class Task:
             run_at: when should the task run, use "now" for a immediate task
             recurrence_time: after how many seconds should the task reoccur
             recurrence_count: how often should the task reoccur
+            max_results: how many results to keep
+            max_result_age: after how many seconds to drop a result
         """
-        self.results = []
-        self.type = self.__class__.__name__
+        self.results = TaskResults(self.result_fields,
+                                   max_count=kwargs.get('max_results', 100),
+                                   max_age=kwargs.get('max_result_age', None))
         self.description = kwargs.get('description', "")
 
         run_at = kwargs.get('run_at', None)
-        self._id = kwargs.get('_id', randint(1, 99999))
+        self._id = kwargs['_id'] if '_id' in kwargs else uuid.uuid4().hex
         recurrence_time = kwargs.get('recurrence_time', None)
         recurrence_count = kwargs.get('recurrence_count', None)
 
@@ -46,19 +69,64 @@ class Task:
         else:
             self.run_at = run_at
 
-        self.name = self.__class__.__name__
         self.recurrence_time = recurrence_time
         self.recurrence_count = recurrence_count
 
+    @property
+    def type(self):
+        return self.__class__.__name__
+
+    @property
+    def name(self):
+        return self.__class__.__name__
+
     def to_json(self):
         data = {'run_at': self.run_at,
                 '_id': self._id,
                 'recurrence_time': self.recurrence_time,
                 'recurrence_count': self.recurrence_count,
                 'type': self.type,
-                'description': self.description}
+                'description': self.description,
+                'max_results': self.results.max_count,
+                'max_result_age': self.results.max_age}
         return data
 
+    @staticmethod
+    def json_options(data):
+        """ Returns the scheduling and result options of a to_json dict
+        as keyword arguments of __init__ """
+        options = {'_id': data['_id'],
+                   'run_at': data['run_at'],
+                   'recurrence_count': data.get('recurrence_count', None),
+                   'recurrence_time': data.get('recurrence_time', None)}
+        for option in ('description', 'max_results', 'max_result_age'):
+            if data.get(option) is not None:
+                options[option] = data[option]
+        return options
+
+    @classmethod
+    def from_json(cls, data, snmp=None):
+        """ Returns the task of a to_json dict, like a stored task
+
+        This runs for every task on a restore, so it skips __init__ and
+        its argument checks and conversions, the values of a to_json dict
+        already went through them. Subclasses set their own attributes,
+        every slot, on the returned task, or call __init__ with
+        json_options when they need its checks.
+
+        :param snmp: Snmp instance of the SNMP tasks
+        """
+        task = cls.__new__(cls)
+        task.results = TaskResults(cls.result_fields,
+                                   max_count=data.get('max_results') or 100,
+                                   max_age=data.get('max_result_age'))
+        task.description = data.get('description') or ""
+        task._id = data['_id']
+        task.run_at = data['run_at'] or time()
+        task.recurrence_time = data.get('recurrence_time')
+        task.recurrence_count = data.get('recurrence_count')
+        return task
+
     def __repr__(self):
         return ("Task ID {} type: {} descr: {} run_at: {} recur_time: {} recur_count: {}"
                 .format(self._id,
@@ -78,43 +146,445 @@ class Task:
 
         if self.recurrence_time and not self.recurrence_count:
             # persistent reoccuring task
-            self.run_at = time() + self.recurrence_time
+            self.run_at = self.next_run_at()
             return True
         elif self.recurrence_time and self.recurrence_count > 1:
             # no persistent reoccuring task
-            self.run_at = time() + self.recurrence_time
+            self.run_at = self.next_run_at()
             self.recurrence_count -= 1
             return True
         else:
             # one off task
             return False
 
+    def next_run_at(self, now=None):
+        """ Returns the next run_at on the grid of recurrence_time
+
+        The next run is counted from the previous run_at instead of
+        from the current time so a recurring task doesn't drift. When
+        the task fell behind, the periods it missed are skipped.
+        """
+        if now is None:
+            now = time()
+
+        run_at = self.run_at + self.recurrence_time
+        if run_at < now:
+            missed = math.ceil((now - run_at) / self.recurrence_time)
+            run_at += missed * self.recurrence_time
+        return run_at
+
+    @property
+    def phase(self):
+        """ Offset in seconds within recurrence_time at which the task runs
+
+        The offset is derived from the task type, device and id so it
+        spreads tasks evenly and stays the same across restarts.
+        """
+        key = '{}:{}:{}'.format(self.type, getattr(self, 'device', ''), self._id)
+        return zlib.crc32(key.encode('utf-8')) / 2 ** 32 * self.recurrence_time
+
+    def spread(self):
+        """ Moves run_at forward to the first moment on the task's phase """
+        if not self.recurrence_time:
+            return
+
+        offset = (self.phase - self.run_at) % self.recurrence_time
+        self.run_at += offset
+
     async def run(self):
         """ Runs the specified task
         each task type has to overload this function """
         raise NotImplementedError
 
 
-class TaskResult:
-    """Results of a Task"""
-    pass
+async def register_poller(poller, controller, keepalive=10):
+    """Register poller to controller and maintain keepalive
+
+    :param poller: Poller tuple of (name, ip, port)
+    :param controller: controller tuple of (ip, port)
+    :param keepalive: The keepalive in seconds
+    """
+    url = "http://{}:{}/pollers/register".format(controller[0], controller[1])
+
+    headers = {'content-type': 'application/json'}
+    payload = {'name': poller[0],
+               'ip': poller[1],
+               'port': poller[2]}
+
+    with aiohttp.ClientSession() as session:
+        while True:
+            logger.debug('Registering/keepalive to controller {}'.format(controller))
+            async with session.post(url, data=json.dumps(payload), headers=headers) as response:
+                logger.debug('Controller response {}'.format(response.json()))
+
+            await asyncio.sleep(keepalive)
+
+
+class TaskResults:
+    """ Bounded ring buffer holding the results of a Task
+
+    Numeric result fields are stored column-wise in typed arrays
+    instead of a dict per result. Any other field of a result is kept
+    in a small dict next to it. Once max_count results are stored the
+    oldest one is overwritten, results older than max_age seconds are
+    dropped. The arrays are only allocated once the first result is
+    stored.
+
+    :param fields: dict of numeric result field to array typecode
+    :param max_count: maximum amount of results to keep
+    :param max_age: maximum age in seconds of a result based on its
+        start_timestamp, None to keep results until overwritten
+    """
+
+    __slots__ = ('fields', 'max_count', 'max_age',
+                 '_columns', '_present', '_extra', '_first', '_count')
+
+    age_field = 'start_timestamp'
+
+    def __init__(self, fields, max_count=100, max_age=None):
+        if max_count < 1:
+            raise ValueError('max_count should be at least 1')
+
+        self.fields = fields
+        self.max_count = max_count
+        self.max_age = max_age
+        self._columns = None
+        # Bitmask per slot of the numeric fields that are set
+        self._present = None
+        self._extra = None
+        self._first = 0
+        self._count = 0
+
+    def _allocate(self):
+        self._columns = [array(typecode) for typecode in self.fields.values()]
+        self._present = array('L')
+        self._extra = []
+
+    def __len__(self):
+        self.expire()
+        return self._count
+
+    def __iter__(self):
+        self.expire()
+        for i in range(self._count):
+            yield self._result((self._first + i) % self.max_count)
+
+    def __getitem__(self, index):
+        self.expire()
+        if index < 0:
+            index += self._count
+        if not 0 <= index < self._count:
+            raise IndexError('result index out of range')
+        return self._result((self._first + index) % self.max_count)
+
+    def _result(self, slot):
+        result = {}
+        mask = self._present[slot]
+        for bit, (field, column) in enumerate(zip(self.fields, self._columns)):
+            if mask & (1 << bit):
+                result[field] = column[slot]
+        if self._extra[slot]:
+            result.update(self._extra[slot])
+        return result
+
+    def _drop_oldest(self):
+        self._extra[self._first] = None
+        self._first = (self._first + 1) % self.max_count
+        self._count -= 1
+
+    def append(self, result):
+        """ Stores a result dict, overwriting the oldest when full """
+        if self._columns is None:
+            self._allocate()
+        if self._count == self.max_count:
+            self._drop_oldest()
+
+        slot = (self._first + self._count) % self.max_count
+        grow = slot == len(self._present)
+
+        mask = 0
+        extra = {}
+        for bit, (field, column) in enumerate(zip(self.fields, self._columns)):
+            value = result.get(field)
+            if value is not None:
+                try:
+                    if grow:
+                        column.append(value)
+                    else:
+                        column[slot] = value
+                    mask |= 1 << bit
+                    continue
+                except (TypeError, OverflowError):
+                    extra[field] = value
+
+            if grow:
+                column.append(0)
+
+        for field, value in result.items():
+            if field not in self.fields:
+                extra[field] = value
+
+        if grow:
+            self._present.append(mask)
+            self._extra.append(extra or None)
+        else:
+            self._present[slot] = mask
+            self._extra[slot] = extra or None
+
+        self._count += 1
+        self.expire()
+
+    def expire(self, now=None):
+        """ Drops the results that are older than max_age """
+        if self.max_age is None or not self._count or self.age_field not in self.fields:
+            return
+
+        cutoff = (now or time()) - self.max_age
+        column = self._columns[list(self.fields).index(self.age_field)]
+        while self._count and column[self._first] < cutoff:
+            self._drop_oldest()
+
+    def nbytes(self):
+        """ Approximate amount of memory used by the stored results """
+        size = sys.getsizeof(self)
+        if self._columns is None:
+            return size
+
+        size += sys.getsizeof(self._columns)
+        size += sys.getsizeof(self._present) + sys.getsizeof(self._extra)
+        for column in self._columns:
+            size += sys.getsizeof(column)
+        for extra in self._extra:
+            if extra:
+                size += sys.getsizeof(extra)
+                size += sum(sys.getsizeof(value) for value in extra.values())
+        return size
 
     def to_json(self):
-        pass
+        return [json_value(result) for result in self]
 
-    @classmethod
-    def from_json(self):
-        pass
+
+class TaskLimiter:
+    """ Limits the amount of concurrently running tasks
+
+    Tasks are limited globally, per task type and per device. A task
+    that would exceed one of its limits waits in a run queue instead
+    of being dropped. Waiting tasks are grouped per (type, device) and
+    the groups are served round-robin, so a single busy device can't
+    starve the others.
+
+    :param start: callable that starts a task once it has room
+    :param max_running: maximum amount of running tasks, None for no limit
+    :param max_running_per_type: dict of task type to maximum running tasks
+    :param max_running_per_device: maximum running tasks per device
+    """
+
+    def __init__(self, start, max_running=None, max_running_per_type=None,
+                 max_running_per_device=None):
+        self.start = start
+        self.max_running = max_running
+        self.max_running_per_type = max_running_per_type or {}
+        self.max_running_per_device = max_running_per_device
+
+        self.running = 0
+        self.running_per_type = Counter()
+        self.running_per_device = Counter()
+
+        self._waiting = OrderedDict()
+        self._waiting_ids = set()
+        self.waiting_per_type = Counter()
+        self.waiting_per_device = Counter()
+
+    @property
+    def waiting(self):
+        """ Amount of tasks waiting in the run queue """
+        return len(self._waiting_ids)
+
+    @staticmethod
+    def _limit_keys(task):
+        return task.type, getattr(task, 'device', None)
+
+    def _has_room(self, task):
+        task_type, device = self._limit_keys(task)
+
+        if self.max_running is not None and self.running >= self.max_running:
+            return False
+
+        type_limit = self.max_running_per_type.get(task_type)
+        if type_limit is not None and self.running_per_type[task_type] >= type_limit:
+            return False
+
+        if (device is not None and self.max_running_per_device is not None and
+                self.running_per_device[device] >= self.max_running_per_device):
+            return False
+
+        return True
+
+    def _start(self, task):
+        task_type, device = self._limit_keys(task)
+        self.running += 1
+        self.running_per_type[task_type] += 1
+        if device is not None:
+            self.running_per_device[device] += 1
+        self.start(task)
+
+    def submit(self, task):
+        """ Starts the task or puts it in the run queue
+
+        :return: False if the task is already waiting in the run queue
+        """
+        if id(task) in self._waiting_ids:
+            logger.warning('{} is still waiting to run, skipping'.format(task))
+            return False
+
+        key = self._limit_keys(task)
+        if key not in self._waiting and self._has_room(task):
+            self._start(task)
+            return True
+
+        self._waiting.setdefault(key, deque()).append(task)
+        self._waiting_ids.add(id(task))
+        self.waiting_per_type[key[0]] += 1
+        if key[1] is not None:
+            self.waiting_per_device[key[1]] += 1
+        return True
+
+    def release(self, task):
+        """ Frees the slots of a finished task and starts waiting tasks """
+        task_type, device = self._limit_keys(task)
+        self.running -= 1
+        self.running_per_type[task_type] -= 1
+        if not self.running_per_type[task_type]:
+            del self.running_per_type[task_type]
+        if device is not None:
+            self.running_per_device[device] -= 1
+            if not self.running_per_device[device]:
+                del self.running_per_device[device]
+
+        self._start_waiting()
+
+    def _start_waiting(self):
+        """ Starts one waiting task per group per pass until no group
+        has room left """
+        progress = True
+        while progress and self._waiting:
+            progress = False
+            for key in list(self._waiting):
+                if self.max_running is not None and self.running >= self.max_running:
+                    return
+
+                queue = self._waiting[key]
+                if not self._has_room(queue[0]):
+                    continue
+
+                task = queue.popleft()
+                self._waiting_ids.discard(id(task))
+                self.waiting_per_type[key[0]] -= 1
+                if not self.waiting_per_type[key[0]]:
+                    del self.waiting_per_type[key[0]]
+                if key[1] is not None:
+                    self.waiting_per_device[key[1]] -= 1
+                    if not self.waiting_per_device[key[1]]:
+                        del self.waiting_per_device[key[1]]
+
+                if queue:
+                    self._waiting.move_to_end(key)
+                else:
+                    del self._waiting[key]
+
+                self._start(task)
+                progress = True
+
+    def run_queue_depth(self):
+        """ Returns the running and waiting task counts for each limit """
+        return {'global': {'limit': self.max_running,
+                           'running': self.running,
+                           'waiting': self.waiting},
+                'type': {task_type: {'limit': self.max_running_per_type.get(task_type),
+                                     'running': self.running_per_type[task_type],
+                                     'waiting': self.waiting_per_type[task_type]}
+                         for task_type in set(self.running_per_type) | set(self.waiting_per_type)},
+                'device': {device: {'limit': self.max_running_per_device,
+                                    'running': self.running_per_device[device],
+                                    'waiting': self.waiting_per_device[device]}
+                           for device in set(self.running_per_device) | set(self.waiting_per_device)}}
 
 
 class TaskManager:
     """ Task Manager handling SNMP, SSH and HTTP tasks """
 
-    def __init__(self, loop=None, async_debug=False):
-        """ Initialise network handlers and task/result queues """
-
-        # Initialise queues
-        self.task_queue = asyncio.Queue()
+    def __init__(self, loop=None, async_debug=False, max_running=500,
+                 max_running_per_type=None, max_running_per_device=10,
+                 spread_recurring=False, store=None):
+        """ Initialise network handlers and task schedule
+
+        :param max_running: maximum amount of concurrently running tasks
+        :param max_running_per_type: dict of task type to maximum running tasks
+        :param max_running_per_device: maximum running tasks per device
+        :param spread_recurring: spread recurring tasks over their
+            recurrence_time instead of running them at the given run_at,
+            see Task.spread
+        :param store: TaskStore to persist the tasks in, see restore
+        """
+        self.spread_recurring = spread_recurring
+        self.store = store
+
+        # Task registry indexed by task id
+        self._tasks = {}
+
+        # Initialise the schedule, a min-heap of [run_at, seq, task]
+        # entries. The sequence number keeps tasks with the same
+        # run_at in insertion order and avoids comparing Tasks.
+        # Removed tasks are marked in place (task set to None) and
+        # skipped when they surface, see _unschedule_task.
+        self._schedule = []
+        self._entries = {}
+        self._removed_entries = 0
+        self._sequence = itertools.count()
+        self._wakeup = asyncio.Event()
+
+        self.limiter = TaskLimiter(self._start_task,
+                                   max_running=max_running,
+                                   max_running_per_type=max_running_per_type,
+                                   max_running_per_device=max_running_per_device)
+
+        # Scheduled run_at of tasks that are due but not started yet
+        self._due_at = {}
+
+        self.metrics = Metrics()
+        self.lateness = self.metrics.histogram(
+            'poller_task_lateness_seconds',
+            'Time between the scheduled run_at and the actual start of a task',
+            ('type',))
+        self.duration = self.metrics.histogram(
+            'poller_task_duration_seconds',
+            'Run duration of a task',
+            ('type',))
+        self.completed = self.metrics.counter(
+            'poller_tasks_total',
+            'Finished task runs by result',
+            ('type', 'status'))
+        self.loop_lag = self.metrics.histogram(
+            'poller_loop_lag_seconds',
+            'Delay of the event loop in waking up a sleeping coroutine')
+        self.metrics.gauge('poller_tasks_running',
+                           'Tasks that are currently running',
+                           lambda: self.limiter.running)
+        self.metrics.gauge('poller_tasks_waiting',
+                           'Due tasks waiting in the run queue for a free slot',
+                           lambda: self.limiter.waiting)
+        self.metrics.gauge('poller_tasks_scheduled',
+                           'Tasks on the schedule',
+                           lambda: len(self._tasks))
+        self.metrics.callback_counter('poller_dns_cache_hits_total',
+                                      'Lookups answered from the DNS cache',
+                                      lambda: resolver.hits)
+        self.metrics.callback_counter('poller_dns_cache_misses_total',
+                                      'Lookups that needed a DNS query',
+                                      lambda: resolver.misses)
+        self.metrics.callback_counter('poller_dns_negative_hits_total',
+                                      'Lookups answered from the cache of failed queries',
+                                      lambda: resolver.negative_hits)
 
         # Get asyncio event loop
         if loop:
@@ -131,20 +601,7 @@ class TaskManager:
         :param controller: controller tuple of (ip, port)
         :param keepalive: The keepalive in seconds
         """
-        url = "http://{}:{}/pollers/register".format(controller[0], controller[1])
-
-        headers = {'content-type': 'application/json'}
-        payload = {'name': poller[0],
-                   'ip': poller[1],
-                   'port': poller[2]}
-
-        with aiohttp.ClientSession() as session:
-            while True:
-                logger.debug('Registering/keepalive to controller {}'.format(controller))
-                async with session.post(url, data=json.dumps(payload), headers=headers) as response:
-                    logger.debug('Controller response {}'.format(response.json()))
-
-                await asyncio.sleep(keepalive)
+        await register_poller(poller, controller, keepalive)
 
     def shutdown(self):
         """ kills any pending tasks and shuts down the task manager """
@@ -154,44 +611,248 @@ class TaskManager:
         self.loop.stop()
         exit(0)
 
+    @staticmethod
+    def _task_key(task_id):
+        """ Task ids arrive both as int and str, index them as str """
+        return str(task_id)
+
+    def tasks(self):
+        """ Returns a list of all scheduled tasks ordered by run_at """
+        return sorted(self._tasks.values(), key=lambda task: task.run_at)
+
+    def get(self, task_id):
+        """ Returns the task with the given id or None """
+        return self._tasks.get(self._task_key(task_id))
+
+    def _schedule_task(self, task):
+        """ Push a task on the schedule heap
+
+        Wakes up process_tasks when the task is due before the
+        deadline it is currently sleeping on.
+        """
+        entry = [task.run_at, next(self._sequence), task]
+        self._entries[self._task_key(task._id)] = entry
+        heapq.heappush(self._schedule, entry)
+        if self._schedule[0] is entry:
+            self._wakeup.set()
+
+    def _unschedule_task(self, task_id):
+        """ Marks the heap entry of a task as removed
+
+        The entry stays on the heap until it surfaces or until more
+        than half of the heap is made up of removed entries.
+        """
+        entry = self._entries.pop(self._task_key(task_id), None)
+        if entry is None:
+            return
+
+        entry[2] = None
+        self._removed_entries += 1
+        if self._removed_entries > len(self._schedule) // 2:
+            self._schedule = [entry for entry in self._schedule
+                              if entry[2] is not None]
+            heapq.heapify(self._schedule)
+            self._removed_entries = 0
+
     def add(self, task):
-        """ Add a task to the queue """
-        # TODO: check if the task ID doesn't exist yet
-        self.task_queue.put_nowait(task)
+        """ Add a task to the schedule
+
+        :raises ValueError: when a task with the same id already exists
+        """
+        key = self._task_key(task._id)
+        if key in self._tasks:
+            raise ValueError('Task ID {} already exists'.format(task._id))
+
+        if self.spread_recurring:
+            task.spread()
+
+        self._tasks[key] = task
+        self._schedule_task(task)
+        self._persist(task)
+
+    def update(self, task):
+        """ Replace the task with the same id and schedule it
+
+        :raises KeyError: when no task with this id exists
+        """
+        key = self._task_key(task._id)
+        if key not in self._tasks:
+            raise KeyError('Task ID {} not found'.format(task._id))
+
+        if self.spread_recurring:
+            task.spread()
+
+        self._unschedule_task(key)
+        self._tasks[key] = task
+        self._schedule_task(task)
+        self._persist(task)
 
     def delete(self, task_id):
-        """ delete a task from the queue """
+        """ delete a task from the schedule
+
+        :return: the deleted task or None if it didn't exist
+        """
+        self._unschedule_task(task_id)
+        task = self._tasks.pop(self._task_key(task_id), None)
+        if task is not None:
+            self._persist(task, deleted=True)
+        return task
+
+    def _persist(self, task, deleted=False):
+        """ Writes a task change to the store, if any """
+        if self.store is None:
+            return
+
+        if deleted:
+            self.store.delete(task._id)
+        else:
+            self.store.put(task)
+
+        if self.store.needs_compaction(len(self._tasks)):
+            self.store.compact(self._tasks.values())
 
-        tasks = []
-        while not self.task_queue.empty():
-            task = self.task_queue.get_nowait()
-            if task._id != task_id:
-                tasks.append(task)
+    def restore(self, factory):
+        """ Loads the tasks from the store
 
-        for item in tasks:
-            self.task_queue.put_nowait(item)
+        Recurring tasks whose run_at passed while the poller was down
+        are moved to their next run on the same grid, so they keep
+        their schedule phase. One off tasks that were missed run
+        immediately.
 
-    async def process_tasks(self, load_interval=.5):
-        """ Handle all scheduled tasks """
+        :param factory: callable converting a task dict to a Task,
+            like RestApi.restore_task. It's called for every stored
+            task, so it should be cheap
+        :return: amount of restored tasks
+        """
+        now = time()
+        # The objects of the restored tasks all survive, collecting
+        # garbage while they're created only costs time
+        gc_enabled = gc.isenabled()
+        gc.disable()
+        try:
+            for data in self.store.load():
+                task = factory(data)
+                if task is None:
+                    logger.warning('Can\'t restore task {}'.format(data))
+                    continue
+
+                if task.recurrence_time and task.run_at < now:
+                    task.run_at = task.next_run_at(now)
+
+                # Heapified at once below instead of a push per task
+                key = str(task._id)
+                if key in self._entries:
+                    self._unschedule_task(key)
+                entry = [task.run_at, next(self._sequence), task]
+                self._tasks[key] = task
+                self._entries[key] = entry
+                self._schedule.append(entry)
+        finally:
+            if gc_enabled:
+                gc.enable()
+
+        heapq.heapify(self._schedule)
+        self._wakeup.set()
+
+        if self.store.log_entries:
+            self.store.compact(self._tasks.values())
+        logger.info('Restored {} tasks'.format(len(self._tasks)))
+        return len(self._tasks)
+
+    def _discard_removed_entries(self):
+        """ Pops removed entries from the top of the heap """
+        while self._schedule and self._schedule[0][2] is None:
+            heapq.heappop(self._schedule)
+            self._removed_entries -= 1
+
+    def _pop_due_tasks(self, now):
+        """ Pops all tasks from the schedule whose run_at has passed """
+        due = []
+        while self._schedule and self._schedule[0][0] <= now:
+            task = heapq.heappop(self._schedule)[2]
+            if task is None:
+                self._removed_entries -= 1
+                continue
+            del self._entries[self._task_key(task._id)]
+            due.append(task)
+        return due
+
+    async def _wait_for_deadline(self):
+        """ Sleeps until the earliest deadline on the schedule or
+        until a task with an earlier deadline gets added """
+        self._wakeup.clear()
+        self._discard_removed_entries()
+
+        if not self._schedule:
+            await self._wakeup.wait()
+            return
+
+        delay = self._schedule[0][0] - time()
+        if delay <= 0:
+            return
+
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), delay)
+        except asyncio.TimeoutError:
+            pass
+
+    def _start_task(self, task):
+        """ Runs a task that got room from the limiter """
+        logger.debug('Running {}'.format(task))
+        due_at = self._due_at.pop(id(task), None)
+        if due_at is not None:
+            self.lateness.observe(max(time() - due_at, 0), task.type)
+        asyncio.ensure_future(self._run_task(task))
+
+    async def _run_task(self, task):
+        status = 'success'
+        start = time()
+        try:
+            result = await task.run()
+            if result is None and len(task.results):
+                result = task.results[-1]
+            if result and 'error' in result:
+                status = 'error'
+        except Exception:
+            status = 'error'
+            logger.exception('{} failed'.format(task))
+        finally:
+            self.duration.observe(time() - start, task.type)
+            self.completed.inc(task.type, status)
+            self.limiter.release(task)
+
+    async def monitor_loop(self, interval=.5):
+        """ Measures how late the event loop wakes up a sleeping coroutine
+
+        A busy loop can't keep its timers, the delay is a measure of
+        the time a single loop iteration takes.
+        """
         while True:
-            tasks_to_reschedule = []
-            while not self.task_queue.empty():
-                task = await self.task_queue.get()
+            start = self.loop.time()
+            await asyncio.sleep(interval)
+            self.loop_lag.observe(max(self.loop.time() - start - interval, 0))
+
+    async def process_tasks(self):
+        """ Handle all scheduled tasks
+
+        Sleeps until the next task is due and only touches the tasks
+        whose run_at has passed. Due tasks are handed to the limiter,
+        which starts them or queues them until they have room.
+        Recurring tasks are pushed back on the schedule with the
+        run_at set by Task.reschedule.
+        """
+        while True:
+            await self._wait_for_deadline()
 
-                # Check if task is scheduled
-                if time() >= task.run_at:
-                    logger.debug('Running {}'.format(task))
-                    asyncio.ensure_future(task.run())
+            for task in self._pop_due_tasks(time()):
+                self._due_at.setdefault(id(task), task.run_at)
+                self.limiter.submit(task)
 
-                    if task.reschedule:
-                        tasks_to_reschedule.append(task)
+                if task.reschedule:
+                    self._schedule_task(task)
+                    if task.recurrence_count:
+                        # Keep the remaining runs over a restart
+                        self._persist(task)
                 else:
-                    # Not scheduled to run yet, back of the queue
-                    tasks_to_reschedule.append(task)
-
-            for task_to_reschedule in tasks_to_reschedule:
-                self.add(task_to_reschedule)
+                    self.delete(task._id)
 
-            await asyncio.sleep(load_interval)
-            print('Task Queue: {}               '
-                  .format(self.task_queue.qsize()), end='\r')
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import os
+logger = logging.getLogger(__name__)
+
+
+class TaskStore:
+    """ Persists the task set of a TaskManager on local disk
+
+    The tasks are kept in a snapshot file with all tasks and an append
+    only change log next to it. Every add, update and delete appends a
+    single line to the log, the log is folded into a new snapshot once
+    it grows larger than the snapshot itself.
+
+    Tasks are stored as their to_json() dict. The snapshot groups them
+    per set of fields: the fields that have the same value for every
+    task of a group are stored once, the others as a row of values per
+    task. That parses several times faster than a dict per task.
+    Because a recurring task keeps running on the grid of its run_at and
+    recurrence_time, the stored run_at is enough to restore the schedule
+    phase. The remaining recurrence_count is stored after every run.
+
+    :param path: path of the snapshot, the log is stored at path + '.log'
+    :param compact_after: minimum amount of log entries before compacting
+    """
+
+    def __init__(self, path, compact_after=10000):
+        self.snapshot_path = path
+        self.log_path = path + '.log'
+        self.compact_after = compact_after
+        self.log_entries = 0
+        self._log = None
+
+    def load(self):
+        """ Yields the stored task dicts from the snapshot and log
+
+        The log is read first, so the snapshot can be streamed without
+        collecting it by id when the log is empty.
+        """
+        changes = self._read_log()
+
+        try:
+            with open(self.snapshot_path, 'r') as f:
+                snapshot = json.loads(f.read())
+        except FileNotFoundError:
+            snapshot = []
+
+        for group in snapshot:
+            if 'rows' not in group:
+                # Snapshot with a dict per task
+                if not changes or str(group['_id']) not in changes:
+                    yield group
+                continue
+            constants = group['constants']
+            fields = group['fields']
+            id_column = fields.index('_id')
+            for row in group['rows']:
+                if changes and str(row[id_column]) in changes:
+                    continue
+                task = constants.copy()
+                task.update(zip(fields, row))
+                yield task
+
+        for task in changes.values():
+            if task is not None:
+                yield task
+
+    def _read_log(self):
+        """ Returns the last logged version of every changed task by id,
+        None for deleted tasks """
+        changes = {}
+        self.log_entries = 0
+        try:
+            with open(self.log_path, 'r') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # Partially written last line after a crash
+                        logger.warning('Skipping corrupt task log entry {}'
+                                       .format(line))
+                        continue
+
+                    if entry['op'] == 'put':
+                        task_id = str(entry['task']['_id'])
+                        # Moved to the end, a task that is deleted and
+                        # added again keeps the order of the log
+                        changes.pop(task_id, None)
+                        changes[task_id] = entry['task']
+                    elif entry['op'] == 'delete':
+                        changes[str(entry['_id'])] = None
+                    self.log_entries += 1
+        except FileNotFoundError:
+            pass
+        return changes
+
+    def _append(self, entry):
+        if self._log is None:
+            self._log = open(self.log_path, 'a')
+
+        self._log.write(json.dumps(entry) + '\n')
+        self._log.flush()
+        self.log_entries += 1
+
+    def put(self, task):
+        """ Stores a new or updated task """
+        self._append({'op': 'put', 'task': task.to_json()})
+
+    def delete(self, task_id):
+        """ Removes a task from the store """
+        self._append({'op': 'delete', '_id': task_id})
+
+    def needs_compaction(self, task_count):
+        return self.log_entries > max(self.compact_after, task_count)
+
+    def compact(self, tasks):
+        """ Writes all tasks to a new snapshot and truncates the log
+
+        The snapshot is written to a temporary file first so a crash
+        halfway leaves the previous snapshot and log intact.
+        """
+        groups = {}
+        for task in tasks:
+            data = task.to_json()
+            groups.setdefault(tuple(data), []).append(list(data.values()))
+
+        snapshot = []
+        for fields, rows in groups.items():
+            first = rows[0]
+            constant = [column for column, field in enumerate(fields)
+                        if field != '_id' and
+                        all(row[column] == first[column] for row in rows)]
+            varying = [column for column in range(len(fields))
+                       if column not in constant]
+            snapshot.append({'constants': {fields[column]: first[column]
+                                           for column in constant},
+                             'fields': [fields[column] for column in varying],
+                             'rows': [[row[column] for column in varying]
+                                      for row in rows]})
+
+        tmp_path = self.snapshot_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            # json.dumps uses the C encoder, json.dump doesn't
+            f.write(json.dumps(snapshot, separators=(',', ':')))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.snapshot_path)
+
+        self.close()
+        open(self.log_path, 'w').close()
+        self.log_entries = 0
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
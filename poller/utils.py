@@ -1,5 +1,10 @@
+import asyncio
+from array import array
+from collections import OrderedDict
 from datetime import datetime
+from time import monotonic
 import json
+import math
 
 
 def pretty_time(timestamp):
@@ -9,6 +14,30 @@ def pretty_time(timestamp):
     return datetime.fromtimestamp(int(timestamp)).strftime('%Y-%m-%d %H:%M:%S')  # blabla asdfasaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaaa
 
 
+def json_value(value):
+    """ Returns a result value with its nested values made JSON
+    serializable
+
+    Bytes are decoded as UTF-8, or hex encoded when they aren't text.
+    Objects with a to_json method, like SNMP OIDs, are rendered by it.
+    Arrays become lists with None for NaN.
+    """
+    if isinstance(value, dict):
+        return {key: json_value(item) for key, item in value.items()}
+    elif isinstance(value, list):
+        return [json_value(item) for item in value]
+    elif isinstance(value, array):
+        return [None if item != item else item for item in value]
+    elif isinstance(value, bytes):
+        try:
+            return value.decode('utf-8')
+        except UnicodeDecodeError:
+            return '0x' + value.hex()
+    elif hasattr(value, 'to_json'):
+        return value.to_json()
+    return value
+
+
 def load_config_file(filename='./config.json'):
     """ Loads credentials from config file """
     with open(filename, 'r') as f:
@@ -22,3 +51,147 @@ def load_config_file(filename='./config.json'):
             config[0]['http_api']['port'],
             config[0]['controller']['host'],
             config[0]['controller']['port'])
+
+
+class LruCache:
+    """ Dict like cache evicting the least recently used entries
+
+    None can't be cached, get returns the default for it.
+
+    :param max_size: maximum amount of entries to keep
+    :param ttl: seconds after which an entry expires, None to keep
+        entries until they are evicted
+    """
+
+    def __init__(self, max_size=1024, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """ Returns the cached value and marks it as recently used """
+        entry = self._entries.get(key)
+        if entry is None or (entry[1] is not None and entry[1] < monotonic()):
+            if entry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+
+    def set(self, key, value, ttl=None):
+        """ Stores a value, evicting the least recently used entry if full
+
+        :param ttl: overrides the ttl of the cache for this entry
+        """
+        if ttl is None:
+            ttl = self.ttl
+        expires = monotonic() + ttl if ttl is not None else None
+
+        self._entries[key] = (value, expires)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def get_or_create(self, key, factory):
+        """ Returns the cached value or stores the result of factory() """
+        value = self.get(key)
+        if value is None:
+            value = factory()
+            self.set(key, value)
+        return value
+
+    def pop(self, key, default=None):
+        entry = self._entries.pop(key, None)
+        return default if entry is None else entry[0]
+
+    def invalidate(self, match):
+        """ Drops all entries for which match(key) is true """
+        for key in [key for key in self._entries if match(key)]:
+            del self._entries[key]
+
+    def clear(self):
+        self._entries.clear()
+
+
+class TimerWheel:
+    """ Hashed timer wheel for the request timeouts
+
+    Timeouts are rounded up to resolution seconds and put in the slot
+    of the tick they expire in, so adding and cancelling a timeout
+    doesn't create a loop timer per request. The wheel only ticks
+    while it holds timeouts.
+
+    :param callback: called with the key of every expired timeout
+    :param resolution: seconds per tick
+    :param size: amount of slots, timeouts longer than a turn of the
+        wheel wait for more turns
+    """
+
+    def __init__(self, callback, resolution=.05, size=256, loop=None):
+        self.callback = callback
+        self.resolution = resolution
+        self.size = size
+        self.loop = loop or asyncio.get_event_loop()
+        # Per slot a dict of key to remaining turns
+        self.slots = [{} for i in range(size)]
+        self.tick = 0
+        self.count = 0
+        self._started_at = None
+        self._handle = None
+
+    def add(self, key, timeout):
+        """ Adds a timeout, returns the slot to cancel it with """
+        if self._handle is None:
+            self._started_at = self.loop.time() - self.tick * self.resolution
+            self._schedule()
+
+        # Relative to the current time, the wheel can lag behind while
+        # the loop is busy
+        now_tick = max(self.tick, int((self.loop.time() - self._started_at) /
+                                      self.resolution))
+        ticks = max(1, math.ceil(timeout / self.resolution)) + now_tick - self.tick
+        slot = (self.tick + ticks) % self.size
+        self.slots[slot][key] = (ticks - 1) // self.size
+        self.count += 1
+        return slot
+
+    def cancel(self, key, slot):
+        if self.slots[slot].pop(key, None) is not None:
+            self.count -= 1
+
+    def _schedule(self):
+        at = self._started_at + (self.tick + 1) * self.resolution
+        self._handle = self.loop.call_at(at, self._advance)
+
+    def _advance(self):
+        # Catch up on the ticks that passed while the loop was busy
+        now_tick = int((self.loop.time() - self._started_at) / self.resolution)
+        while self.tick < now_tick:
+            self.tick += 1
+            slot = self.slots[self.tick % self.size]
+            expired = [key for key, turns in slot.items() if not turns]
+            for key, turns in list(slot.items()):
+                if turns:
+                    slot[key] = turns - 1
+            for key in expired:
+                del slot[key]
+                self.count -= 1
+                self.callback(key)
+
+        if self.count:
+            self._schedule()
+        else:
+            self._handle = None
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
@@ -1,13 +1,87 @@
 #!/usr/bin/env python3
 
+import argparse
 import logging
 import asyncio
+import multiprocessing
 from poller import TaskManager, RestApi
-from poller.snmp_tasks import Snmp
+from poller.shards import ShardRouter, run_worker
+from poller.snmp_tasks import Snmp, SnmpDispatcher
+from poller.task_manager import register_poller
+from poller.task_store import TaskStore
 from poller.utils import load_config_file
 
 
+def limit(value):
+    """ Parses a running task limit, 0 for no limit """
+    value = int(value)
+    if value < 0:
+        raise argparse.ArgumentTypeError('limit can\'t be negative')
+    return value or None
+
+
+def type_limit(value):
+    """ Parses a TYPE=LIMIT running task limit of a task type """
+    task_type, _, value = value.partition('=')
+    if not task_type or not value:
+        raise argparse.ArgumentTypeError('expecting TYPE=LIMIT, like Ping=100')
+    return task_type, limit(value)
+
+
+def run_sharded(workers, ssh_user, ssh_pass, snmp_community,
+                api_name, api_host, api_port,
+                controller_ip, controller_port, snmp_options=None,
+                task_manager_options=None):
+    """ Starts a worker process per shard behind a routing front API
+
+    The workers listen on localhost on the ports following api_port,
+    the front API takes api_port and registers to the controller.
+    """
+    logger = logging.getLogger(__name__)
+
+    shards = [('127.0.0.1', api_port + 1 + shard) for shard in range(workers)]
+    for shard, (host, port) in enumerate(shards):
+        logger.info('Starting worker process for shard {}'.format(shard))
+        process = multiprocessing.Process(target=run_worker,
+                                          args=(shard, host, port,
+                                                snmp_community,
+                                                ssh_user, ssh_pass,
+                                                './tasks.shard{}.json'.format(shard)),
+                                          kwargs={'snmp_options': snmp_options,
+                                                  'task_manager_options': task_manager_options},
+                                          daemon=True)
+        process.start()
+
+    logger.info('Registering poller to controller')
+    asyncio.ensure_future(register_poller((api_name, api_host, api_port),
+                                          (controller_ip, controller_port)))
+
+    logger.info('Loading shard router...')
+    router = ShardRouter(shards, ip=api_host, port=str(api_port))
+    router.start()
+
+
 def main():
+    parser = argparse.ArgumentParser(description='netMon poller')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='amount of worker processes to shard the tasks over')
+    parser.add_argument('--native-snmp', action='store_true',
+                        help='send SNMP GETs with the built in client instead of pysnmp')
+    parser.add_argument('--spread-recurring', action='store_true',
+                        help='spread recurring tasks over their recurrence_time '
+                             'instead of running them at their run_at')
+    parser.add_argument('--max-running', type=limit, default=500,
+                        help='maximum amount of concurrently running tasks per '
+                             'worker, 0 for no limit')
+    parser.add_argument('--max-running-per-type', type=type_limit,
+                        action='append', default=[], metavar='TYPE=LIMIT',
+                        help='maximum amount of running tasks of a task type '
+                             'per worker, can be repeated')
+    parser.add_argument('--max-running-per-device', type=limit, default=10,
+                        help='maximum amount of running tasks per device, '
+                             '0 for no limit')
+    args = parser.parse_args()
+
     logger = logging.getLogger(__name__)
     logging.basicConfig(filename='log.main',
                         level=logging.DEBUG,
@@ -20,10 +94,26 @@ def main():
      api_name, api_host, api_port,
      controller_ip, controller_port) = load_config_file()
 
+    snmp_options = {'native': args.native_snmp}
+    task_manager_options = {'spread_recurring': args.spread_recurring,
+                            'max_running': args.max_running,
+                            'max_running_per_type': dict(args.max_running_per_type),
+                            'max_running_per_device': args.max_running_per_device}
+
+    if args.workers > 1:
+        run_sharded(args.workers, ssh_user, ssh_pass, snmp_community,
+                    api_name, api_host, api_port,
+                    controller_ip, controller_port,
+                    snmp_options=snmp_options,
+                    task_manager_options=task_manager_options)
+        return
+
     logger.info('Loading task_manager...')
-    task_manager = TaskManager(async_debug=False)
+    task_manager = TaskManager(async_debug=False,
+                               store=TaskStore('./tasks.json'),
+                               **task_manager_options)
     logger.info('Loading SNMP handler')
-    snmp_engine = Snmp(community=snmp_community)
+    snmp_engine = SnmpDispatcher(Snmp(community=snmp_community, **snmp_options))
 
     # If you want to add tasks before starting as a test place them here
     # task_manager.add(Ping('10.243.48.5', run_at=time(), recurrence_time=5))
@@ -34,6 +124,7 @@ def main():
 
     logger.info('Registering task manager to asyncio loop')
     asyncio.ensure_future(task_manager.process_tasks())
+    asyncio.ensure_future(task_manager.monitor_loop())
 
     logger.info('Loading REST API...')
     rest_api = RestApi(task_manager,
@@ -41,6 +132,9 @@ def main():
                        snmp_engine=snmp_engine,
                        ssh_user=ssh_user, ssh_pass=ssh_pass)
 
+    logger.info('Restoring stored tasks...')
+    task_manager.restore(rest_api.restore_task)
+
     try:
         # This will start the asyncio loop so the
         # task manager futures will run as well
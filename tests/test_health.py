@@ -0,0 +1,77 @@
+import pytest
+import poller.health
+from poller.health import HealthTracker, CircuitOpen
+
+
+class Clock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(poller.health, 'monotonic', clock)
+    return clock
+
+
+class TestHealthTracker:
+
+    def test_timeout_follows_rtt(self):
+        health = HealthTracker(min_timeout=.1, granularity=.05)
+        assert health.timeout('r1', 2) == 2
+
+        for i in range(20):
+            health.success('r1', .02)
+        assert health.timeout('r1', 2) == .1
+
+        for i in range(20):
+            health.success('r1', .5)
+        assert .5 < health.timeout('r1', 2) < 2
+        assert health.timeout('r1', .5) == .5
+
+    def test_circuit_opens_and_closes(self, clock):
+        health = HealthTracker(failure_threshold=3, open_interval=30,
+                               max_open_interval=60)
+        for i in range(3):
+            assert health.allow('r1')
+            health.failure('r1')
+
+        assert not health.allow('r1')
+        with pytest.raises(CircuitOpen):
+            health.check('r1')
+        assert health.allow('r2')
+
+        # A single health check per interval, failing doubles it
+        clock.now += 30
+        assert health.allow('r1')
+        assert not health.allow('r1')
+        health.failure('r1')
+        clock.now += 30
+        assert not health.allow('r1')
+        clock.now += 30
+        assert health.allow('r1')
+
+        health.success('r1', .01)
+        assert health.allow('r1') and health.allow('r1')
+        assert not health.is_open('r1')
+        assert health.skipped == 4
+
+    def test_in_flight_failures_dont_back_off(self, clock):
+        health = HealthTracker(failure_threshold=3, open_interval=30,
+                               max_open_interval=600)
+        for i in range(10):
+            health.failure('r1')
+
+        clock.now += 30
+        assert health.allow('r1')
+        health.failure('r1')
+        # Only the failed health check doubled the interval
+        clock.now += 59
+        assert not health.allow('r1')
+        clock.now += 1
+        assert health.allow('r1')
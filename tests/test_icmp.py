@@ -0,0 +1,225 @@
+import math
+import socket
+import struct
+import pytest
+from poller.icmp import IcmpEngine, checksum, echo_request, quoted_probe
+from poller.ip_tasks import PathTable, Ping, PingSweep, Trace
+
+
+def open_engine():
+    engine = IcmpEngine()
+    try:
+        engine.open()
+    except PermissionError:
+        pytest.skip('Not allowed to open an ICMP socket')
+    return engine
+
+
+class TestIcmpEngine:
+
+    def test_echo_request_checksum(self):
+        packet = echo_request(0x1234, 7)
+        assert len(packet) == 64
+        assert checksum(packet) == 0
+
+    def test_quoted_probe(self):
+        header = struct.pack('!BBHHHBBH4s4s', 0x45, 0, 84, 0, 0, 1, socket.IPPROTO_ICMP,
+                             0, socket.inet_aton('10.0.0.1'), socket.inet_aton('10.0.0.9'))
+        assert quoted_probe(header + echo_request(0x1234, 7)[:8]) == \
+            (socket.IPPROTO_ICMP, '10.0.0.9', 0x1234, 7)
+
+        header = header[:9] + bytes([socket.IPPROTO_UDP]) + header[10:]
+        assert quoted_probe(header + struct.pack('!HHHH', 40000, 33435, 40, 0)) == \
+            (socket.IPPROTO_UDP, '10.0.0.9', 40000, 33435)
+        assert quoted_probe(header[:12]) is None
+
+    @pytest.mark.asyncio
+    async def test_ping_localhost(self):
+        engine = open_engine()
+        rtts = await engine.ping('127.0.0.1', count=4, preload=2,
+                                 interval=.01, timeout=1)
+        assert len(rtts) == 4
+        assert all(rtt is not None and rtt < 1 for rtt in rtts)
+        assert engine.sent == engine.received == 4
+        assert not engine._pending and engine._timeouts.count == 0
+        engine.close()
+
+    @pytest.mark.asyncio
+    async def test_lost_requests(self):
+        engine = open_engine()
+        # Replies are never read
+        engine.loop.remove_reader(engine.sock.fileno())
+        rtts = await engine.ping('127.0.0.1', count=2, preload=2, timeout=.05)
+        assert rtts == [None, None]
+        assert not engine._pending
+        engine.close()
+
+    @pytest.mark.asyncio
+    async def test_sweep_rate(self):
+        engine = open_engine()
+        addresses = ['127.0.0.{}'.format(i) for i in range(1, 11)]
+        start = engine.loop.time()
+        rtts = await engine.sweep(addresses, count=2, interval=0, rate=100)
+        # 20 requests at 100 per second
+        assert engine.loop.time() - start >= .18
+        assert list(rtts) == addresses
+        assert all(len(host_rtts) == 2 and None not in host_rtts
+                   for host_rtts in rtts.values())
+        engine.close()
+
+    @pytest.mark.asyncio
+    async def test_trace_localhost(self):
+        engine = IcmpEngine()
+        hops = await engine.trace('127.0.0.1', max_hops=5, udp=True)
+        assert len(hops) == 1 and hops[0][0] == '127.0.0.1' and hops[0][2]
+
+        try:
+            engine.open()
+        except PermissionError:
+            pytest.skip('Not allowed to open an ICMP socket')
+        hops = await engine.trace('127.0.0.1', max_hops=5)
+        assert len(hops) == 1 and hops[0][0] == '127.0.0.1' and hops[0][2]
+        assert engine.sock.getsockopt(socket.IPPROTO_IP, socket.IP_TTL) > 5
+        engine.close()
+
+
+class TestTrace:
+
+    @pytest.mark.asyncio
+    async def test_run(self, monkeypatch):
+        monkeypatch.setattr(Trace, 'engine', IcmpEngine())
+        result = await Trace('127.0.0.1', max_hops=5).run()
+        assert result['hops'][0]['ip_address'] == '127.0.0.1'
+        assert float(result['hops'][0]['rtt']) < 1000
+        assert len(result['hops']) == 1
+        Trace.engine.close()
+
+    def test_changes_only(self, monkeypatch):
+        monkeypatch.setattr(Trace, 'paths', PathTable())
+        trace = Trace('10.0.0.9', changes_only=True)
+
+        def run(*hops):
+            result = {'hops': [{'ip_address': address, 'rtt': rtt} for address, rtt in hops]}
+            trace.compact(result)
+            trace.results.append(result)
+            return result
+
+        first = run(('10.0.0.1', '0.500'), ('10.0.0.9', '1.250'))
+        assert first['path_changed'] and first['hops'] == ['10.0.0.1', '10.0.0.9']
+        # A silent hop isn't a path change
+        same = run(('*', '*'), ('10.0.0.9', '1.000'))
+        assert (same['path_changed'], same['path_id']) == (False, first['path_id'])
+        assert 'hops' not in same
+        assert math.isnan(same['rtts'][0]) and same['rtts'][1] == 1.0
+        changed = run(('10.0.0.2', '0.400'), ('10.0.0.9', '1.000'))
+        assert changed['path_changed'] and changed['path_id'] != first['path_id']
+        assert run(('10.0.0.1', '0.500'), ('10.0.0.9', '1.250'))['path_id'] == first['path_id']
+
+        assert [result['path_changed'] for result in trace.results] == [True, False, True, True]
+        assert len(Trace.paths) == 2
+
+    def test_changes_only_completes_path(self, monkeypatch):
+        monkeypatch.setattr(Trace, 'paths', PathTable())
+        trace = Trace('10.0.0.9', changes_only=True)
+
+        def run(*hops):
+            result = {'hops': [{'ip_address': address, 'rtt': rtt} for address, rtt in hops]}
+            trace.compact(result)
+            return result
+
+        first = run(('*', '*'), ('10.0.0.9', '1.250'))
+        complete = run(('10.0.0.1', '0.500'), ('10.0.0.9', '1.250'))
+        assert complete['path_changed'] and complete['path_id'] != first['path_id']
+        assert complete['hops'] == ['10.0.0.1', '10.0.0.9']
+        assert not run(('*', '*'), ('10.0.0.9', '1.000'))['path_changed']
+
+
+class TestPathTable:
+
+    def test_drops_least_recently_used(self):
+        paths = PathTable(max_size=2)
+        first = paths.intern(('10.0.0.1',))
+        second = paths.intern(('10.0.0.2',))
+        assert paths.get(first) == ('10.0.0.1',)
+        third = paths.intern(('10.0.0.3',))
+
+        assert len(paths) == 2
+        assert paths.get(second) is None
+        assert paths.intern(('10.0.0.2',)) not in (first, second, third)
+
+    def test_merge(self):
+        assert PathTable.merge(('*', '10.0.0.9'), ('10.0.0.1', '*')) == ('10.0.0.1', '10.0.0.9')
+        assert PathTable.merge(('10.0.0.1',), ('10.0.0.2',)) is None
+        assert PathTable.merge(('10.0.0.1',), ('10.0.0.1', '10.0.0.9')) is None
+
+
+class TestPing:
+
+    def test_summarize(self):
+        result = {}
+        Ping.summarize([.001, None, .003], result)
+        assert result['packets_sent'] == 3 and result['packets_recv'] == 2
+        assert result['min'] == pytest.approx(1)
+        assert result['avg'] == pytest.approx(2)
+        assert result['max'] == pytest.approx(3)
+        assert result['mdev'] == pytest.approx(1)
+
+        assert list(result['rtts'][::2]) == pytest.approx([1, 3])
+        assert math.isnan(result['rtts'][1])
+        assert result['p50'] == pytest.approx(1)
+        assert result['loss_bursts'] == result['max_loss_burst'] == 1
+
+        result = {}
+        Ping.summarize([None], result)
+        assert result['error'] == 'Host unreachable'
+
+    def test_extract_rtts(self):
+        lines = [b'PING 10.0.0.1 (10.0.0.1) 56(84) bytes of data.',
+                 b'64 bytes from 10.0.0.1: icmp_seq=3 ttl=64 time=0.061 ms',
+                 b'64 bytes from 10.0.0.1: icmp_seq=1 ttl=64 time=0.045 ms',
+                 b'3 packets transmitted, 2 received, 33% packet loss, time 2002ms']
+        assert Ping('10.0.0.1', count=3).extract_rtts(lines) == [0.045, None, 0.061]
+
+    def test_roll_up(self):
+        ping = Ping('10.0.0.1', rollup=2)
+        results = []
+        for rtts in ([.001, None], [.002, .003]):
+            result = {}
+            ping.summarize(rtts, result)
+            ping.roll_up(result)
+            results.append(result)
+
+        assert 'rollup' not in results[0]
+        rollup = results[1]['rollup']
+        assert rollup['runs'] == 2
+        assert rollup['packets_sent'] == 4 and rollup['packets_recv'] == 3
+        assert rollup['p50'] == pytest.approx(2, rel=.05)
+        assert ping._runs == 0 and ping._histogram.sent == 0
+
+
+class TestPingSweep:
+
+    @pytest.mark.asyncio
+    async def test_addresses(self):
+        sweep = PingSweep(['127.0.0.0/30', '127.0.0.2', 'localhost'])
+        assert await sweep.addresses() == ['127.0.0.1', '127.0.0.2']
+
+        with pytest.raises(ValueError):
+            await PingSweep('10.0.0.0/8').addresses()
+
+    @pytest.mark.asyncio
+    async def test_run(self, monkeypatch):
+        monkeypatch.setattr(PingSweep, 'icmp', open_engine())
+        sweep = PingSweep('127.0.0.0/29', count=2, interval=.01)
+        result = await sweep.run()
+        assert result['hosts_total'] == result['hosts_alive'] == 6
+        assert result['packets_sent'] == result['packets_recv'] == 12
+        assert result['hosts']['127.0.0.6'][0] == 2
+        PingSweep.icmp.close()
+
+    def test_summarize(self):
+        result = {}
+        PingSweep.summarize({'10.0.0.1': [.001, .003], '10.0.0.2': [None]}, result)
+        assert result['hosts'] == {'10.0.0.1': [2, 1, 2, 3]}
+        assert result['hosts_total'] == 2 and result['hosts_alive'] == 1
+        assert result['packets_sent'] == 3 and result['packets_recv'] == 2
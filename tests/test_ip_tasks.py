@@ -1,6 +1,7 @@
 import poller
 import pytest
 import asyncio
+import sys
 
 
 class TestPyPerf:
@@ -10,3 +11,11 @@ class TestPyPerf:
         task = poller.ip_tasks.Ping(device='127.0.0.1')
         result = await task.run()
         assert 'start_timestamp' in result
+
+    def test_ping_is_compact(self):
+        task = poller.ip_tasks.Ping(device=''.join(['127.0.0', '.1']), count='5')
+        assert not hasattr(task, '__dict__')
+        assert task.device is sys.intern('127.0.0.1')
+        assert task.count == 5
+        assert task.type == task.name == 'Ping'
+        assert task.to_json()['type'] == 'Ping'
@@ -0,0 +1,28 @@
+import poller
+from poller.metrics import Metrics
+
+
+class TestMetrics:
+
+    def test_render_counter_and_histogram(self):
+        metrics = Metrics()
+        counter = metrics.counter('tasks_total', 'Finished tasks', ('type',))
+        histogram = metrics.histogram('lateness_seconds', 'Lateness',
+                                      buckets=(.1, 1))
+        metrics.gauge('tasks_scheduled', 'Scheduled tasks', lambda: 3)
+
+        counter.inc('Ping')
+        counter.inc('Ping')
+        histogram.observe(.05)
+        histogram.observe(.5)
+        histogram.observe(5)
+
+        text = metrics.render()
+        assert '# TYPE tasks_total counter' in text
+        assert 'tasks_total{type="Ping"} 2.0' in text
+        assert 'lateness_seconds_bucket{le="0.1"} 1.0' in text
+        assert 'lateness_seconds_bucket{le="1.0"} 2.0' in text
+        assert 'lateness_seconds_bucket{le="+Inf"} 3.0' in text
+        assert 'lateness_seconds_count 3.0' in text
+        assert 'lateness_seconds_sum 5.55' in text
+        assert 'tasks_scheduled 3.0' in text
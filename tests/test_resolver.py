@@ -0,0 +1,47 @@
+import poller
+import pytest
+import asyncio
+import socket
+from poller.resolver import Resolver, ResolveError
+
+
+class TestResolver:
+
+    @pytest.fixture
+    def lookups(self, monkeypatch):
+        lookups = []
+
+        async def getaddrinfo(loop, host, port, **kwargs):
+            lookups.append(host)
+            await asyncio.sleep(0.01)
+            if host == 'unknown.example':
+                raise socket.gaierror('Name or service not known')
+            return [(socket.AF_INET, socket.SOCK_DGRAM, 17, '', ('192.0.2.1', 0))]
+
+        monkeypatch.setattr(asyncio.BaseEventLoop, 'getaddrinfo', getaddrinfo)
+        return lookups
+
+    @pytest.mark.asyncio
+    async def test_lookups_are_cached_and_shared(self, lookups):
+        resolver = Resolver()
+        addresses = await asyncio.gather(*[resolver.resolve('router.example')
+                                           for i in range(5)])
+        assert addresses == ['192.0.2.1'] * 5
+        assert await resolver.resolve('router.example') == '192.0.2.1'
+        assert lookups == ['router.example']
+        assert resolver.hits == 1
+
+    @pytest.mark.asyncio
+    async def test_failed_lookups_are_cached(self, lookups):
+        resolver = Resolver()
+        for i in range(3):
+            with pytest.raises(ResolveError):
+                await resolver.resolve('unknown.example')
+        assert lookups == ['unknown.example']
+        assert resolver.negative_hits == 2
+
+    @pytest.mark.asyncio
+    async def test_addresses_are_not_looked_up(self, lookups):
+        resolver = Resolver()
+        assert await resolver.resolve('10.0.0.1') == '10.0.0.1'
+        assert lookups == []
@@ -0,0 +1,43 @@
+import poller
+import pytest
+import asyncio
+from aiohttp.test_utils import TestClient, TestServer
+
+
+def rest_api():
+    manager = poller.TaskManager(loop=asyncio.get_event_loop())
+    return poller.RestApi(manager, snmp_engine=object(),
+                          loop=asyncio.get_event_loop())
+
+
+class TestRestApi:
+
+    @pytest.mark.asyncio
+    @pytest.mark.parametrize('data', [
+        {'type': 'SystemInfoProbe', 'device': '10.0.0.1',
+         'changes_only': True, 'refresh_age': 3600},
+        {'type': 'InterfaceOctetsProbe', 'device': '10.0.0.1', 'if_index': 2,
+         'counters': ['ifInErrors']},
+        {'type': 'InterfaceTableProbe', 'device': '10.0.0.1',
+         'if_indexes': [1, 2]},
+    ], ids=lambda data: data['type'])
+    async def test_post_snmp_tasks(self, data):
+        api = rest_api()
+        data = dict(data, _id='task', run_at=1e10)
+        async with TestClient(TestServer(api.app)) as client:
+            response = await client.post('/tasks', json=data)
+            assert response.status == 204
+
+        task = api.task_manager.get('task')
+        assert task.type == data['type']
+        assert task.snmp is api.snmp_engine
+
+    @pytest.mark.asyncio
+    async def test_post_invalid_task(self):
+        api = rest_api()
+        async with TestClient(TestServer(api.app)) as client:
+            response = await client.post('/tasks', json={'type': 'Ping'})
+            assert response.status == 400
+            response = await client.post('/tasks', json={'type': 'Unknown'})
+            assert response.status == 501
+        assert api.task_manager.tasks() == []
@@ -0,0 +1,65 @@
+import poller
+import pytest
+import asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from poller.metrics import Metrics, merge_metrics
+from poller.shards import ShardRouter, shard_for
+
+
+class TestShards:
+
+    def test_shard_for_is_stable_per_device(self):
+        ping = {'type': 'Ping', 'device': '10.0.0.1', '_id': 1}
+        trace = {'type': 'Trace', 'device': '10.0.0.1', '_id': 2}
+        assert shard_for(ping, 4) == shard_for(trace, 4)
+
+        shards = {shard_for({'device': '10.0.0.{}'.format(i)}, 4)
+                  for i in range(100)}
+        assert shards == {0, 1, 2, 3}
+
+    def test_shard_for_uses_url_host(self):
+        assert (shard_for({'url': 'http://example.com/a'}, 8) ==
+                shard_for({'url': 'https://example.com/b'}, 8))
+
+    @pytest.mark.asyncio
+    async def test_router_keeps_device_on_one_shard(self):
+        loop = asyncio.get_event_loop()
+        workers = [poller.RestApi(poller.TaskManager(loop=loop), loop=loop)
+                   for shard in range(4)]
+        servers = [TestServer(worker.app) for worker in workers]
+        for server in servers:
+            await server.start_server()
+
+        router = ShardRouter([(server.host, server.port) for server in servers],
+                             loop=loop)
+        async with TestClient(TestServer(router.app)) as client:
+            for task_id in range(8):
+                response = await client.post('/tasks', json={
+                    'type': 'Ping', 'device': '10.0.0.1', '_id': task_id,
+                    'run_at': 1e10})
+                assert response.status == 204
+
+            response = await client.get('/tasks/5')
+            assert (await response.json())['_id'] == 5
+            response = await client.delete('/tasks', json={'task_id': 5})
+            assert response.status == 204
+
+        await router.session.close()
+        for server in servers:
+            await server.close()
+
+        counts = [len(worker.task_manager.tasks()) for worker in workers]
+        assert sorted(counts) == [0, 0, 0, 7]
+
+    def test_merge_metrics_groups_shards(self):
+        texts = []
+        for shard in range(2):
+            metrics = Metrics(labels={'shard': shard})
+            metrics.gauge('poller_tasks_scheduled', 'Scheduled', lambda: shard)
+            texts.append(metrics.render())
+
+        lines = merge_metrics(texts).splitlines()
+        assert lines == ['# HELP poller_tasks_scheduled Scheduled',
+                         '# TYPE poller_tasks_scheduled gauge',
+                         'poller_tasks_scheduled{shard="0"} 0.0',
+                         'poller_tasks_scheduled{shard="1"} 1.0']
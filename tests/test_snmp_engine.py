@@ -0,0 +1,129 @@
+import asyncio
+import pytest
+from pyasn1.codec.ber import decoder
+from pysnmp.proto import api
+from poller.snmp_engine import (COUNTER64, OCTET_STRING, GET_REQUEST, GET_BULK_REQUEST,
+                                RESPONSE, NULL_VALUE, SnmpClient, SnmpTimeout,
+                                decode_message, encode_message, encode_value,
+                                endOfMibView)
+from poller.snmp_tasks import Snmp, parse_oid
+
+
+class Agent(asyncio.DatagramProtocol):
+    """ Answers GET and GET BULK requests from a dict of OID tuple to
+    (tag, value) """
+
+    def __init__(self, mib):
+        self.mib = mib
+        self.oids = sorted(mib)
+        self.silent = False
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def _value(self, oid):
+        return encode_value(*self.mib[oid])
+
+    def datagram_received(self, data, address):
+        community, pdu_tag, request_id, field1, field2, varbinds = decode_message(data)
+        if self.silent:
+            return
+
+        response = []
+        if pdu_tag == GET_REQUEST:
+            response = [(oid, self._value(oid)) for oid, tag, value in varbinds]
+        elif pdu_tag == GET_BULK_REQUEST:
+            positions = [oid for oid, tag, value in varbinds]
+            for repetition in range(field2):
+                for column, position in enumerate(positions):
+                    successors = [oid for oid in self.oids if oid > position]
+                    if successors:
+                        positions[column] = successors[0]
+                        response.append((successors[0], self._value(successors[0])))
+                    else:
+                        response.append((position, encode_value(None, endOfMibView)))
+
+        self.transport.sendto(encode_message(community, RESPONSE, request_id,
+                                             0, 0, response), address)
+
+
+async def start_agent():
+    loop = asyncio.get_event_loop()
+    mib = {parse_oid('1.3.6.1.2.1.1.1.0'): (OCTET_STRING, b'router'),
+           parse_oid('1.3.6.1.2.1.1.5.0'): (OCTET_STRING, b'r1'),
+           parse_oid('1.3.6.1.2.1.10.7.1'): (OCTET_STRING, b'other')}
+    for if_index in range(1, 50):
+        mib[parse_oid('1.3.6.1.2.1.31.1.1.1.6.{}'.format(if_index))] = \
+            (COUNTER64, 2 ** 64 - if_index)
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: Agent(mib), local_addr=('127.0.0.1', 0))
+    protocol.port = transport.get_extra_info('sockname')[1]
+    return protocol
+
+
+class TestBer:
+
+    def test_message_decodes_with_pysnmp(self):
+        message = encode_message(b'public', GET_REQUEST, 1234, 0, 0,
+                                 [(parse_oid('1.3.6.1.2.1.31.1.1.1.6.300'), NULL_VALUE)])
+        pmod = api.protoModules[api.protoVersion2c]
+        decoded, rest = decoder.decode(message, asn1Spec=pmod.Message())
+        pdu = pmod.apiMessage.getPDU(decoded)
+        assert pmod.apiPDU.getRequestID(pdu) == 1234
+        assert str(pmod.apiPDU.getVarBinds(pdu)[0][0]) == '1.3.6.1.2.1.31.1.1.1.6.300'
+
+        assert decode_message(message) == (b'public', GET_REQUEST, 1234, 0, 0,
+                                           [(parse_oid('1.3.6.1.2.1.31.1.1.1.6.300'),
+                                             0x05, None)])
+
+
+class TestSnmpClient:
+
+    @pytest.mark.asyncio
+    async def test_get_and_walk(self):
+        agent = await start_agent()
+        snmp = Snmp(native=True, port=agent.port)
+        response = await snmp._get_multi('127.0.0.1', ['1.3.6.1.2.1.1.5.0',
+                                                       '1.3.6.1.2.1.31.1.1.1.6.3'])
+        assert response == {'values': {'1.3.6.1.2.1.1.5.0': b'r1',
+                                       '1.3.6.1.2.1.31.1.1.1.6.3': 2 ** 64 - 3}}
+
+        result = await snmp._get_bulk('127.0.0.1', '1.3.6.1.2.1.1')
+        assert result == {'1.3.6.1.2.1.1.1.0': b'router', '1.3.6.1.2.1.1.5.0': b'r1'}
+
+        rows = [row async for row in snmp.walk('127.0.0.1', ['1.3.6.1.2.1.31.1.1.1.6'])]
+        assert len(rows) == 49
+        assert snmp.client.sent == snmp.client.received
+        assert snmp.fallbacks == 0
+        snmp.shutdown()
+        agent.transport.close()
+
+    @pytest.mark.asyncio
+    async def test_timeout_and_retries(self):
+        agent = await start_agent()
+        agent.silent = True
+        client = SnmpClient(resolution=.01)
+        with pytest.raises(SnmpTimeout):
+            await client.get(('127.0.0.1', agent.port), 'public',
+                             [parse_oid('1.3.6.1.2.1.1.5.0')], timeout=.05, retries=2)
+        assert client.sent == 3
+        assert client.timeouts == 1
+        assert client._timeouts.count == 0
+        client.close()
+        agent.transport.close()
+
+    @pytest.mark.asyncio
+    async def test_dead_device_circuit(self):
+        agent = await start_agent()
+        agent.silent = True
+        snmp = Snmp(native=True, port=agent.port, timeout=.05)
+        snmp.client._timeouts.resolution = .01
+        for i in range(3):
+            response = await snmp._get('127.0.0.1', '1.3.6.1.2.1.1.5.0')
+            assert response['error'] == str(SnmpTimeout())
+
+        response = await snmp._get('127.0.0.1', '1.3.6.1.2.1.1.5.0')
+        assert response['error'].startswith('Circuit open')
+        assert snmp.client.sent == 3
+        snmp.shutdown()
+        agent.transport.close()
@@ -0,0 +1,396 @@
+import poller
+import pytest
+import asyncio
+import time
+from pysnmp.proto import rfc1902, rfc1905
+from poller.resolver import Resolver
+from poller.snmp_engine import Oid, endOfMibView
+from poller.snmp_tasks import (InterfaceOctetsProbe, InterfaceTableProbe,
+                               Snmp, SnmpDispatcher, SnmpError, SystemInfoProbe,
+                               native_value, parse_oid, uptime_interval)
+
+
+class FakeSnmp:
+    """ Stands in for Snmp and answers from a dict of OID values """
+
+    def __init__(self, values):
+        self.values = values
+        self.requests = []
+
+    async def _get_multi(self, device, oids, **kwargs):
+        self.requests.append(oids)
+        return {'values': {oid: self.values.get(oid) for oid in oids}}
+
+
+class TestPyPerf:
+
+    @pytest.mark.asyncio
+    async def test_interface_counters_in_single_get(self):
+        snmp = FakeSnmp({'1.3.6.1.2.1.31.1.1.1.6.3': 1000,
+                         '1.3.6.1.2.1.31.1.1.1.10.3': 2000,
+                         '1.3.6.1.2.1.2.2.1.14.3': 5})
+        task = InterfaceOctetsProbe('10.0.0.1', 3, snmp,
+                                    counters=['ifInErrors', 'ifOutErrors'])
+        await task.run()
+
+        assert len(snmp.requests) == 1
+        result = task.results[-1]
+        assert result['ifHCInOctets'] == 1000
+        assert result['ifHCOutOctets'] == 2000
+        assert result['ifInErrors'] == 5
+        assert 'ifOutErrors' not in result
+        assert task.to_json()['counters'] == ['ifInErrors', 'ifOutErrors']
+
+    def test_unknown_counter(self):
+        with pytest.raises(ValueError):
+            InterfaceOctetsProbe('10.0.0.1', 3, None, counters=['ifSpeed'])
+
+
+class TooBigSnmp(FakeSnmp):
+    """ Answers tooBig for PDUs with more than 2 varbinds """
+
+    async def _get_multi(self, device, oids, **kwargs):
+        if len(oids) > 2:
+            self.requests.append(oids)
+            return {'error': 'tooBig'}
+        return await super()._get_multi(device, oids, **kwargs)
+
+
+class TestSnmpDispatcher:
+
+    @pytest.mark.asyncio
+    async def test_requests_are_coalesced_per_device(self):
+        values = {}
+        for if_index in range(48):
+            values['1.3.6.1.2.1.31.1.1.1.6.{}'.format(if_index)] = if_index
+            values['1.3.6.1.2.1.31.1.1.1.10.{}'.format(if_index)] = if_index * 2
+        snmp = FakeSnmp(values)
+        dispatcher = SnmpDispatcher(snmp, max_varbinds=40)
+
+        tasks = [InterfaceOctetsProbe('10.0.0.1', if_index, dispatcher)
+                 for if_index in range(48)]
+        tasks.append(InterfaceOctetsProbe('10.0.0.2', 1, dispatcher))
+        await asyncio.gather(*[task.run() for task in tasks])
+
+        # 96 OIDs for the first device in 3 PDUs, 1 PDU for the second
+        assert dispatcher.requests == 49
+        assert len(snmp.requests) == 4
+        assert tasks[47].results[-1]['ifHCOutOctets'] == 94
+
+    @pytest.mark.asyncio
+    async def test_too_big_pdus_are_split(self):
+        snmp = TooBigSnmp({'1': 'a', '2': 'b', '3': 'c'})
+        dispatcher = SnmpDispatcher(snmp)
+        first, second = await asyncio.gather(dispatcher._get_multi('d', ['1', '2']),
+                                             dispatcher._get('d', '3'))
+        assert first == {'values': {'1': 'a', '2': 'b'}}
+        assert second == {'value': 'c'}
+
+
+class TestSnmpCache:
+
+    def test_uptime_interval(self):
+        wrap = 2 ** 32 / 100
+        assert uptime_interval(120, 100, 20) == 20
+        assert uptime_interval(5, wrap - 5, 10) == pytest.approx(10)
+        assert uptime_interval(5, 1000, 10) is None
+        assert uptime_interval(5, wrap - 5, 3600) is None
+
+    def test_native_values(self):
+        assert native_value(rfc1902.Counter64(2 ** 64 - 1)) == 2 ** 64 - 1
+        assert native_value(rfc1902.TimeTicks(12345)) == 12345
+        assert native_value(rfc1902.OctetString(b'\xff\x00')) == b'\xff\x00'
+        assert native_value(rfc1902.IpAddress('10.0.0.1')) == '10.0.0.1'
+        oid = native_value(rfc1902.ObjectIdentifier('1.3.6.1.4.1.9'))
+        assert oid == (1, 3, 6, 1, 4, 1, 9) and isinstance(oid, Oid)
+        assert native_value(rfc1905.endOfMibView) is endOfMibView
+
+    def test_targets_are_cached_per_settings(self):
+        snmp = Snmp()
+        target = snmp._target('127.0.0.1', 1, 0)
+        assert snmp._target('127.0.0.1', 1, 0) is target
+        assert snmp._target('127.0.0.1', 2, 0) is not target
+        assert snmp._object_type('1.3.6.1.2.1.1.3.0') is snmp._object_type('1.3.6.1.2.1.1.3.0')
+
+        snmp.invalidate(device='127.0.0.1')
+        assert snmp._target('127.0.0.1', 1, 0) is not target
+
+    def test_invalidate_resolves_device_name(self):
+        snmp = Snmp(resolver=Resolver())
+        snmp.resolver._cache.set('router', '10.0.0.1')
+        target = snmp._target('10.0.0.1', 1, 0)
+        snmp._repetitions.set('10.0.0.1', 50)
+
+        snmp.invalidate(device='router')
+        assert snmp._target('10.0.0.1', 1, 0) is not target
+        assert snmp._repetitions.get('10.0.0.1') is None
+
+
+class WalkSnmp(Snmp):
+    """ Answers GET BULK requests from a sorted list of OIDs """
+
+    def __init__(self, oids, max_answer=None, **kwargs):
+        super().__init__(**kwargs)
+        self.mib = sorted(parse_oid(oid) for oid in oids)
+        self.max_answer = max_answer
+        self.error = 'No SNMP response received before timeout'
+        self.requests = []
+
+    async def _send_bulk(self, address, community, timeout, retries,
+                         max_repetitions, oids):
+        self.requests.append((max_repetitions, oids))
+        if self.max_answer is not None and max_repetitions > self.max_answer:
+            return self.error, True, None
+
+        columns = []
+        for oid in oids:
+            successors = [(mib_oid, mib_oid[-1]) for mib_oid in self.mib
+                          if mib_oid > oid][:max_repetitions]
+            successors += [(oid, endOfMibView)] * (max_repetitions - len(successors))
+            columns.append(successors)
+        return None, False, [list(row) for row in zip(*columns)]
+
+
+class TestSnmpWalk:
+
+    @pytest.mark.asyncio
+    async def test_walk_stops_at_numeric_subtree_end(self):
+        snmp = WalkSnmp(['1.3.6.1.2.1.1.{}.0'.format(i) for i in range(1, 8)] +
+                        ['1.3.6.1.2.1.10.7.2.1.1', '1.3.6.1.2.1.11.1.0'],
+                        max_repetitions=3)
+        result = await snmp._get_bulk('10.0.0.1', '1.3.6.1.2.1.1')
+        assert sorted(result) == ['1.3.6.1.2.1.1.{}.0'.format(i) for i in range(1, 8)]
+        assert result['1.3.6.1.2.1.1.3.0'] == 0
+
+    @pytest.mark.asyncio
+    async def test_columns_are_walked_in_parallel(self):
+        oids = ['1.3.6.1.2.1.31.1.1.1.6.{}'.format(i) for i in range(1, 11)]
+        oids += ['1.3.6.1.2.1.31.1.1.1.10.{}'.format(i) for i in range(1, 11)
+                 if i != 4]
+        snmp = WalkSnmp(oids, max_repetitions=4)
+
+        rows = [row async for row in snmp.walk('10.0.0.1',
+                                               ['1.3.6.1.2.1.31.1.1.1.6',
+                                                '1.3.6.1.2.1.31.1.1.1.10'])]
+        assert [index for index, values in rows] == [(i,) for i in range(1, 11)]
+        assert rows[3][1] == {'1.3.6.1.2.1.31.1.1.1.6': 4}
+        assert len(rows[4][1]) == 2
+        # Both columns in every request, max_repetitions grows
+        assert all(len(request_oids) == 2 for repetitions, request_oids in snmp.requests)
+        assert snmp.requests[1][0] > snmp.requests[0][0]
+
+    @pytest.mark.asyncio
+    async def test_max_repetitions_backs_off_on_too_big(self):
+        snmp = WalkSnmp(['1.3.6.1.2.1.2.2.1.1.{}'.format(i) for i in range(1, 50)],
+                        max_answer=5, max_repetitions=20)
+        snmp.error = 'tooBig'
+        result = await snmp._get_bulk('10.0.0.1', '1.3.6.1.2.1.2.2.1.1')
+        assert len(result) == 49
+        assert [repetitions for repetitions, oids in snmp.requests][:3] == [20, 10, 5]
+        assert snmp._repetitions.get('10.0.0.1') <= 5
+
+    @pytest.mark.asyncio
+    async def test_only_first_timeout_is_retried(self):
+        snmp = WalkSnmp(['1.3.6.1.2.1.2.2.1.1.{}'.format(i) for i in range(1, 50)],
+                        max_answer=0, max_repetitions=20)
+        with pytest.raises(SnmpError):
+            async for row in snmp.walk('10.0.0.1', ['1.3.6.1.2.1.2.2.1.1']):
+                pass
+        assert [repetitions for repetitions, oids in snmp.requests] == [20, 10]
+
+        # Nothing is sent once the circuit of the device is open
+        for i in range(3):
+            snmp.health.failure('10.0.0.1')
+        with pytest.raises(SnmpError):
+            async for row in snmp.walk('10.0.0.1', ['1.3.6.1.2.1.2.2.1.1']):
+                pass
+        assert len(snmp.requests) == 2
+
+
+class TableSnmp:
+    """ Stands in for Snmp with an interface table """
+
+    def __init__(self):
+        self.uptime = 100
+        # if_index -> (name, in octets, out octets)
+        self.interfaces = {}
+
+    async def _get(self, device, oid, **kwargs):
+        return {'value': self.uptime}
+
+    async def _get_multi(self, device, oids, **kwargs):
+        values = {}
+        for oid in oids:
+            if oid == InterfaceTableProbe.uptime_oid:
+                values[oid] = self.uptime
+                continue
+            column, if_index = oid.rsplit('.', 1)
+            interface = self.interfaces.get(int(if_index))
+            position = list(InterfaceTableProbe.columns.values()).index(column)
+            values[oid] = interface[position] if interface else None
+        return {'values': values}
+
+    async def walk(self, device, oids, **kwargs):
+        for if_index, interface in sorted(self.interfaces.items()):
+            yield (if_index,), dict(zip(oids, interface))
+
+
+class TestInterfaceTableProbe:
+
+    @pytest.mark.asyncio
+    async def test_rates(self):
+        snmp = TableSnmp()
+        snmp.interfaces = {1: (b'eth0', 1000, 2000),
+                           2: (b'eth1', 2 ** 64 - 1000, 0),
+                           3: (b'eth2', 0, 0)}
+        task = InterfaceTableProbe('10.0.0.1', snmp)
+        await task.run()
+        assert 'in_bps' not in task.results[-1]['interfaces'][0]
+
+        # 10 seconds later, eth1 was reset and eth2 moved to another if_index
+        snmp.uptime += 1000
+        snmp.interfaces = {1: (b'eth0', 2000, 4000),
+                           2: (b'eth1', 1500, 0),
+                           3: (b'eth3', 0, 0),
+                           4: (b'eth2', 0, 0)}
+        await task.run()
+        eth0, eth1, eth3, eth2 = task.results[-1]['interfaces']
+        assert eth0['in_bps'] == 800 and eth0['out_bps'] == 1600
+        assert 'in_bps' not in eth1 and eth1['out_bps'] == 0
+        assert 'in_bps' not in eth3 and 'in_bps' not in eth2
+        assert task.results[-1]['interface_count'] == 4
+
+        # Reboot, the counters restarted
+        snmp.uptime = 50
+        await task.run()
+        assert task.results[-1]['rebooted']
+        assert all('in_bps' not in interface
+                   for interface in task.results[-1]['interfaces'])
+
+    @pytest.mark.asyncio
+    async def test_uptime_wrap(self, monkeypatch):
+        snmp = TableSnmp()
+        snmp.uptime = 2 ** 32 - 500
+        snmp.interfaces = {1: (b'eth0', 1000, 2000)}
+        task = InterfaceTableProbe('10.0.0.1', snmp)
+        await task.run()
+
+        # sysUpTime wrapped 10 seconds later
+        now = time.time()
+        monkeypatch.setattr(poller.snmp_tasks, 'time', lambda: now + 10)
+        snmp.uptime = 500
+        snmp.interfaces = {1: (b'eth0', 2000, 4000)}
+        await task.run()
+        result = task.results[-1]
+        assert 'rebooted' not in result
+        assert result['interfaces'][0]['in_bps'] == pytest.approx(800)
+
+    @pytest.mark.asyncio
+    async def test_filtered_if_indexes(self):
+        snmp = TableSnmp()
+        snmp.interfaces = {i: ('eth{}'.format(i).encode(), i * 100, 0) for i in range(1, 40)}
+        task = InterfaceTableProbe('10.0.0.1', snmp, if_indexes=[30, 2])
+        await task.run()
+        snmp.uptime += 100
+        snmp.interfaces[30] = (b'eth30', 4000, 0)
+        await task.run()
+
+        interfaces = task.results[-1]['interfaces']
+        assert [interface['if_index'] for interface in interfaces] == [2, 30]
+        assert interfaces[1]['in_bps'] == 1000 * 8
+        assert task.to_json()['if_indexes'] == [2, 30]
+
+
+class SystemSnmp:
+    """ Stands in for Snmp with the system subtree """
+
+    def __init__(self):
+        self.system = {'1.3.6.1.2.1.1.{}.0'.format(i): b'value' for i in range(1, 8)}
+        self.system['1.3.6.1.2.1.1.3.0'] = 100
+        self.gets = 0
+        self.walks = 0
+        self.fail_walks = False
+
+    async def _get(self, device, oid, **kwargs):
+        self.gets += 1
+        return {'value': self.system[oid]}
+
+    async def _get_bulk(self, device, oid, **kwargs):
+        self.walks += 1
+        if self.fail_walks:
+            return {'error': 'No SNMP response received before timeout'}
+        return dict(self.system)
+
+
+class TestSystemInfoProbe:
+
+    @pytest.mark.asyncio
+    async def test_failed_reboot_walk_is_retried(self):
+        snmp = SystemSnmp()
+        task = SystemInfoProbe('10.0.0.1', snmp, changes_only=True)
+        await task.run()
+
+        snmp.system['1.3.6.1.2.1.1.3.0'] = 50
+        snmp.system['1.3.6.1.2.1.1.5.0'] = b'renamed'
+        snmp.fail_walks = True
+        await task.run()
+        assert 'error' in task.results[-1]
+
+        snmp.fail_walks = False
+        await task.run()
+        assert snmp.walks == 3
+        assert task.results[-1]['name'] == b'renamed'
+
+    @pytest.mark.asyncio
+    async def test_only_changes_are_stored(self, monkeypatch):
+        snmp = SystemSnmp()
+        task = SystemInfoProbe('10.0.0.1', snmp, changes_only=True, refresh_age=3600)
+        await task.run()
+        assert task.results[-1]['name'] == b'value'
+        assert task.results[-1]['uptime'] == 1
+
+        snmp.system['1.3.6.1.2.1.1.3.0'] = 200
+        snmp.system['1.3.6.1.2.1.1.5.0'] = b'renamed'
+        await task.run()
+        assert snmp.walks == 1 and snmp.gets == 1
+        assert task.results[-1]['uptime'] == 2
+        assert 'name' not in task.results[-1]
+
+        # Reboot, only the changed name is stored
+        snmp.system['1.3.6.1.2.1.1.3.0'] = 50
+        await task.run()
+        result = task.results[-1]
+        assert snmp.walks == 2
+        assert result['rebooted'] and result['name'] == b'renamed'
+        assert 'description' not in result
+
+        # Refresh after refresh_age
+        now = time.time()
+        monkeypatch.setattr(poller.snmp_tasks, 'time', lambda: now + 3600)
+        await task.run()
+        assert snmp.walks == 3
+
+    @pytest.mark.asyncio
+    async def test_reboot_during_refresh(self):
+        snmp = SystemSnmp()
+        task = SystemInfoProbe('10.0.0.1', snmp, changes_only=True, refresh_age=0)
+        await task.run()
+        assert 'rebooted' not in task.results[-1]
+
+        snmp.system['1.3.6.1.2.1.1.3.0'] = 50
+        await task.run()
+        assert snmp.walks == 2 and snmp.gets == 0
+        assert task.results[-1]['rebooted']
+
+        snmp.system['1.3.6.1.2.1.1.3.0'] = 80
+        await task.run()
+        assert 'rebooted' not in task.results[-1]
+
+    @pytest.mark.asyncio
+    async def test_reboot_without_changes_only(self):
+        snmp = SystemSnmp()
+        task = SystemInfoProbe('10.0.0.1', snmp)
+        await task.run()
+        snmp.system['1.3.6.1.2.1.1.3.0'] = 50
+        await task.run()
+        assert task.results[-1]['rebooted']
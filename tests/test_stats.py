@@ -0,0 +1,41 @@
+import math
+from poller.stats import RttHistogram, percentile, rtt_statistics
+
+
+class TestRttStatistics:
+
+    def test_statistics(self):
+        rtts = [1.0, None, None, 3.0, float('nan'), 2.0, 4.0]
+        statistics = rtt_statistics(rtts)
+        assert statistics['p50'] == 2.0
+        assert statistics['p95'] == statistics['p99'] == 4.0
+        # |3 - 1| + |2 - 3| + |4 - 2| over 3 differences
+        assert statistics['jitter'] == 5 / 3
+        assert statistics['loss_bursts'] == 2
+        assert statistics['max_loss_burst'] == 2
+
+        assert rtt_statistics([None, None]) == {'loss_bursts': 1, 'max_loss_burst': 2}
+
+    def test_percentile(self):
+        ordered = list(range(1, 101))
+        assert percentile(ordered, .5) == 50
+        assert percentile(ordered, .99) == 99
+        assert percentile([], .5) is None
+
+
+class TestRttHistogram:
+
+    def test_percentiles_within_bucket_width(self):
+        histogram = RttHistogram()
+        for run in range(100):
+            histogram.add([run + 1.0, None if run % 10 == 0 else 500.0], max_loss_burst=1)
+
+        summary = histogram.summary()
+        assert summary['packets_sent'] == 200 and summary['packets_recv'] == 190
+        assert summary['max_loss_burst'] == 1
+        assert math.isclose(summary['p50'], 95, rel_tol=.05)
+        assert math.isclose(summary['p99'], 500, rel_tol=.05)
+        assert summary['p99'] >= 500
+
+        histogram.reset()
+        assert histogram.summary()['p50'] is None
@@ -1,5 +1,19 @@
 import poller
 import pytest
+import asyncio
+from collections import Counter
+from time import time
+
+
+class RecordingTask(poller.Task):
+    """ Task that records the time it was started """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.started = []
+
+    async def run(self):
+        self.started.append(time())
 
 
 class TestPyPerf:
@@ -7,3 +21,199 @@ class TestPyPerf:
     def test_init_task_manager(self):
         manager = poller.TaskManager()
         assert manager
+
+    @pytest.mark.asyncio
+    async def test_schedule_runs_due_tasks_in_order(self):
+        manager = poller.TaskManager(loop=asyncio.get_event_loop())
+        now = time()
+        late = RecordingTask(_id=1, run_at=now + 0.2)
+        early = RecordingTask(_id=2, run_at=now + 0.05)
+        manager.add(late)
+        manager.add(early)
+        assert [task._id for task in manager.tasks()] == [2, 1]
+
+        processor = asyncio.ensure_future(manager.process_tasks())
+        await asyncio.sleep(0.1)
+        assert early.started and not late.started
+        await asyncio.sleep(0.2)
+        processor.cancel()
+
+        assert late.started
+        assert late.started[0] - late.run_at < 0.05
+        assert manager.tasks() == []
+
+    @pytest.mark.asyncio
+    async def test_add_wakes_up_scheduler(self):
+        manager = poller.TaskManager(loop=asyncio.get_event_loop())
+        manager.add(RecordingTask(_id=1, run_at=time() + 60))
+        processor = asyncio.ensure_future(manager.process_tasks())
+        await asyncio.sleep(0.01)
+
+        task = RecordingTask(_id=2)
+        manager.add(task)
+        await asyncio.sleep(0.01)
+        processor.cancel()
+
+        assert task.started
+        assert [task._id for task in manager.tasks()] == [1]
+
+    def test_registry_lookup_and_delete(self):
+        manager = poller.TaskManager(loop=asyncio.new_event_loop())
+        task = RecordingTask(_id=1, run_at=time() + 60)
+        manager.add(task)
+
+        assert manager.get(1) is task
+        assert manager.get('1') is task
+        with pytest.raises(ValueError):
+            manager.add(RecordingTask(_id=1))
+
+        assert manager.delete('1') is task
+        assert manager.get(1) is None
+        assert manager.tasks() == []
+        assert manager.delete(1) is None
+
+    def test_generated_ids_are_unique(self):
+        manager = poller.TaskManager(loop=asyncio.new_event_loop())
+        for i in range(2000):
+            manager.add(RecordingTask(run_at=time() + 60))
+        assert len(manager.tasks()) == 2000
+
+    @pytest.mark.asyncio
+    async def test_deleted_task_does_not_run(self):
+        manager = poller.TaskManager(loop=asyncio.get_event_loop())
+        deleted = RecordingTask(_id=1, run_at=time() + 0.05)
+        replaced = RecordingTask(_id=2, run_at=time() + 0.05)
+        manager.add(deleted)
+        manager.add(replaced)
+        manager.delete(1)
+        replacement = RecordingTask(_id=2, run_at=time() + 0.05)
+        manager.update(replacement)
+
+        processor = asyncio.ensure_future(manager.process_tasks())
+        await asyncio.sleep(0.1)
+        processor.cancel()
+
+        assert not deleted.started
+        assert not replaced.started
+        assert replacement.started
+
+    def test_recurring_task_does_not_drift(self):
+        task = RecordingTask(_id=1, run_at=1000.0, recurrence_time=10)
+        assert task.next_run_at(now=1003.5) == 1010.0
+        # Missed periods are skipped but the grid is kept
+        assert task.next_run_at(now=1042.0) == 1050.0
+
+    def test_spread_is_deterministic_and_even(self):
+        now = time()
+        tasks = [SleepTask('10.0.0.{}'.format(i), _id=i, run_at=now,
+                           recurrence_time=60) for i in range(1000)]
+        for task in tasks:
+            task.spread()
+
+        again = SleepTask('10.0.0.1', _id=1, run_at=now + 3600, recurrence_time=60)
+        again.spread()
+        assert (again.run_at - tasks[1].run_at + 30) % 60 == pytest.approx(30)
+
+        buckets = Counter(int(task.run_at - now) // 6 for task in tasks)
+        assert all(task.run_at - now < 60 for task in tasks)
+        assert len(buckets) == 10
+        assert min(buckets.values()) > 50
+
+    @pytest.mark.asyncio
+    async def test_metrics_track_task_runs(self):
+        manager = poller.TaskManager(loop=asyncio.get_event_loop())
+        manager.add(RecordingTask(_id=1))
+        manager.add(RecordingTask(_id=2, run_at=time() + 60))
+        processor = asyncio.ensure_future(manager.process_tasks())
+        await asyncio.sleep(0.01)
+        processor.cancel()
+
+        text = manager.metrics.render()
+        assert 'poller_tasks_total{type="RecordingTask",status="success"} 1.0' in text
+        assert 'poller_task_lateness_seconds_count{type="RecordingTask"} 1.0' in text
+        assert 'poller_tasks_scheduled 1.0' in text
+        assert 'poller_tasks_running 0.0' in text
+
+
+class SleepTask(poller.Task):
+    """ Task that sleeps while running """
+
+    def __init__(self, device, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.device = device
+
+    async def run(self):
+        await asyncio.sleep(0.05)
+
+
+class TestTaskLimiter:
+
+    def test_limits_per_device_and_globally(self):
+        started = []
+        limiter = poller.task_manager.TaskLimiter(started.append,
+                                                  max_running=3,
+                                                  max_running_per_device=2)
+        tasks = [SleepTask('a', _id=i) for i in range(3)]
+        tasks += [SleepTask('b', _id=i) for i in range(3, 6)]
+        for task in tasks:
+            limiter.submit(task)
+
+        assert started == [tasks[0], tasks[1], tasks[3]]
+        depth = limiter.run_queue_depth()
+        assert depth['global'] == {'limit': 3, 'running': 3, 'waiting': 3}
+        assert depth['device']['a'] == {'limit': 2, 'running': 2, 'waiting': 1}
+
+        # The freed slot goes round-robin to the next device group
+        limiter.release(tasks[0])
+        assert started[-1] is tasks[2]
+        limiter.release(tasks[1])
+        assert started[-1] is tasks[4]
+
+    @pytest.mark.asyncio
+    async def test_task_manager_releases_slots(self):
+        manager = poller.TaskManager(loop=asyncio.get_event_loop(),
+                                     max_running_per_type={'SleepTask': 1})
+        for i in range(3):
+            manager.add(SleepTask('a', _id=i))
+
+        processor = asyncio.ensure_future(manager.process_tasks())
+        await asyncio.sleep(0.01)
+        assert manager.limiter.run_queue_depth()['type']['SleepTask']['waiting'] == 2
+        await asyncio.sleep(0.2)
+        processor.cancel()
+
+        assert manager.limiter.running == 0
+        assert manager.limiter.run_queue_depth()['global']['waiting'] == 0
+
+
+class TestTaskResults:
+
+    def test_ring_buffer_keeps_newest_results(self):
+        results = poller.task_manager.TaskResults({'start_timestamp': 'd',
+                                                   'octets': 'Q'},
+                                                  max_count=3)
+        for i in range(5):
+            results.append({'start_timestamp': float(i), 'octets': 2 ** 64 - 1 - i})
+        results.append({'start_timestamp': 5.0, 'error': 'timeout'})
+
+        assert len(results) == 3
+        assert results[0] == {'start_timestamp': 3.0, 'octets': 2 ** 64 - 1 - 3}
+        assert results[-1] == {'start_timestamp': 5.0, 'error': 'timeout'}
+        assert [result['start_timestamp'] for result in results] == [3.0, 4.0, 5.0]
+
+    def test_memory_is_capped(self):
+        results = poller.task_manager.TaskResults({'start_timestamp': 'd'},
+                                                  max_count=10)
+        for i in range(10):
+            results.append({'start_timestamp': time()})
+        size = results.nbytes()
+        for i in range(1000):
+            results.append({'start_timestamp': time()})
+        assert results.nbytes() == size
+
+    def test_results_expire_by_age(self):
+        results = poller.task_manager.TaskResults({'start_timestamp': 'd'},
+                                                  max_age=60)
+        results.append({'start_timestamp': time() - 120})
+        results.append({'start_timestamp': time()})
+        assert len(results) == 1
@@ -0,0 +1,95 @@
+import poller
+import pytest
+import asyncio
+from time import time
+from poller.http_tasks import GetPage
+from poller.ip_tasks import Ping, PingSweep, Trace
+from poller.snmp_tasks import (InterfaceOctetsProbe, InterfaceTableProbe,
+                               SystemInfoProbe)
+from poller.task_store import TaskStore
+
+
+def factory(data):
+    return poller.RestApi.task_types[data['type']].from_json(data)
+
+
+class TestTaskStore:
+
+    def test_restore_replays_snapshot_and_log(self, tmp_path):
+        path = str(tmp_path / 'tasks.json')
+        manager = poller.TaskManager(loop=asyncio.new_event_loop(),
+                                     store=TaskStore(path))
+        now = time()
+        for i in range(5):
+            manager.add(Ping('10.0.0.{}'.format(i), _id=i, run_at=now + 60,
+                             recurrence_time=30, description='ping'))
+        manager.delete(3)
+        manager.update(Ping('10.0.0.99', _id=4, run_at=now + 60))
+
+        restored = poller.TaskManager(loop=asyncio.new_event_loop(),
+                                      store=TaskStore(path))
+        assert restored.restore(factory) == 4
+        assert restored.get(3) is None
+        assert restored.get(4).device == '10.0.0.99'
+        assert restored.get(0).description == 'ping'
+        assert restored.store.log_entries == 0
+
+    def test_restore_keeps_schedule_phase(self, tmp_path):
+        path = str(tmp_path / 'tasks.json')
+        manager = poller.TaskManager(loop=asyncio.new_event_loop(),
+                                     store=TaskStore(path))
+        run_at = time() - 95
+        manager.add(Ping('10.0.0.1', _id=1, run_at=run_at, recurrence_time=30))
+
+        restored = poller.TaskManager(loop=asyncio.new_event_loop(),
+                                      store=TaskStore(path))
+        restored.restore(factory)
+        task = restored.get(1)
+        assert task.run_at == pytest.approx(run_at + 120)
+
+    def test_log_is_compacted(self, tmp_path):
+        store = TaskStore(str(tmp_path / 'tasks.json'), compact_after=10)
+        manager = poller.TaskManager(loop=asyncio.new_event_loop(), store=store)
+        for i in range(5):
+            manager.add(Ping('10.0.0.1', _id=i, run_at=time() + 60))
+        for i in range(25):
+            manager.update(Ping('10.0.0.2', _id=i % 5, run_at=time() + 60))
+
+        assert store.log_entries <= 10
+        tasks = list(TaskStore(store.snapshot_path).load())
+        assert len(tasks) == 5
+        assert all(task['device'] == '10.0.0.2' for task in tasks)
+
+    @pytest.mark.parametrize('task', [
+        Ping('10.0.0.1', count=3, rollup=5, _id=1, recurrence_time=30,
+             recurrence_count=4, max_results=10),
+        PingSweep(['10.0.0.0/30'], rate=100, _id=2),
+        Trace('10.0.0.1', icmp=True, changes_only=True, _id=3,
+              description='trace'),
+        GetPage('http://localhost/', timeout=5, _id=4),
+        SystemInfoProbe('10.0.0.1', None, changes_only=True, _id=5),
+        InterfaceOctetsProbe('10.0.0.1', 2, None, counters=['ifInErrors'],
+                             _id=6),
+        InterfaceTableProbe('10.0.0.1', None, if_indexes=[3, 1], _id=7),
+    ], ids=lambda task: type(task).__name__)
+    def test_from_json_round_trip(self, task):
+        restored = factory(task.to_json())
+        assert type(restored) is type(task)
+        assert restored.to_json() == task.to_json()
+        for cls in type(task).__mro__:
+            for slot in getattr(cls, '__slots__', ()):
+                assert hasattr(restored, slot), slot
+
+    @pytest.mark.asyncio
+    async def test_recurrence_count_is_persisted(self, tmp_path):
+        path = str(tmp_path / 'tasks.json')
+        manager = poller.TaskManager(loop=asyncio.get_event_loop(),
+                                     store=TaskStore(path))
+        manager.add(Ping('127.0.0.1', count=1, _id=1, run_at=time(),
+                         recurrence_time=60, recurrence_count=3))
+        processor = asyncio.ensure_future(manager.process_tasks())
+        await asyncio.sleep(0.05)
+        processor.cancel()
+
+        tasks = list(TaskStore(path).load())
+        assert [task['recurrence_count'] for task in tasks] == [2]
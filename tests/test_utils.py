@@ -0,0 +1,66 @@
+import asyncio
+from array import array
+import poller
+import pytest
+from poller.snmp_engine import Oid
+from poller.utils import LruCache, TimerWheel, json_value
+
+
+class TestLruCache:
+
+    def test_evicts_least_recently_used(self):
+        cache = LruCache(max_size=2)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        assert cache.get('a') == 1
+        cache.set('c', 3)
+
+        assert cache.get('b') is None
+        assert cache.get('a') == 1
+        assert cache.get('c') == 3
+        assert (cache.hits, cache.misses) == (3, 1)
+
+    def test_entries_expire(self):
+        cache = LruCache(ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2, ttl=-1)
+        assert cache.get('a') == 1
+        assert cache.get('b') is None
+        assert len(cache) == 1
+
+    def test_invalidate(self):
+        cache = LruCache()
+        cache.set(('10.0.0.1', 1), 'x')
+        cache.set(('10.0.0.2', 1), 'y')
+        cache.invalidate(lambda key: key[0] == '10.0.0.1')
+        assert cache.get(('10.0.0.1', 1)) is None
+        assert cache.get(('10.0.0.2', 1)) == 'y'
+
+
+class TestJsonValue:
+
+    def test_renders_nested_values(self):
+        result = {'name': b'r1', 'serial': b'\xff\x01', 'object_id': Oid((1, 3, 6, 1)),
+                  'interfaces': [{'name': b'eth0', 'in_bps': 8.0}]}
+        assert json_value(result) == {'name': 'r1', 'serial': '0xff01',
+                                      'object_id': '1.3.6.1',
+                                      'interfaces': [{'name': 'eth0', 'in_bps': 8.0}]}
+
+    def test_renders_arrays(self):
+        assert json_value({'rtts': array('d', [1.5, float('nan')])}) == {'rtts': [1.5, None]}
+
+
+class TestTimerWheel:
+
+    @pytest.mark.asyncio
+    async def test_expires_in_order(self):
+        expired = []
+        wheel = TimerWheel(expired.append, resolution=.01, size=4)
+        wheel.add('late', .1)
+        slot = wheel.add('cancelled', .02)
+        wheel.add('early', .02)
+        wheel.cancel('cancelled', slot)
+
+        await asyncio.sleep(.2)
+        assert expired == ['early', 'late']
+        assert wheel._handle is None